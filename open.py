@@ -1,5 +1,6 @@
 import logging
 import os
+import sys
 
 import tornado
 
@@ -16,6 +17,12 @@ logging.basicConfig(
     level=logging.DEBUG,
 )
 port = 8001
+# python open.py [processes]
+processes = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+if processes > 1:
+    logging.debug("Opening proxy on port %s with %d workers" % (port, processes))
+    run_proxy(port, processes=processes)
+    sys.exit(0)
 run_proxy(port, start_ioloop=False)
 
 ili = tornado.ioloop.IOLoop.instance()
@@ -0,0 +1,193 @@
+"""
+Admission control for proxied requests.
+
+Past a point, taking more requests only makes every request slower: they
+queue inside the upstream client, the memcached pool runs out of clients
+and everybody times out. An `AdmissionController` caps the requests being
+served, overall and per client address, and makes the others wait in a
+bounded queue:
+
+    admission = AdmissionController(max_in_flight=1000, max_per_client=100,
+                                    max_queue=1000, max_wait=5)
+    ticket = admission.admit(address, on_admitted, on_rejected)
+    ...
+    admission.release(ticket)     # when done, whether admitted or still waiting
+
+Waiting requests are admitted in arrival order as soon as both limits
+allow; a request whose client is at its limit does not hold up those of
+other clients. Requests arriving to a full queue, and those that waited
+`max_wait` seconds, get `on_rejected()` and should be answered 503 with a
+Retry-After of `retry_after` seconds.
+
+`report` has the counts of admitted, queued and rejected requests, the
+current and peak queue depth and the average and longest wait.
+"""
+import collections
+import functools
+import time
+
+from tornado import ioloop
+from tornado import stack_context
+
+WAITING = 'waiting'
+ADMITTED = 'admitted'
+DONE = 'done'
+
+
+class _Ticket(object):
+    __slots__ = ('client', 'state', 'queued_at', 'on_admitted', 'on_rejected', 'timeout')
+
+    def __init__(self, client):
+        self.client = client
+        self.state = None
+        self.queued_at = 0
+        self.on_admitted = self.on_rejected = self.timeout = None
+
+
+class AdmissionController(object):
+    def __init__(self, max_in_flight=1000, max_per_client=100, max_queue=1000, max_wait=5,
+                 retry_after=1, io_loop=None):
+        self.max_in_flight = max_in_flight
+        self.max_per_client = max_per_client
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._io_loop = io_loop
+        self.in_flight = 0
+        self.clients = {}  # address -> requests in flight
+        self.waiting = {}  # address -> requests queued
+        self.queue = collections.deque()
+        self.peak_queue = 0
+        self.stats = {}
+
+    @property
+    def io_loop(self):
+        # Resolved late, see MemcacheLease.io_loop.
+        return self._io_loop or ioloop.IOLoop.instance()
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def _fits(self, client):
+        return self.in_flight < self.max_in_flight and \
+            self.clients.get(client, 0) < self.max_per_client
+
+    def admit(self, client, on_admitted, on_rejected):
+        """Calls `on_admitted()` once the request of `client` may be served,
+        right away if there is room, or `on_rejected()`. Returns the ticket
+        to `release`."""
+        ticket = _Ticket(client)
+        if client not in self.waiting and self._fits(client):
+            self._admit(ticket)
+            on_admitted()
+            return ticket
+        if len(self.queue) >= self.max_queue:
+            self._statlog('rejected')
+            self._statlog('rejected_queue_full')
+            ticket.state = DONE
+            on_rejected()
+            return ticket
+        self._statlog('queued')
+        ticket.state = WAITING
+        ticket.queued_at = time.time()
+        ticket.on_admitted = stack_context.wrap(on_admitted)
+        ticket.on_rejected = stack_context.wrap(on_rejected)
+        with stack_context.NullContext():
+            ticket.timeout = self.io_loop.add_timeout(
+                ticket.queued_at + self.max_wait, functools.partial(self._expired, ticket))
+        self.queue.append(ticket)
+        self.waiting[client] = self.waiting.get(client, 0) + 1
+        self.peak_queue = max(self.peak_queue, len(self.queue))
+        return ticket
+
+    def _admit(self, ticket):
+        ticket.state = ADMITTED
+        self.in_flight += 1
+        self.clients[ticket.client] = self.clients.get(ticket.client, 0) + 1
+        self._statlog('admitted')
+
+    def release(self, ticket):
+        """Ends the request of `ticket`, or its wait if it was not admitted yet."""
+        if ticket.state == WAITING:
+            self._statlog('abandoned')
+            self._dequeue(ticket)
+        elif ticket.state == ADMITTED:
+            self.in_flight -= 1
+            left = self.clients[ticket.client] - 1
+            if left:
+                self.clients[ticket.client] = left
+            else:
+                del self.clients[ticket.client]
+            self._admit_waiting()
+        ticket.state = DONE
+
+    def _dequeue(self, ticket):
+        self.queue.remove(ticket)
+        self.io_loop.remove_timeout(ticket.timeout)
+        left = self.waiting[ticket.client] - 1
+        if left:
+            self.waiting[ticket.client] = left
+        else:
+            del self.waiting[ticket.client]
+        wait = time.time() - ticket.queued_at
+        self._statlog('wait_seconds', wait)
+        self.stats['wait_max'] = max(self.stats.get('wait_max', 0), wait)
+
+    def _admit_waiting(self):
+        if not self.queue or self.in_flight >= self.max_in_flight:
+            return
+        for ticket in list(self.queue):
+            if self.in_flight >= self.max_in_flight:
+                break
+            if self._fits(ticket.client):
+                self._dequeue(ticket)
+                self._admit(ticket)
+                ticket.on_admitted()
+
+    def _expired(self, ticket):
+        if ticket.state != WAITING:
+            return
+        self._statlog('rejected')
+        self._statlog('rejected_deadline')
+        self._dequeue(ticket)
+        ticket.state = DONE
+        ticket.on_rejected()
+
+    def report(self):
+        waited = self.stats.get('queued', 0) - len(self.queue)
+        return dict(self.stats, in_flight=self.in_flight, clients=len(self.clients),
+                    queue=len(self.queue), peak_queue=self.peak_queue,
+                    wait_avg=self.stats.get('wait_seconds', 0) / waited if waited else 0)
+
+
+if __name__ == '__main__':
+    loop = ioloop.IOLoop.instance()
+    admission = AdmissionController(max_in_flight=2, max_per_client=1, max_queue=2,
+                                    max_wait=0.1, io_loop=loop)
+    events = []
+
+    def request(client, name):
+        return admission.admit(client, lambda: events.append(name + ' admitted'),
+                               lambda: events.append(name + ' rejected'))
+
+    a1 = request('a', 'a1')
+    a2 = request('a', 'a2')       # a is at its limit
+    b1 = request('b', 'b1')       # not held up by a2
+    c1 = request('c', 'c1')       # no room left
+    d1 = request('d', 'd1')       # queue full
+    assert events == ['a1 admitted', 'b1 admitted', 'd1 rejected'], events
+    admission.release(a1)
+    assert events[3:] == ['a2 admitted'], events     # arrival order, before c1
+    admission.release(b1)
+    assert events[4:] == ['c1 admitted'], events
+    b2 = request('b', 'b2')       # no room left
+    loop.add_timeout(time.time() + 0.2, loop.stop)
+    loop.start()
+    assert events[5:] == ['b2 rejected'], events
+    for ticket in (a2, c1, b2, d1):
+        admission.release(ticket)
+    report = admission.report()
+    assert report['in_flight'] == 0 and report['queue'] == 0 and not admission.clients
+    assert not admission.waiting and report['rejected_deadline'] == 1
+    assert report['peak_queue'] == 2
+    print 'ok'
@@ -0,0 +1,152 @@
+"""
+Per-origin circuit breaker.
+
+An origin that is down makes every request for it wait for the connect or
+request timeout. Once `threshold` requests in a row failed (connection
+errors, timeouts, or the 502-504 answers of an overloaded gateway), the
+breaker opens and the origin's requests are answered at once:
+
+    if not breaker.allow(host):
+        ...  # fail fast, 504 if breaker.timed_out(host) else 502
+    ...fetch...
+    breaker.failure(host, timeout) or breaker.success(host)
+
+After `reset_timeout` seconds one request is let through as a probe
+(half-open). If it succeeds the breaker closes, if it fails the breaker
+opens again for twice as long, up to `max_reset_timeout`. A probe taking
+longer than the current reset timeout does not keep the origin blocked,
+the next request probes again.
+
+Only origins with recent failures are tracked, at most `max_hosts` of them.
+"""
+import logging
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class _Origin(object):
+    __slots__ = ('state', 'failures', 'timeout', 'opened_at', 'reset_timeout', 'probed_at')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.timeout = False
+        self.opened_at = self.probed_at = 0
+        self.reset_timeout = 0
+
+
+class CircuitBreaker(object):
+    def __init__(self, threshold=5, reset_timeout=30, max_reset_timeout=300,
+                 max_hosts=10000):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.max_hosts = max_hosts
+        self.origins = {}
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def allow(self, host):
+        """Whether a request to `host` may go upstream."""
+        origin = self.origins.get(host)
+        if origin is None or origin.state == CLOSED:
+            return True
+        now = time.time()
+        if origin.state == OPEN and now >= origin.opened_at + origin.reset_timeout or \
+                origin.state == HALF_OPEN and now >= origin.probed_at + origin.reset_timeout:
+            origin.state = HALF_OPEN
+            origin.probed_at = now
+            self._statlog('probes')
+            return True
+        self._statlog('rejected')
+        return False
+
+    def timed_out(self, host):
+        """Whether the last failure of `host` was a timeout."""
+        origin = self.origins.get(host)
+        return origin is not None and origin.timeout
+
+    def retry_after(self, host):
+        """Seconds until `host` is probed again."""
+        origin = self.origins.get(host)
+        if origin is None or origin.state == CLOSED:
+            return 0
+        start = origin.opened_at if origin.state == OPEN else origin.probed_at
+        return max(0, int(start + origin.reset_timeout - time.time()) + 1)
+
+    def success(self, host):
+        origin = self.origins.pop(host, None)
+        if origin is not None and origin.state != CLOSED:
+            self._statlog('closed')
+            logging.info('Circuit of %s closed' % host)
+
+    def failure(self, host, timeout=False):
+        origin = self.origins.get(host)
+        if origin is None:
+            if len(self.origins) >= self.max_hosts:
+                self._forget_closed()
+            origin = self.origins[host] = _Origin()
+        origin.failures += 1
+        origin.timeout = timeout
+        if origin.state == HALF_OPEN:
+            self._statlog('probe_failures')
+            self._open(host, origin, min(origin.reset_timeout * 2, self.max_reset_timeout))
+        elif origin.state == CLOSED and origin.failures >= self.threshold:
+            self._open(host, origin, self.reset_timeout)
+
+    def _open(self, host, origin, reset_timeout):
+        if origin.state == CLOSED:
+            self._statlog('opened')
+            logging.warning('Circuit of %s opened after %d failures'
+                            % (host, origin.failures))
+        origin.state = OPEN
+        origin.opened_at = time.time()
+        origin.reset_timeout = reset_timeout
+
+    def _forget_closed(self):
+        for host in [host for host, origin in self.origins.iteritems()
+                     if origin.state == CLOSED]:
+            del self.origins[host]
+
+    def report(self, max_hosts=100):
+        states = {}
+        hosts = {}
+        for host, origin in self.origins.iteritems():
+            states[origin.state] = states.get(origin.state, 0) + 1
+            if origin.state != CLOSED and len(hosts) < max_hosts:
+                hosts[host] = {'state': origin.state, 'failures': origin.failures,
+                               'timeout': origin.timeout,
+                               'retry_after': self.retry_after(host)}
+        return dict(self.stats, open=states.get(OPEN, 0), half_open=states.get(HALF_OPEN, 0),
+                    failing=states.get(CLOSED, 0), hosts=hosts)
+
+
+if __name__ == '__main__':
+    breaker = CircuitBreaker(threshold=3, reset_timeout=0.2, max_reset_timeout=0.4)
+    for i in range(2):
+        breaker.failure('a')
+    assert breaker.allow('a')
+    breaker.success('a')
+    for i in range(3):
+        assert breaker.allow('a')
+        breaker.failure('a', timeout=True)
+    assert not breaker.allow('a') and breaker.timed_out('a')
+    time.sleep(0.25)
+    assert breaker.allow('a')          # the probe
+    assert not breaker.allow('a')
+    breaker.failure('a')
+    assert breaker.report()['hosts']['a']['state'] == OPEN
+    time.sleep(0.25)
+    assert not breaker.allow('a')      # waits twice as long now
+    time.sleep(0.2)
+    assert breaker.allow('a')
+    breaker.success('a')
+    assert breaker.allow('a') and breaker.allow('a')
+    report = breaker.report()
+    assert report['opened'] == 1 and report['closed'] == 1 and not report['hosts']
+    print 'ok'
@@ -0,0 +1,224 @@
+"""
+Binary layout of cached responses stored in memcached.
+
+An entry is a fixed header followed by the effective url, the response
+headers and the body:
+
+    magic 'WP' | version | flags | code | request_time | stored_at |
+    url length | headers length | body length | url | headers | body
+
+`stored_at` is when the response was fetched or last revalidated (see
+freshness). Entries of older versions are still read: version 2 ones have
+a 2 byte url length, and version 1 ones also lack `stored_at`, read as 0.
+
+Headers are encoded as ``Name: value`` lines joined by CRLF. The body is
+zlib-compressed (flag FLAG_ZLIB) only when that is worth it: small bodies
+and content types that are already compressed are stored as they are.
+Text bodies may instead be compressed against a shared dictionary (flag
+FLAG_ZDICT, see shareddict), in which case the body starts with the 4 byte
+dictionary id.
+
+Entries are stored with the memcached flag MEMCACHED_FLAG so that other
+clients can tell them apart from pickled values.
+
+A resource whose responses vary on request headers that are not part of
+its key has a vary marker under its key instead, ``'WV' | 1 |``
+followed by the header names joined by commas, and its entries under
+variant keys (see fingerprint.KeyPolicy.variant).
+"""
+import struct
+import zlib
+
+from shareddict import UnknownDictionary
+
+MAGIC = 'WP'
+VARY_MAGIC = 'WV'
+VERSION = 3
+VARY_VERSION = 1
+MEMCACHED_FLAG = 1 << 8
+
+FLAG_ZLIB = 1 << 0
+FLAG_ZDICT = 1 << 1
+
+HEADER = struct.Struct('!2sBBHddIII')
+HEADER_V2 = struct.Struct('!2sBBHddHII')
+HEADER_V1 = struct.Struct('!2sBBHdHII')
+DICTIONARY_ID = struct.Struct('!I')
+
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 1024
+# Keep the raw body unless compression saves at least this fraction.
+COMPRESS_MIN_SAVING = 0.1
+INCOMPRESSIBLE_TYPES = ('image/', 'video/', 'audio/', 'font/woff',
+                        'application/zip', 'application/gzip',
+                        'application/x-gzip', 'application/x-rar',
+                        'application/x-7z', 'application/pdf',
+                        'application/x-shockwave-flash', 'application/ogg')
+# SVG is the one image type that compresses well.
+COMPRESSIBLE_EXCEPTIONS = ('image/svg',)
+
+
+def should_compress(content_type, body):
+    if len(body) < COMPRESS_MIN_SIZE:
+        return False
+    content_type = (content_type or '').lower()
+    if content_type.startswith(COMPRESSIBLE_EXCEPTIONS):
+        return True
+    return not content_type.startswith(INCOMPRESSIBLE_TYPES)
+
+
+def _content_type(headers):
+    for name, value in headers:
+        if name.lower() == 'content-type':
+            return value
+    return None
+
+
+def encode_entry(entry, dictionaries=None):
+    """Packs a response entry dict (see proxy.response_entry) into bytes.
+
+    With a `shareddict.DictionaryRegistry`, bodies of groups that have a
+    dictionary are compressed with it and the achieved ratio is recorded.
+    """
+    body = entry['body'] or ''
+    headers = entry['headers']
+    raw_size = len(body)
+    flags = 0
+    if should_compress(_content_type(headers), body):
+        dictionary = dictionaries.for_entry(entry) if dictionaries is not None else None
+        if dictionary is not None:
+            compressed = DICTIONARY_ID.pack(dictionary.id) + dictionary.compress(body)
+            flag = FLAG_ZDICT
+        else:
+            compressed = zlib.compress(body, COMPRESS_LEVEL)
+            flag = FLAG_ZLIB
+        if len(compressed) <= len(body) * (1 - COMPRESS_MIN_SAVING):
+            body = compressed
+            flags |= flag
+    if dictionaries is not None:
+        dictionaries.record(entry, raw_size, len(body))
+    url = entry['effective_url'] or ''
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    header_block = '\r\n'.join('%s: %s' % (name, value) for name, value in headers)
+    return ''.join((
+        HEADER.pack(MAGIC, VERSION, flags, entry['code'], entry['request_time'] or 0.0,
+                    entry.get('stored_at', 0.0), len(url), len(header_block), len(body)),
+        url, header_block, body,
+    ))
+
+
+def encode_vary(names):
+    return VARY_MAGIC + chr(VARY_VERSION) + ','.join(names)
+
+
+def decode_vary(data):
+    """The header names of a vary marker, or None if `data` is not one."""
+    if len(data) < 3 or data[:2] != VARY_MAGIC or ord(data[2]) != VARY_VERSION:
+        return None
+    return tuple(data[3:].split(',')) if len(data) > 3 else ()
+
+
+def decode_entry(data, dictionaries=None):
+    """Unpacks bytes written by `encode_entry`.
+
+    Raises ValueError for anything that is not an entry of a known
+    version, e.g. values pickled by an older proxy, and its subclass
+    `shareddict.UnknownDictionary` if the body was compressed with a
+    dictionary that is not in `dictionaries`.
+    """
+    if len(data) < HEADER_V1.size or data[:2] != MAGIC:
+        raise ValueError('Not a cache entry')
+    version = ord(data[2])
+    if version in (VERSION, 2):
+        header = HEADER if version == VERSION else HEADER_V2
+        if len(data) < header.size:
+            raise ValueError('Truncated cache entry')
+        magic, version, flags, code, request_time, stored_at, url_len, headers_len, \
+            body_len = header.unpack_from(data)
+    elif version == 1:
+        header = HEADER_V1
+        magic, version, flags, code, request_time, url_len, headers_len, body_len = \
+            HEADER_V1.unpack_from(data)
+        stored_at = 0.0
+    else:
+        raise ValueError('Unsupported cache entry version %d' % version)
+    if header.size + url_len + headers_len + body_len != len(data):
+        raise ValueError('Truncated cache entry')
+    pos = header.size
+    url = data[pos:pos + url_len]
+    pos += url_len
+    header_block = data[pos:pos + headers_len]
+    pos += headers_len
+    body = data[pos:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    elif flags & FLAG_ZDICT:
+        dictionary_id, = DICTIONARY_ID.unpack_from(body)
+        dictionary = dictionaries.get(dictionary_id) if dictionaries is not None else None
+        if dictionary is None:
+            raise UnknownDictionary(dictionary_id)
+        body = dictionary.decompress(body[DICTIONARY_ID.size:])
+    headers = []
+    if header_block:
+        for line in header_block.split('\r\n'):
+            name, _, value = line.partition(': ')
+            headers.append((name, value))
+    return {
+        'body': body,
+        'code': code,
+        'effective_url': url,
+        'headers': headers,
+        'time_info': {},
+        'request_time': request_time,
+        'stored_at': stored_at,
+    }
+
+
+if __name__ == '__main__':
+    # Compares encode/decode cost and stored size with the previous
+    # cPickle + zlib + base64 format.
+    import base64
+    import os
+    import timeit
+    import cPickle
+    from tornado.httputil import HTTPHeaders
+
+    def legacy_dumps(entry):
+        result = dict(entry, headers=HTTPHeaders(entry['headers']))
+        return base64.encodestring(zlib.compress(cPickle.dumps(result)))
+
+    def legacy_loads(dumped):
+        return cPickle.loads(zlib.decompress(base64.decodestring(dumped)))
+
+    html = ''.join('<div class="item-%d"><a href="/page/%d">Item %d</a></div>\n' % (i, i, i)
+                   for i in xrange(1500))
+    samples = [
+        ('text/html 80KB', 'text/html; charset=utf-8', html),
+        ('text/css 900B', 'text/css', html[:900]),
+        ('image/jpeg 120KB', 'image/jpeg', os.urandom(120 * 1024)),
+        ('application/javascript 300KB', 'application/javascript', html * 4),
+    ]
+    print '%-30s %10s %10s %10s %10s %10s %10s' % (
+        'sample', 'old size', 'new size', 'old enc', 'new enc', 'old dec', 'new dec')
+    for label, content_type, body in samples:
+        entry = {
+            'body': body,
+            'code': 200,
+            'effective_url': 'http://www.example.com/some/path?query=1',
+            'headers': [('Date', 'Sat, 17 Oct 2026 12:00:00 GMT'),
+                        ('Content-Type', content_type),
+                        ('Server', 'nginx'),
+                        ('Cache-Control', 'max-age=3600')],
+            'time_info': {},
+            'request_time': 0.123,
+        }
+        old = legacy_dumps(entry)
+        new = encode_entry(entry)
+        assert decode_entry(new)['body'] == body
+        n = 200
+        timings = [min(timeit.repeat(lambda: f(arg), number=n, repeat=3)) / n * 1e6
+                   for f, arg in ((legacy_dumps, entry), (encode_entry, entry),
+                                  (legacy_loads, old), (decode_entry, new))]
+        print '%-30s %10d %10d %8.0fus %8.0fus %8.0fus %8.0fus' % (
+            (label, len(old), len(new)) + tuple(timings))
@@ -0,0 +1,188 @@
+"""
+Single-flight coalescing of concurrent requests for the same resource.
+
+While one request (the leader) fetches a fingerprint, every other request
+for that fingerprint (a follower) waits for the leader's result instead of
+doing its own cache lookup and upstream fetch.
+
+    role = coalescer.join(fingerprint, on_result)
+    if role == FOLLOWER:
+        return                  # on_result(response) will be called later
+    ...fetch...
+    if role == LEADER:
+        coalescer.release(fingerprint, response)
+
+`MemcacheLease` does the same across proxy nodes sharing a memcached pool:
+the node whose ``add`` of the lease key succeeds fetches upstream and fills
+the cache, the others poll memcached for the value until the lease is gone.
+
+"""
+import logging
+import os
+import socket
+import time
+
+from tornado import ioloop
+
+LEADER = 'leader'
+FOLLOWER = 'follower'
+# The in-flight fetch already has max_followers waiting, fetch directly.
+OVERFLOW = 'overflow'
+
+
+class RequestCoalescer(object):
+    def __init__(self, max_followers=500):
+        self.max_followers = max_followers
+        self.inflight = {}
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def join(self, key, callback):
+        """Registers interest in `key` and returns LEADER, FOLLOWER or OVERFLOW.
+
+        Followers get `callback(response)` when the leader releases the key,
+        with None if the leader has no response to share.
+        """
+        followers = self.inflight.get(key)
+        if followers is None:
+            self.inflight[key] = []
+            self._statlog('leaders')
+            return LEADER
+        if len(followers) >= self.max_followers:
+            self._statlog('overflows')
+            return OVERFLOW
+        followers.append(callback)
+        self._statlog('followers')
+        return FOLLOWER
+
+    def release(self, key, response):
+        """Ends the in-flight fetch for `key` and hands `response` to its followers."""
+        followers = self.inflight.pop(key, None)
+        if not followers:
+            return
+        if response is None:
+            self._statlog('unshared', len(followers))
+        for callback in followers:
+            try:
+                callback(response)
+            except Exception:
+                logging.error('Exception in coalesced request callback', exc_info=True)
+
+    def waiting(self):
+        """Number of followers currently waiting on a leader."""
+        return sum(len(f) for f in self.inflight.itervalues())
+
+
+class MemcacheLease(object):
+    def __init__(self, client, ttl=10, poll_interval=0.05, max_poll_interval=1,
+                 max_wait=None, prefix='lease:', io_loop=None):
+        self.client = client
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_wait = ttl if max_wait is None else max_wait
+        self.prefix = prefix
+        self._io_loop = io_loop
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.stats = {}
+
+    @property
+    def io_loop(self):
+        # Resolved late: the lease is created at import time, possibly in a
+        # supervisor that forks workers, which must not share an IOLoop.
+        return self._io_loop or ioloop.IOLoop.instance()
+
+    def _statlog(self, name):
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+    def acquire(self, key, callback):
+        """Calls `callback(True)` if this node now holds the lease on `key`.
+
+        If memcached cannot be asked, the lease is considered held so the
+        request is not left waiting on a lease nobody holds.
+        """
+
+        def added(stored):
+            if stored is None:
+                self._statlog('unavailable')
+                callback(True)
+                return
+            self._statlog('won' if stored else 'lost')
+            callback(bool(stored))
+
+        self.client.add(self.prefix + key, self.owner, time=self.ttl, callback=added)
+
+    def release(self, key):
+        self.client.delete(self.prefix + key, callback=lambda data: None)
+
+    def wait(self, key, callback):
+        """Polls for the value of `key` while another node holds its lease.
+
+        Calls `callback(value)` once the holder stored it, or `callback(None)`
+        when the lease disappears or `max_wait` passes without a value, in
+        which case the caller should fetch directly.
+        """
+        deadline = time.time() + self.max_wait
+        state = {'interval': self.poll_interval}
+
+        def poll():
+            self.client.get(key, callback=got_value)
+
+        def got_value(value):
+            if value:
+                self._statlog('waited_hits')
+                callback(value)
+            elif time.time() >= deadline:
+                self._statlog('wait_timeouts')
+                callback(None)
+            else:
+                self.client.get(self.prefix + key, callback=got_lease)
+
+        def got_lease(owner):
+            if not owner:
+                # Released without a value (uncacheable or failed) or expired.
+                self._statlog('lease_gone')
+                callback(None)
+                return
+            delay = min(state['interval'], max(deadline - time.time(), 0))
+            state['interval'] = min(state['interval'] * 2, self.max_poll_interval)
+            self.io_loop.add_timeout(time.time() + delay, poll)
+
+        self.io_loop.add_timeout(time.time() + self.poll_interval, poll)
+
+
+if __name__ == '__main__':
+    coalescer = RequestCoalescer(max_followers=2)
+    results = []
+    assert coalescer.join('a', results.append) == LEADER
+    assert coalescer.join('a', results.append) == FOLLOWER
+    assert coalescer.join('a', results.append) == FOLLOWER
+    assert coalescer.join('a', results.append) == OVERFLOW
+    assert coalescer.join('b', results.append) == LEADER
+    assert coalescer.waiting() == 2
+    coalescer.release('a', 'response')
+    assert results == ['response', 'response'], results
+    assert coalescer.join('a', results.append) == LEADER   # a new fetch
+
+    # Released without a response: followers fetch on their own.
+    coalescer.join('b', results.append)
+    coalescer.release('b', None)
+    assert results[2:] == [None], results
+    coalescer.release('b', 'late')                          # nobody is waiting
+    assert results[3:] == [], results
+
+    # A failing follower does not keep the others from their response.
+    def broken(response):
+        raise ValueError(response)
+    coalescer.join('a', broken)
+    coalescer.join('a', results.append)
+    logging.disable(logging.ERROR)
+    coalescer.release('a', 'other')
+    logging.disable(logging.NOTSET)
+    assert results[3:] == ['other'], results
+    assert not coalescer.inflight and coalescer.waiting() == 0
+    assert coalescer.stats == {'leaders': 3, 'followers': 5, 'overflows': 1, 'unshared': 1}, \
+        coalescer.stats
+    print 'ok'
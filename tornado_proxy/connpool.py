@@ -0,0 +1,165 @@
+"""
+Idle keep-alive connections to origin servers.
+
+Connections are pooled per (scheme, host, port). A connection goes back to
+the pool only after a response whose end was framed (Content-Length,
+chunked encoding or no body) was read completely and neither side asked to
+close it; it is closed if it stays idle longer than `idle_timeout` or the
+pool is full.
+
+    pool = ConnectionPool(max_idle=256, max_idle_per_host=8, idle_timeout=30)
+    stream = pool.checkout(key)     # an idle IOStream, or None to connect
+    ...
+    pool.checkin(key, stream)       # once the response on it is complete
+
+`stats` counts connections reused, newly opened, parked, and dropped because
+the origin closed them, they expired, or a limit was reached.
+"""
+import collections
+import time
+
+from tornado import ioloop
+from tornado import stack_context
+
+
+def pool_key(parsed):
+    """The pool key of a `urlparse.urlsplit` result."""
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    return (parsed.scheme, (parsed.hostname or '').lower(), port)
+
+
+class ConnectionPool(object):
+    def __init__(self, max_idle=256, max_idle_per_host=8, idle_timeout=30,
+                 io_loop=None):
+        self.max_idle = max_idle
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.hosts = {}  # key -> idle streams, most recently parked last
+        self.parked = collections.OrderedDict()  # stream -> (key, timeout), oldest first
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def __len__(self):
+        return len(self.parked)
+
+    def reuse_rate(self):
+        """Fraction of upstream requests sent on a reused connection."""
+        reused = self.stats.get('reused', 0)
+        total = reused + self.stats.get('new', 0)
+        return float(reused) / total if total else 0.0
+
+    def checkout(self, key):
+        """Returns an idle connection to `key`, or None if a new one is needed."""
+        streams = self.hosts.get(key)
+        while streams:
+            stream = streams[-1]
+            self._remove(stream)
+            # Bytes the origin sent while the connection was idle cannot be
+            # the answer to the next request.
+            if stream.closed() or stream._read_buffer_size:
+                self._statlog('stale')
+                stream.close()
+                continue
+            self._statlog('reused')
+            return stream
+        self._statlog('new')
+        return None
+
+    def checkin(self, key, stream):
+        """Parks `stream`, whose last response was read completely.
+
+        Returns False if it was closed instead.
+        """
+        if stream.closed():
+            return False
+        streams = self.hosts.setdefault(key, [])
+        if len(streams) >= self.max_idle_per_host:
+            self._statlog('host_limit')
+            stream.close()
+            return False
+        # Not in the context of the request that used the connection last.
+        with stack_context.NullContext():
+            stream.set_close_callback(lambda: self._on_close(stream))
+            timeout = self.io_loop.add_timeout(time.time() + self.idle_timeout,
+                                               lambda: self._expire(stream))
+        streams.append(stream)
+        self.parked[stream] = (key, timeout)
+        self._statlog('parked')
+        while len(self.parked) > self.max_idle:
+            oldest = next(iter(self.parked))
+            self._remove(oldest)
+            oldest.close()
+            self._statlog('evicted')
+        return True
+
+    def _remove(self, stream):
+        key, timeout = self.parked.pop(stream)
+        self.io_loop.remove_timeout(timeout)
+        streams = self.hosts[key]
+        streams.remove(stream)
+        if not streams:
+            del self.hosts[key]
+        stream.set_close_callback(None)
+
+    def _on_close(self, stream):
+        if stream in self.parked:
+            self._remove(stream)
+            self._statlog('closed_idle')
+
+    def _expire(self, stream):
+        if stream in self.parked:
+            self._remove(stream)
+            stream.close()
+            self._statlog('expired')
+
+    def close(self):
+        for stream in list(self.parked):
+            self._remove(stream)
+            stream.close()
+
+
+if __name__ == '__main__':
+    import socket
+    from tornado import iostream
+
+    loop = ioloop.IOLoop.instance()
+    pool = ConnectionPool(max_idle=3, max_idle_per_host=2, idle_timeout=0.2, io_loop=loop)
+    peers = []
+
+    def connection():
+        mine, theirs = socket.socketpair()
+        peers.append(theirs)
+        stream = iostream.IOStream(mine, io_loop=loop)
+        stream.write('GET / HTTP/1.1\r\n\r\n')    # used, so the stream watches the socket
+        return stream
+
+    def run(seconds):
+        loop.add_timeout(time.time() + seconds, loop.stop)
+        loop.start()
+
+    a, b = ('http', 'a', 80), ('http', 'b', 80)
+    assert pool.checkout(a) is None
+    a1, a2, a3 = connection(), connection(), connection()
+    assert pool.checkin(a, a1) and pool.checkin(a, a2)
+    assert not pool.checkin(a, a3) and a3.closed()      # per-host limit
+    assert pool.checkout(a) is a2                        # most recently parked
+    assert pool.checkin(a, a2)
+    b1, b2 = connection(), connection()
+    assert pool.checkin(b, b1) and pool.checkin(b, b2)
+    assert a1.closed() and len(pool) == 3                # oldest over max_idle
+
+    peers[1].sendall('unsolicited')                      # to a2
+    peers[3].recv(1024)
+    peers[3].close()                                     # b1
+    run(0.05)
+    assert b1 not in pool.parked
+    assert pool.checkout(a) is None and a2.closed()
+    run(0.3)
+    assert len(pool) == 0 and b2.closed() and not pool.hosts
+    assert pool.stats == {'new': 2, 'reused': 1, 'parked': 5, 'host_limit': 1,
+                          'evicted': 1, 'stale': 1, 'closed_idle': 1, 'expired': 1}, pool.stats
+    assert pool.reuse_rate() == 1 / 3.0
+    print 'ok'
@@ -0,0 +1,368 @@
+"""
+Request fingerprints, the keys of cached responses.
+
+A fingerprint hashes the canonical url (see `canonicalize_url`), the
+method, the body, the query arguments and the request headers except
+IGNORED_HEADERS:
+
+    key = fingerprint(url, method, body, headers, arguments)
+
+Every header that differs splits a resource into several keys, though most
+(cookies, conditional and cache-control headers, language and encoding
+details) do not change the response. A `KeyPolicy` chooses what goes into
+the key instead: which headers, after which normalization, and which query
+parameters are dropped on which hosts:
+
+    policy = KeyPolicy(exclude_headers=('Cookie', 'User-Agent'),
+                       normalizers={'Accept-Language': primary_language},
+                       strip_params={'*': ('utm_*', 'gclid'),
+                                     '*.example.com': ('sid',)})
+    key = policy.fingerprint(url, method, body, headers, arguments)
+
+A response whose ``Vary`` names headers that the key does not contain
+verbatim is stored under `variant` keys, which add the values of those
+headers to the fingerprint, so that no request gets another's variant.
+
+`canonicalize_url` is the algorithm of Scrapy 0.x's
+``scrapy.utils.url.canonicalize_url``, so keys stay what they were when
+Scrapy computed them, without importing Scrapy and Twisted. Canonical urls
+are memoized by the raw url in an LRU of MEMO_BYTES, as browsers request
+the same urls over and over.
+
+Run this module to check results against those recorded with Scrapy
+0.18.4 and w3lib 1.2, and to compare them and the speed with Scrapy if it
+is installed.
+"""
+import cgi
+import fnmatch
+import hashlib
+import re
+import urllib
+import urlparse
+
+from lrucache import LRUCache
+
+IGNORED_HEADERS = ('Connection', 'User-Agent', 'Referer')
+MEMO_BYTES = 4 * 1024 * 1024
+
+# w3lib's safe_url_string of the Scrapy 0.x days.
+_SAFE_CHARS = urllib.always_safe + '%' + ';/?:@&=+$|,#' + "-_.!~*'()"
+
+_memo = LRUCache(MEMO_BYTES)
+
+
+def _unquote_path(path):
+    # Escaped slashes and question marks would change the url's structure.
+    for reserved in ('2f', '2F', '3f', '3F'):
+        path = path.replace('%' + reserved, '%25' + reserved.upper())
+    return urllib.unquote(path)
+
+
+def canonicalize_url(url, keep_blank_values=True, keep_fragments=False, encoding=None):
+    """Sorts the query arguments, normalizes percent-encoding in the path,
+    lowercases the host and drops the fragment, so that
+    ``http://www.example.com/query?id=111&cat=222`` and
+    ``http://www.example.com/query?cat=222&id=111`` have one canonical form.
+    """
+    if isinstance(url, unicode):
+        url = url.encode(encoding or 'utf-8')
+    scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
+    keyvals = cgi.parse_qsl(query, keep_blank_values)
+    keyvals.sort()
+    query = urllib.urlencode(keyvals)
+    path = urllib.quote(_unquote_path(path), _SAFE_CHARS) or '/'
+    fragment = fragment if keep_fragments else ''
+    return urlparse.urlunparse((scheme, netloc.lower(), path, params, query, fragment))
+
+
+def canonical_url(url):
+    """`canonicalize_url` with default arguments, memoized."""
+    canonical = _memo.get(url)
+    if canonical is None:
+        canonical = canonicalize_url(url)
+        _memo.set(url, canonical, len(url) + len(canonical) + 100)
+    return canonical
+
+
+def fingerprint(url, method, body, headers, arguments=None):
+    """SHA1 hex digest identifying the response to a request.
+
+    `headers` is a dict of request headers and `arguments` one of query
+    arguments (name -> list of values). Both are hashed in their iteration
+    order, which keeps the keys of the existing cache valid.
+    """
+    parts = [canonical_url(url), str(method), str(body)]
+    if arguments:
+        parts.extend('%s%s' % item for item in arguments.iteritems())
+    parts.extend('%s%s' % (name, value) for name, value in headers.iteritems()
+                 if name not in IGNORED_HEADERS)
+    return hashlib.sha1(''.join(parts)).hexdigest()
+
+
+def accept_encoding_bucket(value):
+    """Responses are stored decoded, only gzip support is worth telling apart."""
+    return 'gzip' if 'gzip' in value.lower() else 'identity'
+
+
+def primary_language(value):
+    """The primary subtag of the preferred language: 'en-US,en;q=0.5' -> 'en'."""
+    return value.split(',')[0].split(';')[0].split('-')[0].strip().lower()
+
+
+def _header_name(name):
+    return '-'.join(word.capitalize() for word in name.strip().split('-'))
+
+
+def _patterns(patterns):
+    return re.compile('|'.join(fnmatch.translate(p.lower()) for p in patterns))
+
+
+# Bodies are cached decoded, Vary: Accept-Encoding does not matter.
+_VARY_IGNORED = ('Accept-Encoding',)
+
+
+class KeyPolicy(object):
+    """What part of a request makes up its cache key.
+
+    Headers are hashed if they are in `include_headers` (every header when
+    None) and not in `exclude_headers`, after the function of `normalizers`
+    for their name, if any, and sorted by name. `strip_params` maps host
+    patterns to patterns of query parameters left out of the key.
+    """
+
+    def __init__(self, include_headers=None, exclude_headers=IGNORED_HEADERS,
+                 normalizers=None, strip_params=None):
+        self.include_headers = (frozenset(_header_name(n) for n in include_headers)
+                                if include_headers is not None else None)
+        self.exclude_headers = frozenset(_header_name(n) for n in exclude_headers)
+        self.normalizers = dict((_header_name(n), f) for n, f in (normalizers or {}).items())
+        self.strip_params = [(_patterns([host]), _patterns(params))
+                             for host, params in (strip_params or {}).items()]
+        self._host_patterns = {}
+        self._memo = LRUCache(MEMO_BYTES)
+
+    def hashes(self, name):
+        return ((self.include_headers is None or name in self.include_headers) and
+                name not in self.exclude_headers)
+
+    def _stripped_params(self, host):
+        """One pattern of the parameters stripped on `host`, or None."""
+        if host not in self._host_patterns:
+            if len(self._host_patterns) > 10000:
+                self._host_patterns.clear()
+            patterns = [params.pattern for host_pattern, params in self.strip_params
+                        if host_pattern.match(host)]
+            self._host_patterns[host] = re.compile('|'.join(patterns)) if patterns else None
+        return self._host_patterns[host]
+
+    def _strip(self, url, arguments):
+        stripped = self._memo.get(url)
+        if stripped is None:
+            stripped = self._strip_url(url)
+            self._memo.set(url, stripped, 2 * len(url) + 100)
+        url, names = stripped
+        if names and arguments:
+            arguments = dict((name, value) for name, value in arguments.iteritems()
+                             if name not in names)
+        return url, arguments
+
+    def _strip_url(self, url):
+        """`url` without the parameters stripped on its host, and their names."""
+        host = url.partition('://')[2].partition('/')[0].rpartition('@')[2].partition(':')[0]
+        pattern = self._stripped_params(host)
+        base, _, query = url.partition('?')
+        if pattern is None or not query:
+            return url, frozenset()
+        kept = []
+        names = set()
+        for pair in query.split('&'):
+            name = urllib.unquote_plus(pair.partition('=')[0])
+            if pattern.match(name.lower()):
+                names.add(name)
+            else:
+                kept.append(pair)
+        if not names:
+            return url, frozenset()
+        return (base + '?' + '&'.join(kept) if kept else base), frozenset(names)
+
+    def fingerprint(self, url, method, body, headers, arguments=None):
+        url = canonical_url(url)
+        if self.strip_params:
+            url, arguments = self._strip(url, arguments)
+        parts = [url, str(method), str(body)]
+        if arguments:
+            parts.extend('%s%s' % item for item in sorted(arguments.iteritems()))
+        for name, value in sorted(headers.iteritems()):
+            if self.hashes(name):
+                normalize = self.normalizers.get(name)
+                parts.append('%s%s' % (name, normalize(value) if normalize else value))
+        return hashlib.sha1(''.join(parts)).hexdigest()
+
+    def vary(self, value):
+        """The headers named by a Vary header `value` that a key of this
+        policy does not contain verbatim, or None for ``Vary: *``."""
+        names = set()
+        for name in (value or '').split(','):
+            name = _header_name(name)
+            if name == '*':
+                return None
+            if name and name not in _VARY_IGNORED and \
+                    (not self.hashes(name) or name in self.normalizers):
+                names.add(name)
+        return tuple(sorted(names))
+
+    def variant(self, key, names, headers):
+        """The key of the variant of `key` selected by `headers`."""
+        parts = [key]
+        for name in names:
+            value = headers.get(name, '')
+            normalize = self.normalizers.get(name)
+            parts.append('%s:%s\n' % (name, normalize(value) if normalize and value else value))
+        return hashlib.sha1(''.join(parts)).hexdigest()
+
+
+class _LegacyPolicy(KeyPolicy):
+    """The keys of earlier versions: `fingerprint`, unsorted and unnormalized."""
+
+    def fingerprint(self, url, method, body, headers, arguments=None):
+        return fingerprint(url, method, body, headers, arguments)
+
+
+LEGACY_POLICY = _LegacyPolicy()
+
+# Keys for browsing: cookies are kept, but not conditional and cache-control
+# headers, and neither tracking parameters.
+BROWSER_POLICY = KeyPolicy(
+    exclude_headers=IGNORED_HEADERS + ('If-Modified-Since', 'If-None-Match', 'If-Match',
+                                       'If-Unmodified-Since', 'If-Range', 'Cache-Control',
+                                       'Pragma', 'Dnt', 'Upgrade-Insecure-Requests',
+                                       'Proxy-Connection', 'Keep-Alive', 'Te'),
+    normalizers={'Accept-Encoding': accept_encoding_bucket,
+                 'Accept-Language': primary_language},
+    strip_params={'*': ('utm_*', 'gclid', 'fbclid', 'mc_cid', 'mc_eid',
+                        'phpsessid', 'jsessionid', 'sessionid')},
+)
+
+
+if __name__ == '__main__':
+    # Checks that urls canonicalize and requests fingerprint as with
+    # Scrapy, then times both.
+    import timeit
+    from tornado.httputil import HTTPHeaders
+
+    urls = [
+        'http://www.example.com/query?id=111&cat=222',
+        'http://www.example.com/query?cat=222&id=111',
+        'http://WWW.Example.COM/a%20b/c%2Fd?x=%20y&y=1&x=2#frag',
+        'http://www.example.com/do?a=1&a=&b',
+        'http://www.example.com/caf%C3%A9/%7Euser/;params?q=caf%E9',
+        u'http://www.example.com/unicode/\xe9t\xe9?q=\xe9',
+        'http://www.example.com/path with spaces/?q=a b&r=%2F',
+        'http://www.example.com:8080/a/../b/./c?',
+        'https://user:pw@www.example.com/%3F%3f%2f?#',
+        'http://www.example.com',
+        'http://www.example.com/static/js/app.min.js?v=1.2.3&_=1350000000000',
+    ]
+    headers = HTTPHeaders({'Host': 'www.example.com', 'User-Agent': 'Mozilla/5.0',
+                           'Accept': 'text/html,application/xhtml+xml,*/*;q=0.8',
+                           'Accept-Language': 'en-US,en;q=0.5',
+                           'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive',
+                           'Cookie': 'session=0123456789abcdef; theme=dark'})
+    arguments = {'id': ['111'], 'cat': ['222']}
+    # (canonical url, fingerprint) of each url above with `headers` and
+    # `arguments`, from Scrapy 0.18.4 and w3lib 1.2.
+    golden = [
+        ('http://www.example.com/query?cat=222&id=111',
+         '209671894e73d6b380978ebded5a3965a59a5eaa'),
+        ('http://www.example.com/query?cat=222&id=111',
+         '209671894e73d6b380978ebded5a3965a59a5eaa'),
+        ('http://www.example.com/a%20b/c%2Fd?x=+y&x=2&y=1',
+         'bcd33f253c7d9f3151f70b39284ffd2e2732936c'),
+        ('http://www.example.com/do?a=&a=1&b=',
+         '832801e54d27d0bf19cc4ca53218699f05f28b51'),
+        ('http://www.example.com/caf%C3%A9/~user/;params?q=caf%E9',
+         '78a120786f2da81da67ed7e17e827f168971a26c'),
+        ('http://www.example.com/unicode/%C3%A9t%C3%A9?q=%C3%A9',
+         '230de57b105f1f7c0f6246137649b412e8bc31b1'),
+        ('http://www.example.com/path%20with%20spaces/?q=a+b&r=%2F',
+         '4f215760e8bc2d7d2aebb0bd399d324d9f7b86e8'),
+        ('http://www.example.com:8080/a/../b/./c',
+         '5c8f53d7a0b5a9637288d7d646f6fe794b21a378'),
+        ('https://user:pw@www.example.com/%3F%3F%2F',
+         'da2658510c3accd4f2580bc02410ac886d4b90dc'),
+        ('http://www.example.com/',
+         '655f82dc19123fdefc433bccd74d2b51aeafdd8a'),
+        ('http://www.example.com/static/js/app.min.js?_=1350000000000&v=1.2.3',
+         '2592526d44dafb1a8264224e6bc20a40d7a06e58'),
+    ]
+    for url, (canonical, key) in zip(urls, golden):
+        assert canonicalize_url(url) == canonical, (url, canonicalize_url(url))
+        assert fingerprint(url, 'GET', None, headers, arguments) == key, url
+
+    try:
+        from scrapy.utils.url import canonicalize_url as scrapy_canonicalize_url
+    except ImportError:
+        scrapy_canonicalize_url = None
+        print 'Scrapy is not installed, checked the recorded results only'
+
+    def scrapy_fingerprint(url, method, body, headers, arguments=None):
+        # fingerprint_request as it was with Scrapy.
+        fp = hashlib.sha1()
+        fp.update(str(scrapy_canonicalize_url(url)))
+        fp.update(str(method))
+        fp.update(str(body))
+        if arguments:
+            for name, value in arguments.iteritems():
+                fp.update("%s%s" % (name, value))
+        for name, value in headers.iteritems():
+            if name in IGNORED_HEADERS:
+                continue
+            fp.update("%s%s" % (name, value))
+        return fp.hexdigest()
+
+    if scrapy_canonicalize_url is not None:
+        mismatches = 0
+        for url in urls:
+            ours, theirs = canonicalize_url(url), scrapy_canonicalize_url(url)
+            if ours != theirs:
+                mismatches += 1
+                print 'MISMATCH %r\n  ours   %r\n  scrapy %r' % (url, ours, theirs)
+            if fingerprint(url, 'GET', None, headers, arguments) != \
+                    scrapy_fingerprint(url, 'GET', None, headers, arguments):
+                mismatches += 1
+                print 'FINGERPRINT MISMATCH %r' % url
+        print '%d urls compared with Scrapy, %d mismatches' % (len(urls), mismatches)
+
+    # The legacy policy is `fingerprint`; a policy keys requests that only
+    # differ in excluded headers, header order or stripped parameters alike.
+    reordered = HTTPHeaders()
+    for name, value in reversed(list(headers.get_all())):
+        reordered.add(name, value)
+    reordered['If-None-Match'] = '"abc"'
+    reordered['Accept-Language'] = 'en-GB'
+    for url in urls:
+        assert LEGACY_POLICY.fingerprint(url, 'GET', None, headers, arguments) == \
+            fingerprint(url, 'GET', None, headers, arguments)
+        tracked = url + ('&' if '?' in url else '?') + 'utm_source=x&PHPSESSID=1'
+        assert BROWSER_POLICY.fingerprint(url, 'GET', None, headers) == \
+            BROWSER_POLICY.fingerprint(tracked, 'GET', None, reordered), url
+    names = BROWSER_POLICY.vary('accept-encoding, Accept-Language, user-agent')
+    assert names == ('Accept-Language', 'User-Agent'), names
+    assert BROWSER_POLICY.vary('*') is None
+
+    n = 20000
+    timings = [('canonicalize_url', lambda: [canonicalize_url(url) for url in urls]),
+               ('canonical_url (memoized)', lambda: [canonical_url(url) for url in urls]),
+               ('fingerprint', lambda: [fingerprint(url, 'GET', None, headers, arguments)
+                                        for url in urls]),
+               ('BROWSER_POLICY.fingerprint',
+                lambda: [BROWSER_POLICY.fingerprint(url, 'GET', None, headers, arguments)
+                         for url in urls])]
+    if scrapy_canonicalize_url is not None:
+        timings[:0] = [
+            ('scrapy canonicalize_url', lambda: [scrapy_canonicalize_url(url) for url in urls]),
+            ('scrapy fingerprint', lambda: [scrapy_fingerprint(url, 'GET', None, headers, arguments)
+                                            for url in urls])]
+    for label, f in timings:
+        best = min(timeit.repeat(f, number=n // len(urls), repeat=3))
+        print '%-28s %8.2fus per url' % (label, best / (n // len(urls) * len(urls)) * 1e6)
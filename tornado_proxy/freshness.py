@@ -0,0 +1,451 @@
+"""
+Freshness of cached responses and their revalidation.
+
+A cached entry (see proxy.response_entry) records when it was stored, and
+its headers tell for how long it is fresh (RFC 7234): ``s-maxage``,
+``max-age``, ``Expires``, or, without any of them, a tenth of the time
+since ``Last-Modified``. `state` puts an entry in one of four states:
+
+    FRESH    served as it is
+    REFRESH  still fresh, but served and refreshed in the background now,
+             with a probability that rises as expiry comes closer
+    STALE    expired less than its stale-while-revalidate window ago,
+             served and refreshed in the background
+    EXPIRED  not served, fetched again
+
+The early refresh is "XFetch" (Vattani et al., Optimal Probabilistic Cache
+Stampede Prevention): an entry whose fetch took `delta` seconds is
+refreshed once ``age - delta * beta * log(random()) >= lifetime``. A hot
+key is thereby refreshed by one of its readers shortly before it expires
+rather than by all of them at once right after.
+
+A `Revalidator` sends the background requests. They are conditional when
+the entry has validators (``If-None-Match`` from ``ETag``,
+``If-Modified-Since`` from ``Last-Modified``); a 304 answer only updates the
+headers and the stored time of the entry:
+
+    revalidator = Revalidator()
+    if revalidator.serve(key, request, entry, callback):
+        ...  # answer with entry, which may be being revalidated now
+    # callback(response, entry): entry is the updated entry on a 304, None
+    # otherwise, and it is up to the callback to store a new response
+
+Only GETs are revalidated; other requests are answered from entries that
+are fresh (or due for an early refresh) and fetched again otherwise. A key
+is revalidated by at most one request of the process at a time. A new body
+is kept up to `max_body_size` bytes, and within the memory `budget` (see
+membudget) if given; the callback gets a response whose body is None for
+one that was not.
+
+A `StoragePolicy` decides which responses are written to memcached at all
+and for how long: responses a shared cache must not keep (``no-store``,
+``private``, ``Set-Cookie``, answers to authorized requests) are skipped,
+the others are kept for their lifetime plus their stale window, clamped to
+``[min_ttl, max_ttl]``. Error responses with a status in `negative_codes`
+are kept `negative_ttl` seconds only. It counts the writes it skipped by
+reason.
+"""
+import email.utils
+import fnmatch
+import logging
+import math
+import random
+import time
+import urlparse
+
+import tornado.httpclient
+from tornado.httputil import HTTPHeaders
+from cStringIO import StringIO
+
+# Lifetime of responses without explicit freshness or Last-Modified.
+DEFAULT_LIFETIME = 5 * 60
+HEURISTIC_FRACTION = 0.1
+MAX_HEURISTIC_LIFETIME = 24 * 3600
+# How long expired responses are served while being revalidated, unless
+# they say otherwise with stale-while-revalidate (or must-revalidate).
+STALE_WHILE_REVALIDATE = 24 * 3600
+# Eagerness of the early refresh, 0 disables it.
+EARLY_REFRESH_BETA = 1.0
+# Hosts whose responses are fresh for a fixed number of seconds, whatever
+# their headers say, as {pattern: seconds} with fnmatch patterns ('*.cdn.net');
+# 0 keeps them out of the cache. Use a list of pairs if patterns overlap,
+# the first match wins.
+HOST_LIFETIMES = {}
+# memcached reads expiration times above 30 days as timestamps.
+_MEMCACHED_MAX_TTL = 30 * 24 * 3600
+
+FRESH, REFRESH, STALE, EXPIRED = 'fresh', 'refresh', 'stale', 'expired'
+
+# Headers of a 304 that must not replace the stored ones (RFC 7232 4.1).
+_KEPT_ON_304 = frozenset(['content-length', 'content-encoding', 'transfer-encoding',
+                          'content-range', 'connection', 'keep-alive'])
+# Request headers about the client's own copy, see unconditional.
+CLIENT_CONDITIONS = frozenset(['if-none-match', 'if-modified-since', 'if-match',
+                               'if-unmodified-since', 'if-range', 'range'])
+
+
+def parse_cache_control(value):
+    """Directives of a Cache-Control header as a dict, True for those without a value."""
+    directives = {}
+    for part in (value or '').split(','):
+        name, sep, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip().strip('"') if sep else True
+    return directives
+
+
+def parse_http_date(value):
+    """Seconds since the epoch of an HTTP date, or None if it does not parse."""
+    parsed = email.utils.parsedate_tz(value or '')
+    if parsed is None:
+        return None
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _header_dict(headers):
+    return dict((name.lower(), value) for name, value in headers)
+
+
+def host_lifetime(url):
+    """The lifetime HOST_LIFETIMES sets for responses from `url`, or None."""
+    if not HOST_LIFETIMES or not url:
+        return None
+    host = (urlparse.urlsplit(url).hostname or '').lower()
+    items = HOST_LIFETIMES.items() if isinstance(HOST_LIFETIMES, dict) else HOST_LIFETIMES
+    for pattern, seconds in items:
+        if fnmatch.fnmatchcase(host, pattern.lower()):
+            return seconds
+    return None
+
+
+def lifetime(headers, url=None):
+    """How many seconds a response from `url` with `headers` (name, value
+    pairs) is fresh."""
+    fixed = host_lifetime(url)
+    if fixed is not None:
+        return fixed
+    headers = _header_dict(headers)
+    cache_control = parse_cache_control(headers.get('cache-control'))
+    if 'no-cache' in cache_control:
+        return 0
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cache_control:
+            return _seconds(cache_control[directive])
+    date = parse_http_date(headers.get('date'))
+    if 'expires' in headers:
+        expires = parse_http_date(headers['expires'])
+        # An invalid Expires, like "0", means already expired.
+        if expires is None or date is None:
+            return 0
+        return max(0, expires - date)
+    last_modified = parse_http_date(headers.get('last-modified'))
+    if last_modified is not None and date is not None:
+        return min(MAX_HEURISTIC_LIFETIME,
+                   int(max(0, date - last_modified) * HEURISTIC_FRACTION))
+    return DEFAULT_LIFETIME
+
+
+def stale_window(headers):
+    """How many seconds after expiry a response with `headers` may be served."""
+    cache_control = parse_cache_control(_header_dict(headers).get('cache-control'))
+    if 'must-revalidate' in cache_control or 'proxy-revalidate' in cache_control \
+            or 'no-cache' in cache_control:
+        return 0
+    if 'stale-while-revalidate' in cache_control:
+        return _seconds(cache_control['stale-while-revalidate'])
+    return STALE_WHILE_REVALIDATE
+
+
+def state(entry, now=None, beta=None):
+    """FRESH, REFRESH, STALE or EXPIRED, see the module documentation."""
+    if now is None:
+        now = time.time()
+    if beta is None:
+        beta = EARLY_REFRESH_BETA
+    age = now - entry.get('stored_at', 0)
+    fresh_for = lifetime(entry['headers'], entry.get('effective_url'))
+    if age < fresh_for:
+        delta = entry.get('request_time') or 0
+        # 1 - random() is in (0, 1], which log accepts.
+        if beta and delta and \
+                age - delta * beta * math.log(1 - random.random()) >= fresh_for:
+            return REFRESH
+        return FRESH
+    if age < fresh_for + stale_window(entry['headers']):
+        return STALE
+    return EXPIRED
+
+
+def conditional_headers(entry):
+    """The validator request headers for `entry`, empty if it has none."""
+    headers = _header_dict(entry['headers'])
+    conditions = {}
+    if 'etag' in headers:
+        conditions['If-None-Match'] = headers['etag']
+    if 'last-modified' in headers:
+        conditions['If-Modified-Since'] = headers['last-modified']
+    return conditions
+
+
+def unconditional(headers):
+    """Copy of the request `headers` without the conditions and the range
+    of the client's own copy, to fetch the whole response for the cache."""
+    kept = HTTPHeaders()
+    for name, value in headers.get_all():
+        if name.lower() not in CLIENT_CONDITIONS:
+            kept.add(name, value)
+    return kept
+
+
+def not_modified(entry, headers, now=None):
+    """Copy of `entry` updated with the headers of a 304 answering its revalidation."""
+    updated = {}
+    for name, value in headers.get_all():
+        if name.lower() not in _KEPT_ON_304:
+            updated.setdefault(name.lower(), []).append((name, value))
+    merged = []
+    for name, value in entry['headers']:
+        lower = name.lower()
+        if lower not in updated:
+            merged.append((name, value))
+        elif updated[lower]:
+            # All stored values of a header the 304 sends are replaced.
+            merged.extend(updated[lower])
+            updated[lower] = None
+    for values in updated.itervalues():
+        merged.extend(values or ())
+    return dict(entry, headers=merged, stored_at=time.time() if now is None else now)
+
+
+class Revalidator(object):
+    def __init__(self, max_clients=5000, max_body_size=None, budget=None):
+        self.max_clients = max_clients
+        self.max_body_size = max_body_size
+        self.budget = budget
+        self.inflight = set()
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def serve(self, key, request, entry, callback):
+        """Whether `entry` may answer `request`; starts its revalidation if due."""
+        current = state(entry)
+        self._statlog(current)
+        if current == FRESH:
+            return True
+        if request.method != 'GET':
+            return current == REFRESH
+        if current == EXPIRED:
+            return False
+        self.revalidate(key, request, entry, callback)
+        return True
+
+    def revalidate(self, key, request, entry, callback):
+        """Fetches `request` again, conditionally on the validators of
+        `entry`, unless `key` is being revalidated already.
+
+        Calls `callback(response, updated)` with the updated entry on a 304
+        and None otherwise.
+        """
+        if key in self.inflight:
+            self._statlog('coalesced')
+            return
+        self.inflight.add(key)
+        self._statlog('started')
+        # The client's own conditions were about its copy, not ours.
+        headers = unconditional(request.headers)
+        conditions = conditional_headers(entry)
+        headers.update(conditions)
+        self._statlog('conditional' if conditions else 'unconditional')
+        started = time.time()
+        body = {'chunks': [], 'size': 0}
+
+        def on_chunk(chunk):
+            if body['chunks'] is None:
+                return
+            body['size'] += len(chunk)
+            if self.max_body_size is not None and body['size'] > self.max_body_size or \
+                    self.budget is not None and not self.budget.reserve(len(chunk)):
+                drop_chunks()
+            else:
+                body['chunks'].append(chunk)
+
+        def drop_chunks():
+            if self.budget is not None and body['chunks']:
+                self.budget.release(sum(len(chunk) for chunk in body['chunks']))
+            body['chunks'] = None
+
+        def done(response):
+            self.inflight.discard(key)
+            self._statlog('seconds', time.time() - started)
+            chunks = body['chunks']
+            drop_chunks()
+            if chunks is None:
+                self._statlog('too_large')
+            response = tornado.httpclient.HTTPResponse(
+                request=response.request, code=response.code, headers=response.headers,
+                buffer=StringIO(''.join(chunks)) if chunks is not None else None,
+                effective_url=response.effective_url, error=response.error,
+                request_time=response.request_time, time_info=response.time_info)
+            updated = None
+            if response.code == 304 and conditions:
+                self._statlog('not_modified')
+                updated = not_modified(entry, response.headers)
+            elif response.code == 599:
+                self._statlog('failed')
+                logging.warning('Revalidating %s failed: %s' % (request.url, response.error))
+            else:
+                self._statlog('modified')
+            callback(response, updated)
+
+        revalidation = tornado.httpclient.HTTPRequest(
+            url=request.url, method='GET', headers=headers, follow_redirects=False,
+            connect_timeout=request.connect_timeout, request_timeout=request.request_timeout,
+            ca_certs=request.ca_certs, streaming_callback=on_chunk)
+        tornado.httpclient.AsyncHTTPClient(max_clients=self.max_clients).fetch(
+            revalidation, done)
+
+    def report(self):
+        return dict(self.stats, inflight=len(self.inflight))
+
+
+class StoragePolicy(object):
+    def __init__(self, min_ttl=60, max_ttl=7 * 24 * 3600, store_set_cookie=False,
+                 negative_ttl=10, negative_codes=(500, 502, 503, 504)):
+        self.min_ttl = min_ttl
+        self.max_ttl = min(max_ttl, _MEMCACHED_MAX_TTL)
+        self.store_set_cookie = store_set_cookie
+        self.negative_ttl = negative_ttl
+        self.negative_codes = negative_codes
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def skip(self, reason):
+        """Counts a response that is not stored because of `reason`."""
+        self._statlog('skipped')
+        self._statlog('skipped_' + reason)
+
+    def ttl(self, request_headers, entry):
+        """Seconds to keep `entry`, fetched with `request_headers`, in
+        memcached; None (counted as skipped) if it must not be kept."""
+        reason = self._uncacheable(request_headers, entry)
+        if reason is None and entry['code'] in self.negative_codes:
+            if not self.negative_ttl:
+                self.skip('status')
+                return None
+            self._statlog('stored')
+            self._statlog('stored_negative')
+            return self.negative_ttl
+        if reason is None:
+            url = entry['effective_url']
+            ttl = lifetime(entry['headers'], url) + stale_window(entry['headers'])
+            if host_lifetime(url) == 0:
+                reason = 'host'
+            elif ttl <= 0:
+                reason = 'expired'
+        if reason is not None:
+            self.skip(reason)
+            return None
+        self._statlog('stored')
+        return max(self.min_ttl, min(self.max_ttl, int(ttl)))
+
+    def _uncacheable(self, request_headers, entry):
+        headers = _header_dict(entry['headers'])
+        cache_control = parse_cache_control(headers.get('cache-control'))
+        if 'no-store' in cache_control or \
+                'no-store' in parse_cache_control(request_headers.get('Cache-Control')):
+            return 'no_store'
+        if 'private' in cache_control:
+            return 'private'
+        if 'set-cookie' in headers and not self.store_set_cookie:
+            return 'set_cookie'
+        if 'Authorization' in request_headers and not (
+                'public' in cache_control or 's-maxage' in cache_control or
+                'must-revalidate' in cache_control):
+            return 'authorization'
+        return None
+
+    def report(self):
+        written = self.stats.get('stored', 0) + self.stats.get('skipped', 0)
+        return dict(self.stats, skipped_ratio=round(
+            self.stats.get('skipped', 0) / float(written), 3) if written else 0)
+
+
+if __name__ == '__main__':
+    date = 'Sat, 17 Oct 2026 12:00:00 GMT'
+    stored = parse_http_date(date)
+
+    def entry(*headers, **kwargs):
+        return dict({'headers': [('Date', date)] + list(headers), 'stored_at': stored,
+                     'code': 200, 'request_time': 0}, **kwargs)
+
+    assert lifetime(entry(('Cache-Control', 'public, max-age=60'))['headers']) == 60
+    assert lifetime(entry(('Cache-Control', 's-maxage=10, max-age=60'))['headers']) == 10
+    assert lifetime(entry(('Expires', 'Sat, 17 Oct 2026 13:00:00 GMT'))['headers']) == 3600
+    assert lifetime(entry(('Expires', '0'))['headers']) == 0
+    assert lifetime(entry(('Last-Modified', 'Sat, 07 Oct 2026 12:00:00 GMT'))['headers']) \
+        == 24 * 3600
+    assert lifetime(entry()['headers']) == DEFAULT_LIFETIME
+
+    cached = entry(('Cache-Control', 'max-age=60, stale-while-revalidate=30'),
+                   ('ETag', '"v1"'))
+    assert state(cached, stored + 10) == FRESH
+    assert state(cached, stored + 70) == STALE
+    assert state(cached, stored + 95) == EXPIRED
+    assert state(entry(('Cache-Control', 'max-age=60, must-revalidate')), stored + 70) \
+        == EXPIRED
+    # Entries written before freshness was recorded are stale.
+    assert state({'headers': [], 'request_time': 0}, stored) == EXPIRED
+
+    # The early refresh hits a growing share of the reads as expiry nears.
+    slow = dict(cached, request_time=2.0)
+    for age, low, high in ((10, 0, 0.01), (55, 0.05, 0.15), (59.5, 0.7, 0.9)):
+        share = sum(state(slow, stored + age) == REFRESH for i in xrange(10000)) / 10000.0
+        assert low <= share <= high, (age, share)
+
+    assert conditional_headers(cached) == {'If-None-Match': '"v1"'}
+    client = HTTPHeaders({'Range': 'bytes=0-9', 'If-Range': '"v1"', 'If-None-Match': '"v1"',
+                          'If-Modified-Since': date, 'Accept': '*/*'})
+    assert unconditional(client).items() == [('Accept', '*/*')]
+    refreshed = not_modified(cached, HTTPHeaders({'ETag': '"v1"', 'Content-Length': '0',
+                                                  'Cache-Control': 'max-age=120'}),
+                             stored + 70)
+    assert ('Cache-Control', 'max-age=120') in refreshed['headers']
+    assert not any(name == 'Content-Length' for name, value in refreshed['headers'])
+    assert state(refreshed, stored + 100) == FRESH
+
+    policy = StoragePolicy(min_ttl=60, max_ttl=3600)
+    url = 'http://www.example.com/'
+    ttl = lambda *headers, **kwargs: policy.ttl(
+        HTTPHeaders(kwargs.get('request', {})), entry(*headers, effective_url=url))
+    assert ttl(('Cache-Control', 'max-age=100, stale-while-revalidate=20')) == 120
+    assert ttl(('Cache-Control', 'max-age=10, must-revalidate')) == 60
+    assert ttl(('Cache-Control', 'max-age=86400')) == 3600
+    assert ttl(('Cache-Control', 'no-store')) is None
+    assert ttl(('Cache-Control', 'private, max-age=60')) is None
+    assert ttl(('Set-Cookie', 'id=1')) is None
+    assert ttl(('Cache-Control', 'max-age=60'), request={'Authorization': 'Basic eA=='}) is None
+    assert ttl(('Cache-Control', 'public, max-age=60'),
+               request={'Authorization': 'Basic eA=='}) == 3600
+    assert ttl(('Expires', '0'), ('Cache-Control', 'must-revalidate')) is None
+    HOST_LIFETIMES = [('*.example.com', 0), ('*', 600)]
+    assert ttl(('Cache-Control', 'max-age=60')) is None
+    url = 'http://example.org/'
+    assert ttl(('Cache-Control', 'no-cache')) == 600 + 0
+    assert policy.report()['skipped_private'] == 1
+    assert policy.report()['skipped'] == 6
+    assert policy.ttl(HTTPHeaders(), dict(entry(), code=502, effective_url=url)) == 10
+    print 'ok'
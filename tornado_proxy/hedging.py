@@ -0,0 +1,265 @@
+"""
+Hedged upstream requests.
+
+Most requests to an origin answer quickly, a few wait seconds on a stuck
+connect or a slow backend. A `HedgedFetch` that has no response headers
+after the `quantile` of its origin's recent time to headers sends the
+request a second time on another connection, uses whichever attempt
+answers first and cancels the other:
+
+    hedging = HedgePolicy(latencies, quantile=0.95, ratio=0.05, burst=10)
+    HedgedFetch(hedging, client, request, callback, host).start()
+
+`client` must have ``fetch_connection`` and ``can_send`` (see
+warc_httpclient), since only requests sent at once can be cancelled. The
+``header_callback`` and ``streaming_callback`` of `request` only see the
+winning attempt, and an attempt failing without a response (599) does
+not win while the other may still answer. The delay is kept between
+`min_delay` and `max_delay`, the latter being used until the origin has
+enough samples in `latencies` (a latency.LatencyTracker).
+
+Hedges are budgeted per origin: each request earns it `ratio` of a hedge,
+up to `burst`, so hedging adds at most about `ratio` to the requests an
+origin gets even when it is slow for everybody.
+
+`report` has the counts of requests, hedges, hedges that won and hedges
+refused for lack of budget, and the hedge and win rates.
+"""
+import collections
+import copy
+import functools
+import time
+
+
+class HedgePolicy(object):
+    def __init__(self, latencies, quantile=0.95, min_delay=0.05, max_delay=1.0,
+                 ratio=0.05, burst=10, max_hosts=10000):
+        self.latencies = latencies
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.ratio = ratio
+        self.burst = burst
+        self.max_hosts = max_hosts
+        self.tokens = collections.OrderedDict()  # host -> hedges available
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def delay(self, host):
+        """Seconds to wait for the response headers before hedging."""
+        q = self.latencies.quantile(host, self.quantile)
+        if q is None:
+            return self.max_delay
+        return min(self.max_delay, max(self.min_delay, q))
+
+    def requested(self, host):
+        self._statlog('requests')
+        tokens = self.tokens.pop(host, None)
+        if tokens is None:
+            # A new origin may be hedged once right away.
+            tokens = 1
+            if len(self.tokens) >= self.max_hosts:
+                self.tokens.popitem(last=False)
+        self.tokens[host] = min(self.burst, tokens + self.ratio)
+
+    def allow(self, host):
+        """Whether `host` can take a hedge now; takes it from its budget."""
+        tokens = self.tokens.get(host, 0)
+        if tokens < 1:
+            self._statlog('budget_exhausted')
+            return False
+        self.tokens[host] = tokens - 1
+        self._statlog('hedged')
+        return True
+
+    def report(self):
+        requests = self.stats.get('requests', 0)
+        hedged = self.stats.get('hedged', 0)
+        return dict(self.stats,
+                    hedge_rate=round(hedged / float(requests), 3) if requests else 0,
+                    win_rate=round(self.stats.get('hedge_wins', 0) / float(hedged), 3)
+                    if hedged else 0)
+
+
+class _Attempt(object):
+    __slots__ = ('connection', 'started', 'done')
+
+    def __init__(self):
+        self.connection = None
+        self.started = time.time()
+        self.done = False
+
+
+class HedgedFetch(object):
+    def __init__(self, policy, client, request, callback, host):
+        self.policy = policy
+        self.client = client
+        self.request = request
+        self.callback = callback
+        self.host = host
+        self.attempts = []
+        self.winner = None
+        self._timeout = None
+
+    def start(self):
+        self.policy.requested(self.host)
+        attempt = self._send()
+        if attempt.connection is not None and not attempt.done:
+            self._timeout = self.client.io_loop.add_timeout(
+                attempt.started + self.policy.delay(self.host), self._hedge)
+
+    def _send(self):
+        attempt = _Attempt()
+        self.attempts.append(attempt)
+        request = copy.copy(self.request)
+        if request.header_callback is not None:
+            request.header_callback = functools.partial(self._on_header, attempt)
+        if request.streaming_callback is not None:
+            request.streaming_callback = functools.partial(self._on_chunk, attempt)
+        connection = self.client.fetch_connection(
+            request, functools.partial(self._on_response, attempt))
+        if not attempt.done:
+            attempt.connection = connection
+        return attempt
+
+    def _hedge(self):
+        self._timeout = None
+        if self.winner is None and self.client.can_send(self.request) and \
+                self.policy.allow(self.host):
+            self._send()
+
+    def _on_header(self, attempt, line):
+        if self.winner is None:
+            self._win(attempt)
+        if attempt is self.winner:
+            self.request.header_callback(line)
+
+    def _on_chunk(self, attempt, chunk):
+        if attempt is self.winner:
+            self.request.streaming_callback(chunk)
+
+    def _on_response(self, attempt, response):
+        attempt.done = True
+        if self.winner is None:
+            if response.code == 599 and not all(other.done for other in self.attempts):
+                return
+            self._win(attempt, answered=response.code != 599)
+        if attempt is self.winner:
+            self.callback(response)
+
+    def _win(self, attempt, answered=True):
+        self.winner = attempt
+        if self._timeout is not None:
+            self.client.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        now = time.time()
+        if answered:
+            self.policy.latencies.record(self.host, now - attempt.started)
+        if attempt is not self.attempts[0]:
+            self.policy._statlog('hedge_wins')
+        for other in self.attempts:
+            if other is not attempt and not other.done:
+                # All we know is that it takes longer than this.
+                self.policy.latencies.record(self.host, now - other.started)
+                other.done = True
+                if other.connection is not None:
+                    other.connection.cancel()
+                    self.policy._statlog('cancelled')
+
+
+if __name__ == '__main__':
+    from tornado import ioloop
+    from tornado.httpclient import HTTPRequest, HTTPResponse
+
+    from latency import LatencyTracker
+
+    # Each request earns `ratio` of a hedge; a new origin starts with one.
+    policy = HedgePolicy(LatencyTracker(), ratio=0.5, burst=2)
+    policy.requested('a')
+    assert policy.allow('a') and not policy.allow('a')
+    policy.requested('a')
+    assert policy.allow('a')
+    for i in range(10):
+        policy.requested('a')
+    assert policy.tokens['a'] == 2                      # capped at burst
+    assert policy.stats == {'requests': 12, 'hedged': 2, 'budget_exhausted': 1}, policy.stats
+
+    class Connection(object):
+        def __init__(self, request, callback):
+            self.request = request
+            self.callback = callback
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    class Client(object):
+        def __init__(self, io_loop):
+            self.io_loop = io_loop
+            self.connections = []
+
+        def can_send(self, request):
+            return True
+
+        def fetch_connection(self, request, callback):
+            self.connections.append(Connection(request, callback))
+            return self.connections[-1]
+
+    loop = ioloop.IOLoop.instance()
+    client = Client(loop)
+    policy = HedgePolicy(LatencyTracker(), max_delay=0.05, ratio=0.5, burst=2)
+    lines, responses = [], []
+
+    def fetch():
+        request = HTTPRequest('http://a/', header_callback=lines.append)
+        HedgedFetch(policy, client, request, responses.append, 'a').start()
+        return request
+
+    def run(seconds):
+        loop.add_timeout(time.time() + seconds, loop.stop)
+        loop.start()
+
+    def answer(connection, code):
+        if code != 599:
+            connection.request.header_callback('HTTP/1.1 %d OK\r\n' % code)
+        connection.callback(HTTPResponse(connection.request, code))
+
+    # The hedge answers first: it wins and the first attempt is cancelled.
+    fetch()
+    run(0.1)
+    first, hedge = client.connections
+    answer(hedge, 200)
+    assert first.cancelled and not hedge.cancelled
+    assert lines == ['HTTP/1.1 200 OK\r\n'] and [r.code for r in responses] == [200]
+    answer(first, 201)                                  # too late, not passed on
+    assert len(lines) == 1 and len(responses) == 1
+
+    # A failed attempt does not win while the other may still answer.
+    del client.connections[:], lines[:], responses[:]
+    fetch()
+    run(0.1)
+    first, hedge = client.connections
+    answer(first, 599)
+    assert not responses and not hedge.cancelled
+    answer(hedge, 200)
+    assert [r.code for r in responses] == [200]
+
+    # Both hedges were spent: the next slow request is not hedged.
+    del client.connections[:], responses[:]
+    fetch()
+    run(0.1)
+    assert len(client.connections) == 1
+    answer(client.connections[0], 200)
+
+    # Answered before the delay: no hedge.
+    del client.connections[:], responses[:]
+    fetch()
+    answer(client.connections[0], 200)
+    run(0.1)
+    assert len(client.connections) == 1 and [r.code for r in responses] == [200]
+    report = policy.report()
+    assert (report['requests'], report['hedged'], report['hedge_wins'], report['cancelled'],
+            report['budget_exhausted']) == (4, 2, 2, 1, 1), report
+    print 'ok'
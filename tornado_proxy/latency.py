@@ -0,0 +1,84 @@
+"""
+Recent upstream latencies per origin.
+
+    latencies = LatencyTracker(samples=200, min_samples=20)
+    latencies.record(host, seconds)
+    latencies.quantile(host, 0.95)    # None until min_samples were recorded
+
+Each origin keeps its last `samples` measurements, as single precision
+floats in a ring; only the `max_hosts` origins recorded most recently are
+tracked.
+"""
+import array
+import collections
+
+
+class _Window(object):
+    __slots__ = ('values', 'size', 'next')
+
+    def __init__(self, size):
+        self.values = array.array('f')
+        self.size = size
+        self.next = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, seconds):
+        if len(self.values) < self.size:
+            self.values.append(seconds)
+        else:
+            self.values[self.next] = seconds
+            self.next = (self.next + 1) % self.size
+
+
+class LatencyTracker(object):
+    def __init__(self, samples=200, min_samples=20, max_hosts=10000):
+        self.samples = samples
+        self.min_samples = min_samples
+        self.max_hosts = max_hosts
+        self.hosts = collections.OrderedDict()  # host -> _Window, oldest host first
+
+    def record(self, host, seconds):
+        window = self.hosts.pop(host, None)
+        if window is None:
+            window = _Window(self.samples)
+            if len(self.hosts) >= self.max_hosts:
+                self.hosts.popitem(last=False)
+        window.append(seconds)
+        self.hosts[host] = window
+
+    def quantile(self, host, q):
+        window = self.hosts.get(host)
+        if window is None or len(window) < self.min_samples:
+            return None
+        ordered = sorted(window.values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def report(self, max_hosts=100):
+        hosts = {}
+        for host in reversed(self.hosts):
+            if len(hosts) >= max_hosts:
+                break
+            window = self.hosts[host]
+            ordered = sorted(window.values)
+            hosts[host] = {'samples': len(window),
+                           'p50': round(ordered[len(ordered) // 2], 3),
+                           'p95': round(ordered[min(len(ordered) - 1,
+                                                    int(0.95 * len(ordered)))], 3)}
+        return {'tracked': len(self.hosts), 'hosts': hosts}
+
+
+if __name__ == '__main__':
+    latencies = LatencyTracker(samples=100, min_samples=10, max_hosts=2)
+    for i in range(5):
+        latencies.record('a', 0.1)
+    assert latencies.quantile('a', 0.95) is None
+    for i in range(1, 101):
+        latencies.record('a', i / 100.0)
+    assert round(latencies.quantile('a', 0.95), 3) == 0.96
+    assert round(latencies.quantile('a', 0.5), 3) == 0.51
+    latencies.record('b', 1)
+    latencies.record('c', 1)
+    assert 'a' not in latencies.hosts and latencies.report()['tracked'] == 2
+    print 'ok'
@@ -0,0 +1,166 @@
+"""
+Byte-budgeted LRU cache with per-entry TTL.
+
+Used as an in-process L1 in front of memcached, holding responses for hot
+fingerprints so a hit costs neither a network round-trip nor a decode.
+
+    cache = LRUCache(max_bytes=64 * 1024 * 1024, ttl=300)
+    cache.set(key, value, size=len(body))
+    value = cache.get(key)          # None on miss or expiry
+
+The contents can be written to disk with `save` and read back with `load`,
+so a restarted process starts warm.
+"""
+import collections
+import logging
+import os
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class LRUCache(object):
+    def __init__(self, max_bytes, ttl=None, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self.entries = collections.OrderedDict()  # key -> (value, size, expires)
+        self.bytes = 0
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, touch=False) is not None
+
+    def get(self, key, touch=True):
+        entry = self.entries.get(key)
+        if entry is None:
+            if touch:
+                self._statlog('misses')
+            return None
+        value, size, expires = entry
+        if expires and expires <= time.time():
+            self._remove(key)
+            self._statlog('expirations')
+            if touch:
+                self._statlog('misses')
+            return None
+        if touch:
+            # Re-insert to move the key to the most recently used end.
+            del self.entries[key]
+            self.entries[key] = entry
+            self._statlog('hits')
+        return value
+
+    def set(self, key, value, size, ttl=None):
+        """Stores `value`, accounted as `size` bytes, for `ttl` seconds.
+
+        Returns False if the entry is too large to be cached.
+        """
+        if key in self.entries:
+            self._remove(key)
+        if size > self.max_entry_bytes:
+            self._statlog('rejected')
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else 0
+        self.entries[key] = (value, size, expires)
+        self.bytes += size
+        self._statlog('sets')
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self._statlog('evictions')
+        return True
+
+    def delete(self, key):
+        if key in self.entries:
+            self._remove(key)
+
+    def _remove(self, key):
+        value, size, expires = self.entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def save(self, path):
+        """Writes the unexpired entries, least recently used first, to `path`."""
+        now = time.time()
+        items = [(key, value, size, expires)
+                 for key, (value, size, expires) in self.entries.iteritems()
+                 if not expires or expires > now]
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(items, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        logging.info('Saved %d cache entries to %s' % (len(items), path))
+
+    def load(self, path):
+        """Restores entries written by `save`, skipping those that expired since."""
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, 'rb') as f:
+                items = pickle.load(f)
+        except Exception:
+            logging.warning('Could not load cache snapshot %s' % path, exc_info=True)
+            return 0
+        now = time.time()
+        loaded = 0
+        for key, value, size, expires in items:
+            if expires and expires <= now:
+                continue
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expires)
+            self.bytes += size
+            loaded += 1
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+        logging.info('Loaded %d cache entries from %s' % (loaded, path))
+        return loaded
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    cache = LRUCache(max_bytes=100, max_entry_bytes=50)
+    assert cache.set('a', 'A', 40) and cache.set('b', 'B', 40)
+    assert cache.get('a') == 'A'            # b is now least recently used
+    assert cache.set('c', 'C', 40)
+    assert 'b' not in cache and cache.get('a') == 'A' and cache.get('c') == 'C'
+    assert cache.bytes == 80 and len(cache) == 2
+    assert not cache.set('d', 'D', 51)      # larger than an entry may be
+    assert cache.set('a', 'A2', 10)         # replaced, not counted twice
+    assert cache.bytes == 50 and cache.get('a') == 'A2'
+
+    cache.set('short', 'S', 10, ttl=0.05)
+    cache.set('long', 'L', 10, ttl=60)
+    time.sleep(0.1)
+    assert cache.get('short') is None and cache.get('long') == 'L'
+    assert cache.bytes == 60
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'cache')
+        cache.save(path)
+        restored = LRUCache(max_bytes=30)
+        assert restored.load(path) == 3
+        # Loaded least recently used first, so that is what goes over budget.
+        assert restored.entries.keys() == ['a', 'long'] and restored.bytes == 20, restored.entries
+    finally:
+        shutil.rmtree(directory)
+    assert cache.stats == {'sets': 6, 'hits': 5, 'misses': 1, 'evictions': 1,
+                           'rejected': 1, 'expirations': 1}, cache.stats
+    print 'ok'
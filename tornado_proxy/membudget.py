@@ -0,0 +1,202 @@
+"""
+Process-wide memory budget for response bodies in flight.
+
+Every miss holds some of its body in memory: what was written to the
+client but not sent yet, the chunks assembled for the cache and the
+spooled WARC payload. With thousands of downloads at once that adds up,
+so they share a `MemoryBudget`:
+
+    buffers = MemoryBudget(max_bytes=256 * 1024 * 1024, per_response=4 * 1024 * 1024)
+    if buffers.reserve(len(chunk), held):
+        ...                       # keep it in memory
+        buffers.release(len(chunk))
+    else:
+        ...                       # spill it to disk, or do not keep it
+
+`reserve` refuses once the process would hold more than `max_bytes`, or
+the response (already holding `held` bytes) more than `per_response`.
+
+A `SpillingWriter` writes a response body to the client within the
+budget: once the client is too far behind, further chunks go to a
+temporary file and are sent from there, `block_size` bytes at a time, as
+the client reads.
+
+`report` has the current and peak bytes held, the refused reservations
+and the responses and bytes spilled to disk.
+"""
+import os
+import tempfile
+
+
+class MemoryBudget(object):
+    def __init__(self, max_bytes=256 * 1024 * 1024, per_response=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.per_response = per_response
+        self.bytes = 0
+        self.peak = 0
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def reserve(self, n, held=0, force=False):
+        """Accounts for `n` more bytes of a response holding `held`; False,
+        and nothing accounted, if that exceeds the budget unless `force`."""
+        if not force and (held + n > self.per_response or self.bytes + n > self.max_bytes):
+            self._statlog('refused')
+            return False
+        self.bytes += n
+        if self.bytes > self.peak:
+            self.peak = self.bytes
+        return True
+
+    def release(self, n):
+        self.bytes -= n
+
+    def report(self):
+        return dict(self.stats, bytes=self.bytes, peak=self.peak, max_bytes=self.max_bytes)
+
+
+class SpillingWriter(object):
+    """
+    Writes a response body to the client of a ``RequestHandler``, through a
+    temporary file while the client is behind by more than the budget
+    allows. Call `finish` instead of ``handler.finish()``, it waits for the
+    body to be sent, so that it is accounted for until then, and `close`
+    once the handler is done.
+    """
+
+    def __init__(self, handler, budget, block_size=256 * 1024):
+        self.handler = handler
+        self.budget = budget
+        self.block_size = block_size
+        self.held = 0  # written to the client, not sent yet
+        self.spill = None
+        self._spill_read = self._spill_size = 0
+        self._finishing = False
+        self._closed = False
+
+    def write(self, data):
+        if self._closed or not data:
+            return
+        if self.spill is None:
+            if self.budget.reserve(len(data), self.held):
+                self._send(data)
+                return
+            if not self.held:
+                # The client is not behind at all, so a block goes out now
+                # whatever the budget; only the rest has to wait on disk.
+                head, data = data[:self.block_size], data[self.block_size:]
+                self.budget.reserve(len(head), force=True)
+                self._send(head)
+                if not data:
+                    return
+            self.budget._statlog('spilled')
+            self.spill = tempfile.TemporaryFile()
+        self.spill.seek(0, os.SEEK_END)
+        self.spill.write(data)
+        self._spill_size += len(data)
+        self.budget._statlog('spilled_bytes', len(data))
+
+    def _send(self, data):
+        self.held += len(data)
+        self.handler.write(data)
+        try:
+            self.handler.flush(callback=self._drained)
+        except IOError:
+            pass
+
+    def _drained(self):
+        self.budget.release(self.held)
+        self.held = 0
+        if self._closed:
+            return
+        if self.spill is None:
+            if self._finishing:
+                self.finish()
+            return
+        self.spill.seek(self._spill_read)
+        block = self.spill.read(self.block_size)
+        self._spill_read += len(block)
+        if self._spill_read == self._spill_size:
+            self._close_spill()
+        # Always taken, or a spilling response could never catch up.
+        self.budget.reserve(len(block), force=True)
+        self._send(block)
+
+    def finish(self):
+        if (self.held or self.spill is not None) and not self._closed:
+            # handler.finish() flushes without a callback, which would drop
+            # _drained and with it the release of what is still held.
+            self._finishing = True
+            return
+        try:
+            self.handler.finish()
+        except IOError:
+            pass
+
+    def _close_spill(self):
+        self.spill.close()
+        self.spill = None
+        self._spill_read = self._spill_size = 0
+
+    def close(self):
+        """Gives up on what was not sent yet, e.g. once the client went away."""
+        if self._closed:
+            return
+        self._closed = True
+        self.budget.release(self.held)
+        self.held = 0
+        if self.spill is not None:
+            self._close_spill()
+
+
+if __name__ == '__main__':
+    class Handler(object):
+        def __init__(self):
+            self.sent = []
+            self.callback = None
+            self.finished = False
+
+        def write(self, data):
+            self.sent.append(data)
+
+        def flush(self, callback=None):
+            self.callback = callback
+
+        def finish(self):
+            self.finished = True
+
+        def drain(self):
+            callback, self.callback = self.callback, None
+            callback()
+
+    budget = MemoryBudget(max_bytes=10, per_response=6)
+    handler = Handler()
+    writer = SpillingWriter(handler, budget, block_size=4)
+    writer.write('abcdefgh')      # too big, a block is sent and the rest spilled
+    writer.write('ij')
+    assert handler.sent == ['abcd'] and budget.bytes == 4 and writer.spill is not None
+    writer.finish()
+    assert not handler.finished
+    handler.drain()
+    assert handler.sent[1:] == ['efgh'] and budget.bytes == 4
+    handler.drain()
+    assert handler.sent[2:] == ['ij'] and writer.spill is None and not handler.finished
+    assert budget.bytes == 2
+    handler.drain()
+    assert handler.finished and budget.bytes == 0 and budget.peak == 4
+    writer.close()
+    assert budget.bytes == 0
+
+    handler = Handler()
+    writer = SpillingWriter(handler, budget, block_size=4)
+    writer.write('abc')           # a whole body, held until sent
+    writer.finish()
+    assert not handler.finished and budget.bytes == 3
+    writer.close()                # the client went away
+    assert budget.bytes == 0
+    report = budget.report()
+    assert report['spilled'] == 1 and report['spilled_bytes'] == 6
+    assert budget.reserve(6) and not budget.reserve(5) and budget.reserve(4, held=2)
+    print 'ok'
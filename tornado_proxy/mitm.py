@@ -0,0 +1,247 @@
+"""
+HTTPS interception with certificates issued on the fly.
+
+A CONNECT to an intercepted port is answered by the proxy itself; the TLS
+connection the client then opens is terminated with a certificate for the
+requested host, signed by a local CA the clients have to trust, and the
+requests sent through it are handled like plain proxied requests for
+``https://host/...`` urls.
+
+    authority = CertificateAuthority('ca')    # creates ca/ca-cert.pem once
+    context = authority.context(host)         # ssl.SSLContext for `host`
+    intercept(stream, host, port, context, app, address)
+
+Generating certificates is what makes interception expensive, so:
+
+- every leaf certificate shares one key pair, generated with the CA,
+  which leaves a signature as the only public key operation per host;
+- leaf certificates are written to ``<directory>/certs/<host>.pem`` and
+  reused by later runs and the other processes until they expire or the
+  CA changes;
+- the ``ssl.SSLContext`` of a host is kept in an LRU of `max_contexts`
+  entries. OpenSSL keeps the session cache and session ticket keys in the
+  context, so keeping it is also what lets clients resume their TLS
+  sessions instead of doing a full handshake on every connection.
+
+Needs pyOpenSSL to create certificates; without it `CertificateAuthority`
+raises RuntimeError.
+"""
+import hashlib
+import logging
+import os
+import re
+import socket
+import ssl
+
+from tornado import iostream
+from tornado import stack_context
+from tornado.httpserver import HTTPConnection
+
+try:
+    from OpenSSL import crypto
+except ImportError:
+    crypto = None
+
+from lrucache import LRUCache
+from tunnel import take_socket, CONNECTION_ESTABLISHED
+
+KEY_BITS = 2048
+CA_VALIDITY = 10 * 365 * 24 * 3600
+# Browsers reject leaf certificates valid for more than 398 days.
+LEAF_VALIDITY = 365 * 24 * 3600
+# Leaf certificates expiring within this many seconds are issued again.
+LEAF_RENEW_BEFORE = 24 * 3600
+CA_NAME = 'WarcProxy CA'
+
+_HOSTNAME = re.compile(r'^[a-z0-9_]([a-z0-9_.-]{0,251}[a-z0-9_])?$')
+
+
+def _write_atomic(path, data, mode=0644):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def _is_ip(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except socket.error:
+            pass
+    return False
+
+
+def _serial():
+    return int(os.urandom(8).encode('hex'), 16) >> 1
+
+
+class CertificateAuthority(object):
+    def __init__(self, directory='ca', max_contexts=1000):
+        if crypto is None:
+            raise RuntimeError('HTTPS interception needs pyOpenSSL')
+        self.directory = directory
+        self.cert_dir = os.path.join(directory, 'certs')
+        self.contexts = LRUCache(max_contexts, max_entry_bytes=1)  # one "byte" per host
+        self.stats = {}
+        if not os.path.isdir(self.cert_dir):
+            os.makedirs(self.cert_dir)
+        self.ca_cert_path = os.path.join(directory, 'ca-cert.pem')
+        self.leaf_key_path = os.path.join(directory, 'leaf-key.pem')
+        self._load_or_create()
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def _load_or_create(self):
+        ca_path = os.path.join(self.directory, 'ca.pem')
+        if os.path.exists(ca_path) and os.path.exists(self.leaf_key_path):
+            with open(ca_path, 'rb') as f:
+                pem = f.read()
+            self.ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM, pem)
+            self.ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+            with open(self.leaf_key_path, 'rb') as f:
+                self.leaf_key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+        else:
+            self._create(ca_path)
+        self.store = crypto.X509Store()
+        self.store.add_cert(self.ca_cert)
+
+    def _create(self, ca_path):
+        self.ca_key = crypto.PKey()
+        self.ca_key.generate_key(crypto.TYPE_RSA, KEY_BITS)
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.set_serial_number(_serial())
+        cert.get_subject().CN = CA_NAME
+        cert.get_subject().O = CA_NAME
+        cert.gmtime_adj_notBefore(-24 * 3600)
+        cert.gmtime_adj_notAfter(CA_VALIDITY)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(self.ca_key)
+        cert.add_extensions([
+            crypto.X509Extension('basicConstraints', True, 'CA:TRUE, pathlen:0'),
+            crypto.X509Extension('keyUsage', True, 'keyCertSign, cRLSign'),
+            crypto.X509Extension('subjectKeyIdentifier', False, 'hash', subject=cert),
+        ])
+        cert.sign(self.ca_key, 'sha256')
+        self.ca_cert = cert
+        self.leaf_key = crypto.PKey()
+        self.leaf_key.generate_key(crypto.TYPE_RSA, KEY_BITS)
+
+        ca_cert_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+        _write_atomic(self.leaf_key_path,
+                      crypto.dump_privatekey(crypto.FILETYPE_PEM, self.leaf_key), 0600)
+        _write_atomic(ca_path, crypto.dump_privatekey(crypto.FILETYPE_PEM, self.ca_key) +
+                      ca_cert_pem, 0600)
+        _write_atomic(self.ca_cert_path, ca_cert_pem)
+        # Certificates of a previous CA are useless now.
+        for name in os.listdir(self.cert_dir):
+            os.remove(os.path.join(self.cert_dir, name))
+        logging.info('Created certificate authority %s, clients must trust %s'
+                     % (self.directory, self.ca_cert_path))
+
+    def context(self, host):
+        """The server-side ``ssl.SSLContext`` presenting a certificate for `host`.
+
+        Raises ValueError if `host` is not a hostname or IP address.
+        """
+        host = host.lower().strip('[]')
+        context = self.contexts.get(host)
+        if context is not None:
+            return context
+        path = self._leaf(host)
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION
+        context.load_cert_chain(path, self.leaf_key_path)
+        self.contexts.set(host, context, 1)
+        return context
+
+    def _leaf(self, host):
+        """Path of a valid certificate for `host`, issued if needed."""
+        is_ip = _is_ip(host)
+        if not is_ip and not _HOSTNAME.match(host):
+            raise ValueError('Not a hostname: %r' % host)
+        name = host.replace(':', '_') if len(host) < 200 else hashlib.sha1(host).hexdigest()
+        path = os.path.join(self.cert_dir, name + '.pem')
+        if os.path.exists(path) and self._usable(path):
+            self._statlog('loaded')
+            return path
+        _write_atomic(path, crypto.dump_certificate(crypto.FILETYPE_PEM,
+                                                    self._issue(host, is_ip)))
+        self._statlog('issued')
+        return path
+
+    def _usable(self, path):
+        try:
+            with open(path, 'rb') as f:
+                cert = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
+            crypto.X509StoreContext(self.store, cert).verify_certificate()
+        except (IOError, crypto.Error, crypto.X509StoreContextError):
+            return False
+        # Also refuses certificates that will expire soon. Both times are
+        # ASN.1 strings in the same format, which compare like the dates.
+        not_after = cert.get_notAfter()
+        renew = crypto.X509()
+        renew.gmtime_adj_notAfter(LEAF_RENEW_BEFORE)
+        return not_after > renew.get_notAfter()
+
+    def _issue(self, host, is_ip):
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.set_serial_number(_serial())
+        cert.get_subject().CN = host[:64]
+        cert.gmtime_adj_notBefore(-24 * 3600)
+        cert.gmtime_adj_notAfter(LEAF_VALIDITY)
+        cert.set_issuer(self.ca_cert.get_subject())
+        cert.set_pubkey(self.leaf_key)
+        alt_name = ('IP:' if is_ip else 'DNS:') + host
+        cert.add_extensions([
+            crypto.X509Extension('basicConstraints', True, 'CA:FALSE'),
+            crypto.X509Extension('keyUsage', True, 'digitalSignature, keyEncipherment'),
+            crypto.X509Extension('extendedKeyUsage', False, 'serverAuth'),
+            crypto.X509Extension('subjectAltName', False, alt_name),
+            crypto.X509Extension('authorityKeyIdentifier', False, 'keyid:always',
+                                 issuer=self.ca_cert),
+        ])
+        cert.sign(self.ca_key, 'sha256')
+        return cert
+
+    def report(self):
+        return dict(self.stats, contexts=len(self.contexts),
+                    context_hits=self.contexts.stats.get('hits', 0))
+
+
+def intercept(stream, host, port, context, request_callback, address, io_loop=None):
+    """Answers the CONNECT received on `stream` and serves the TLS connection
+    the client opens next, passing its requests to `request_callback` with
+    absolute ``https://`host`[:`port`]/...`` urls, as a proxy receives them.
+    """
+    authority = host if port == 443 else '%s:%d' % (host, port)
+
+    def on_request(request):
+        request.uri = 'https://%s%s' % (authority, request.uri)
+        request.path, sep, request.query = request.uri.partition('?')
+        request_callback(request)
+
+    # The socket is taken over before answering: the client starts the
+    # handshake right after the answer, and bytes the stream would read
+    # by then could not be handed to the TLS layer.
+    sock, pending = take_socket(stream)
+    if pending:
+        logging.warning('Data after CONNECT %s before its answer, closing' % authority)
+        sock.close()
+        return
+    try:
+        # A new connection's send buffer always has room for this.
+        sock.sendall(CONNECTION_ESTABLISHED)
+    except socket.error:
+        sock.close()
+        return
+    # fromfd gives the bare _socket.socket, ssl needs the wrapper.
+    tls = context.wrap_socket(socket.socket(_sock=sock), server_side=True,
+                              do_handshake_on_connect=False)
+    with stack_context.NullContext():
+        HTTPConnection(iostream.SSLIOStream(tls, io_loop=io_loop), address, on_request)
@@ -0,0 +1,336 @@
+"""
+Speculative prefetch of the subresources of HTML pages.
+
+A browser asks for the stylesheets, scripts and images of a page only once
+it has the page, a round trip later. A `Prefetcher` reads the page as it
+passes through the proxy and fetches them in the background, so that they
+are cached, or on their way, when the browser asks:
+
+    prefetcher = Prefetcher(fetch, load, max_per_page=32, page_concurrency=6,
+                            max_in_flight=64, max_bytes=64 * 1024 * 1024, period=60)
+    prefetcher.page(url, request_headers, html)
+    ...
+    prefetcher.lookup(url, request_headers, callback)     # on a cache miss
+
+`fetch(key, url, headers, callback)` fetches a subresource and keeps its
+response under `key`, then calls `callback(entry, size)` with the entry
+kept (None if it was not) and the bytes fetched; `load(key, callback)`
+calls `callback(entry)` with the entry kept under `key`, or None. Cache
+keys hash request headers the proxy cannot guess for the browser's own
+requests, so prefetched responses are kept under a `prefetch_key` made of
+the url and the cookies sent, and `lookup` finds them, or waits for one
+still being fetched, for a request that missed its own key.
+
+Only the first `max_per_page` subresources of a page are prefetched, at
+most `page_concurrency` of a page and `max_in_flight` in all at once, the
+others wait in turn with those of at most `max_pages` pages. Prefetching
+pauses once `max_bytes` were fetched in the current `period` seconds, and
+resumes with the next one, and a url prefetched in the last `recent_ttl`
+seconds is not fetched again. The page's cookies are only sent to its own
+origin.
+
+`report` has the counts of pages scanned, subresources found, prefetched
+and skipped by reason, the bytes fetched, the pauses over the byte budget,
+and the hits: cache misses that a prefetched response answered, with
+their rate.
+"""
+import collections
+import functools
+import hashlib
+import re
+import time
+import urlparse
+
+from tornado import ioloop
+from tornado import stack_context
+
+from fingerprint import canonical_url
+
+# Accept headers of Firefox for each kind of subresource.
+ACCEPT = {
+    'style': 'text/css,*/*;q=0.1',
+    'script': '*/*',
+    'image': 'image/avif,image/webp,*/*',
+}
+FORWARDED_HEADERS = ('User-Agent', 'Accept-Language', 'Accept-Encoding')
+LINK_RELS = frozenset(['stylesheet', 'preload', 'modulepreload', 'icon'])
+
+_TAG = re.compile(r'<(link|script|img)\b([^>]*)>', re.I)
+_ATTR = re.compile(r'''([a-zA-Z-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+_BASE = re.compile(r'''<base\b[^>]*\bhref\s*=\s*["']?([^"'\s>]+)''', re.I)
+
+
+def _attributes(text):
+    return dict((name.lower(), double or single or bare)
+                for name, double, single, bare in _ATTR.findall(text))
+
+
+def _unescape(value):
+    return value.replace('&amp;', '&').replace('&#38;', '&').strip()
+
+
+def subresources(html, url, limit=None):
+    """The (url, kind) of the stylesheets, scripts and images `html`, the
+    page at `url`, links to, in document order and without repeats."""
+    base = _BASE.search(html)
+    if base is not None:
+        url = urlparse.urljoin(url, _unescape(base.group(1)))
+    found = []
+    seen = set()
+    for tag, text in _TAG.findall(html):
+        tag = tag.lower()
+        attributes = _attributes(text)
+        if tag == 'link':
+            rels = set(attributes.get('rel', '').lower().split())
+            if not rels & LINK_RELS:
+                continue
+            link = attributes.get('href')
+            kind = 'style' if 'stylesheet' in rels or attributes.get('as') == 'style' else \
+                'script' if 'modulepreload' in rels or attributes.get('as') == 'script' else \
+                'image'
+        else:
+            link = attributes.get('src')
+            kind = 'script' if tag == 'script' else 'image'
+        if not link:
+            continue
+        link = urlparse.urldefrag(urlparse.urljoin(url, _unescape(link)))[0]
+        if not link.startswith(('http://', 'https://')) or link in seen:
+            continue
+        seen.add(link)
+        found.append((link, kind))
+        if limit is not None and len(found) >= limit:
+            break
+    return found
+
+
+def origin_of(url):
+    parts = urlparse.urlsplit(url)
+    return parts.scheme, parts.netloc.lower()
+
+
+def prefetch_key(url, cookie=''):
+    return hashlib.sha1('prefetch\n%s\n%s' % (canonical_url(url), cookie)).hexdigest()
+
+
+def varies(value):
+    """Whether a response with a Vary header `value` may differ between
+    requests of the same `prefetch_key`. Bodies are cached decoded, so
+    Accept-Encoding does not count."""
+    names = set(name.strip().lower() for name in (value or '').split(','))
+    return bool(names - set(['', 'accept-encoding', 'cookie']))
+
+
+class _Page(object):
+    __slots__ = ('url', 'headers', 'urls', 'running')
+
+    def __init__(self, url, headers, urls):
+        self.url = url
+        self.headers = headers
+        self.urls = collections.deque(urls)
+        self.running = 0
+
+
+class Prefetcher(object):
+    def __init__(self, fetch, load, max_per_page=32, page_concurrency=6, max_in_flight=64,
+                 max_bytes=64 * 1024 * 1024, period=60, max_pages=100, recent_ttl=60,
+                 max_recent=10000, max_scan=256 * 1024, io_loop=None):
+        self.fetch = fetch
+        self.load = load
+        self.max_per_page = max_per_page
+        self.page_concurrency = page_concurrency
+        self.max_in_flight = max_in_flight
+        self.max_bytes = max_bytes
+        self.period = period
+        self.max_pages = max_pages
+        self.recent_ttl = recent_ttl
+        self.max_recent = max_recent
+        self.max_scan = max_scan
+        self._io_loop = io_loop
+        self.pages = collections.deque()
+        self.inflight = {}  # key -> callbacks waiting for the entry
+        self.recent = collections.OrderedDict()  # key -> prefetched at, oldest first
+        self._window_started = 0
+        self._window_bytes = 0
+        self._resume = None
+        self.stats = {}
+
+    @property
+    def io_loop(self):
+        # Resolved late, see MemcacheLease.io_loop.
+        return self._io_loop or ioloop.IOLoop.instance()
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def page(self, url, request_headers, html):
+        """Prefetches the subresources of the page `html` fetched from `url`
+        with `request_headers`."""
+        self._statlog('pages')
+        if len(self.pages) >= self.max_pages:
+            self._statlog('skipped_pages_full')
+            return
+        if 'Authorization' in request_headers:
+            # Not cached anyway.
+            self._statlog('skipped_authorized')
+            return
+        urls = subresources(html[:self.max_scan], url, self.max_per_page)
+        self._statlog('found', len(urls))
+        if urls:
+            self.pages.append(_Page(url, request_headers, urls))
+            self._pump()
+
+    def _over_budget(self):
+        now = time.time()
+        if now >= self._window_started + self.period:
+            self._window_started = now
+            self._window_bytes = 0
+        return self._window_bytes >= self.max_bytes
+
+    def _pump(self):
+        if self._resume is not None:
+            return
+        blocked = 0
+        while self.pages and blocked < len(self.pages) and \
+                len(self.inflight) < self.max_in_flight:
+            if self._over_budget():
+                # The pages keep waiting until the next period.
+                self._statlog('paused_budget')
+                with stack_context.NullContext():
+                    self._resume = self.io_loop.add_timeout(
+                        self._window_started + self.period, self._resumed)
+                return
+            page = self.pages[0]
+            self.pages.rotate(-1)
+            if page.running >= self.page_concurrency:
+                blocked += 1
+                continue
+            blocked = 0
+            url, kind = page.urls.popleft()
+            if not page.urls:
+                self.pages.pop()
+            self._start(page, url, kind)
+
+    def _resumed(self):
+        self._resume = None
+        self._pump()
+
+    def _headers(self, page, url, kind):
+        headers = dict((name, page.headers[name]) for name in FORWARDED_HEADERS
+                       if name in page.headers)
+        headers['Accept'] = ACCEPT[kind]
+        headers['Referer'] = page.url
+        if 'Cookie' in page.headers and origin_of(url) == origin_of(page.url):
+            headers['Cookie'] = page.headers['Cookie']
+        return headers
+
+    def _start(self, page, url, kind):
+        headers = self._headers(page, url, kind)
+        key = prefetch_key(url, headers.get('Cookie', ''))
+        now = time.time()
+        while self.recent and next(self.recent.itervalues()) < now - self.recent_ttl:
+            self.recent.popitem(last=False)
+        if key in self.inflight or key in self.recent:
+            self._statlog('skipped_recent')
+            return
+        self.inflight[key] = []
+        page.running += 1
+
+        def loaded(entry):
+            if entry is not None:
+                # Kept by another process meanwhile.
+                self._statlog('skipped_cached')
+                done(entry, 0, False)
+            else:
+                self.fetch(key, url, headers, done)
+
+        def done(entry, size, fetched=True):
+            page.running -= 1
+            self._window_bytes += size
+            if fetched:
+                self._statlog('bytes', size)
+                self._statlog('prefetched' if entry is not None else 'not_kept')
+            self.recent[key] = time.time()
+            if len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
+            for callback in self.inflight.pop(key):
+                callback(entry)
+            self._pump()
+
+        self.load(key, loaded)
+
+    def lookup(self, url, request_headers, callback):
+        """Calls `callback(entry)` with the prefetched response for a
+        request of `url` with `request_headers`, or None."""
+        self._statlog('lookups')
+        key = prefetch_key(url, request_headers.get('Cookie', ''))
+        callback = functools.partial(self._looked_up, stack_context.wrap(callback))
+        waiting = self.inflight.get(key)
+        if waiting is not None:
+            self._statlog('waited')
+            waiting.append(callback)
+        else:
+            self.load(key, callback)
+
+    def _looked_up(self, callback, entry):
+        if entry is not None:
+            self._statlog('hits')
+        callback(entry)
+
+    def report(self):
+        lookups = self.stats.get('lookups', 0)
+        return dict(self.stats, in_flight=len(self.inflight),
+                    pages_waiting=len(self.pages), recent=len(self.recent),
+                    hit_rate=round(self.stats.get('hits', 0) / float(lookups), 3)
+                    if lookups else 0)
+
+
+if __name__ == '__main__':
+    html = '''<html><head><base href="/site/">
+    <link rel="stylesheet" href="a.css"><link rel=icon href='/favicon.ico'>
+    <link rel="alternate" href="feed.xml"><script src="app.js?v=1&amp;x=2"></script>
+    </head><body><img src="http://cdn.example/i.png#top"><img src="data:image/png;base64,xx">
+    <img src="a.css"></body></html>'''
+    assert subresources(html, 'http://example.com/page') == [
+        ('http://example.com/site/a.css', 'style'),
+        ('http://example.com/favicon.ico', 'image'),
+        ('http://example.com/site/app.js?v=1&x=2', 'script'),
+        ('http://cdn.example/i.png', 'image')], subresources(html, 'http://example.com/page')
+
+    kept = {}
+    fetches = []
+
+    def fetch(key, url, headers, callback):
+        fetches.append((key, url, headers, callback))
+
+    def load(key, callback):
+        callback(kept.get(key))
+
+    loop = ioloop.IOLoop.instance()
+    prefetcher = Prefetcher(fetch, load, max_per_page=3, page_concurrency=2, max_in_flight=10,
+                            max_bytes=100, period=0.1, io_loop=loop)
+    page_headers = {'Cookie': 'sid=1', 'User-Agent': 'test', 'Accept': 'text/html'}
+    prefetcher.page('http://example.com/page', page_headers, html)
+    assert [f[1] for f in fetches] == ['http://example.com/site/a.css',
+                                       'http://example.com/favicon.ico']
+    assert fetches[0][2] == {'Cookie': 'sid=1', 'User-Agent': 'test',
+                             'Accept': 'text/css,*/*;q=0.1',
+                             'Referer': 'http://example.com/page'}
+    answers = []
+    prefetcher.lookup('http://example.com/site/a.css', {'Cookie': 'sid=1'}, answers.append)
+    kept[fetches[0][0]] = 'css entry'
+    fetches[0][3]('css entry', 60)     # answers the waiting lookup, starts app.js
+    assert answers == ['css entry'] and fetches[2][1] == 'http://example.com/site/app.js?v=1&x=2'
+    fetches[1][3](None, 50)            # over the byte budget now
+    prefetcher.page('http://example.com/other', {}, '<img src="/b.png">')
+    assert len(fetches) == 3 and prefetcher.report()['pages_waiting'] == 1
+    prefetcher.lookup('http://example.com/site/a.css', {'Cookie': 'sid=2'}, answers.append)
+    assert answers[1:] == [None]
+    loop.add_timeout(time.time() + 0.2, loop.stop)
+    loop.start()                       # the next period
+    assert len(fetches) == 4 and fetches[3][1] == 'http://example.com/b.png'
+    report = prefetcher.report()
+    assert report['hits'] == 1 and report['waited'] == 1 and report['hit_rate'] == 0.5
+    assert report['paused_budget'] == 1 and report['bytes'] == 110 and report['in_flight'] == 2
+    assert report['pages_waiting'] == 0
+    assert not varies(None) and not varies('Accept-Encoding, Cookie') and varies('Accept')
+    print 'ok'
@@ -26,34 +26,274 @@
 # THE SOFTWARE.
 
 import sys
+import os
 import socket
-import hashlib
-import cPickle
+import signal
+import atexit
+import logging
 import zlib
-import base64
+import time
+import functools
 from  cStringIO import StringIO
-import weakref
+import datetime
+import httplib
+import urlparse
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.iostream
 import tornado.web
 import tornado.httpclient
-from scrapy.utils.url import canonicalize_url
+from tornado.httputil import HTTPHeaders
 
 import tornadoasyncmemcache as memcache
+from coalescing import RequestCoalescer, MemcacheLease, LEADER, FOLLOWER
+from lrucache import LRUCache
+from cacheentry import encode_entry, decode_entry, encode_vary, decode_vary, MEMCACHED_FLAG
+from shareddict import DictionaryRegistry, UnknownDictionary
+from fingerprint import LEGACY_POLICY
+from tunnel import TunnelManager
+from resolver import Resolver
+from breaker import CircuitBreaker
+from writebehind import WriteBehindQueue
+from admission import AdmissionController
+from membudget import MemoryBudget, SpillingWriter
+from latency import LatencyTracker
+from hedging import HedgePolicy, HedgedFetch
+from timeouts import AdaptiveTimeouts
+from prefetch import Prefetcher, varies
+import ranges
+import freshness
+import mitm
+import workers
 
-ccs = memcache.ClientPool(['127.0.0.1:11211'], maxclients=5000)
+# memcached operations taking over MEMCACHED_TIMEOUT seconds count as misses
+# (or failed writes). A server that cannot be connected to, or times out
+# MEMCACHED_DEAD_AFTER operations in a row, is dead: while no server is
+# alive requests bypass the cache, and dead servers are health-checked
+# every MEMCACHED_RETRY seconds.
+MEMCACHED_TIMEOUT = 0.5
+MEMCACHED_DEAD_AFTER = 3
+MEMCACHED_RETRY = 10
+ccs = memcache.ClientPool(['127.0.0.1:11211'], maxclients=5000, timeout=MEMCACHED_TIMEOUT,
+                          dead_after=MEMCACHED_DEAD_AFTER, dead_retry=MEMCACHED_RETRY)
 
-__all__ = ['ProxyHandler', 'run_proxy']
+__all__ = ['ProxyHandler', 'StatsHandler', 'run_proxy']
 from  tornado.httpclient import HTTPResponse
 
 CACHED_CODES = [200, 301, 302, 303, 307, 404, 304]
+FORWARDED_HEADERS = ('Date', 'Cache-Control', 'Server', 'Content-Type', 'Location',
+                     'Retry-After', 'Content-Range', 'Accept-Ranges')
+UPSTREAM_CLIENT = "tornado_proxy.warc_httpclient.WarcSimpleAsyncHTTPClient"
 
-_fingerprint_cache = weakref.WeakKeyDictionary()
+# Send upstream headers and body chunks to the client as they arrive
+# instead of waiting for the whole response.
+STREAM_RESPONSES = True
+# Streamed bodies larger than this are not assembled for memcached
+# (memcached rejects items above 1MB by default).
+CACHEABLE_SIZE_LIMIT = 768 * 1024
+# GETs with a Range header are keyed like the whole object, and answered
+# with 206 slices of it (several ranges as multipart/byteranges) once it
+# is cached. Until then the range is fetched upstream, and objects of at
+# most RANGE_CACHE_LIMIT bytes are fetched whole in the background.
+SERVE_RANGES = True
+RANGE_CACHE_LIMIT = CACHEABLE_SIZE_LIMIT
+whole_fetches = set()  # keys being fetched whole
 
+# Response bodies in flight hold at most BODY_MEMORY_BUDGET bytes of memory
+# in this process, and one response at most BODY_MEMORY_LIMIT: past that,
+# what its client did not read yet spills to a temporary file, streamed
+# bodies are no longer assembled for the cache and WARC payloads are
+# spooled to disk. Bodies that have to be buffered whole (not streamed)
+# fail with a 502 past MAX_BUFFERED_BODY bytes.
+BODY_MEMORY_BUDGET = 256 * 1024 * 1024
+BODY_MEMORY_LIMIT = 4 * 1024 * 1024
+MAX_BUFFERED_BODY = 64 * 1024 * 1024
+buffers = MemoryBudget(max_bytes=BODY_MEMORY_BUDGET, per_response=BODY_MEMORY_LIMIT)
 
-def fingerprint_request(req, arguments=None):
+# Responses are sent without waiting for memcached to store them: cache
+# writes are queued and written in pipelined batches (see writebehind).
+# Writes beyond WRITE_QUEUE_ITEMS or WRITE_QUEUE_BYTES waiting are dropped.
+WRITE_QUEUE_ITEMS = 10000
+WRITE_QUEUE_BYTES = 64 * 1024 * 1024
+writes = WriteBehindQueue(ccs, max_items=WRITE_QUEUE_ITEMS, max_bytes=WRITE_QUEUE_BYTES)
+
+# Concurrent requests with the same fingerprint share one cache lookup and
+# upstream fetch; at most MAX_FOLLOWERS wait on a single fetch.
+COALESCED_METHODS = ('GET',)
+MAX_FOLLOWERS = 500
+coalescer = RequestCoalescer(max_followers=MAX_FOLLOWERS)
+
+# Coalesce cold misses across proxy nodes sharing the memcached pool: only
+# the node holding the fingerprint's lease (LEASE_TTL seconds) goes upstream.
+DISTRIBUTED_LEASE = False
+LEASE_TTL = 10
+lease = MemcacheLease(ccs, ttl=LEASE_TTL)
+
+# In-process cache of decoded responses in front of memcached. With
+# L1_SNAPSHOT set it is saved there on shutdown and reloaded on startup.
+L1_CACHE_BYTES = 64 * 1024 * 1024
+L1_TTL = 5 * 60
+L1_SNAPSHOT = None
+l1_cache = LRUCache(L1_CACHE_BYTES, ttl=L1_TTL)
+
+# Compress cached text bodies against dictionaries built from sampled
+# bodies of the same content type (and host, with DICTIONARIES_BY_HOST).
+# Entries written this way are always readable, whatever this is set to.
+SHARED_DICTIONARIES = False
+DICTIONARIES_BY_HOST = False
+dictionaries = DictionaryRegistry(ccs, by_host=DICTIONARIES_BY_HOST)
+
+# Which parts of a request make up its cache key, see fingerprint.KeyPolicy
+# (fingerprint.BROWSER_POLICY raises the hit ratio of browsing sessions);
+# LEGACY_POLICY keeps the keys of earlier versions. Responses varying on
+# headers the key leaves out are cached per variant, and the Vary headers
+# of the VARY_KEYS most recently used keys are remembered.
+KEY_POLICY = LEGACY_POLICY
+VARY_KEYS = 100000
+vary_names = LRUCache(VARY_KEYS, max_entry_bytes=1)  # one "byte" per key
+
+# Cached responses are served while fresh (see freshness for the lifetime
+# rules and tunables). Expired ones are still served for a while, and
+# refreshed by a conditional request in the background; hot keys are
+# refreshed early, by one of their readers, shortly before they expire.
+revalidator = freshness.Revalidator(max_clients=5000, max_body_size=CACHEABLE_SIZE_LIMIT,
+                                    budget=buffers)
+
+# Responses are written to memcached for their lifetime plus the time they
+# may be served stale, but for at least CACHE_MIN_TTL and at most
+# CACHE_MAX_TTL seconds. Those a shared cache must not keep (no-store,
+# private, Set-Cookie unless CACHE_SET_COOKIE, answers to authorized
+# requests) are not written at all. Lifetimes per host are set with
+# freshness.HOST_LIFETIMES.
+CACHE_MIN_TTL = 60
+CACHE_MAX_TTL = 7 * 24 * 3600
+CACHE_SET_COOKIE = False
+# Error responses with a status in NEGATIVE_CODES, and the 502 and 504
+# answers sent when the origin could not be reached, are cached only
+# NEGATIVE_TTL seconds (0 disables this).
+NEGATIVE_TTL = 10
+NEGATIVE_CODES = (500, 502, 503, 504)
+storage = freshness.StoragePolicy(min_ttl=CACHE_MIN_TTL, max_ttl=CACHE_MAX_TTL,
+                                  store_set_cookie=CACHE_SET_COOKIE,
+                                  negative_ttl=NEGATIVE_TTL, negative_codes=NEGATIVE_CODES)
+
+# At most MAX_IN_FLIGHT requests are served at once, MAX_IN_FLIGHT_PER_CLIENT
+# of them from the same address. Up to ADMISSION_QUEUE more wait for their
+# turn, for ADMISSION_WAIT seconds at most; the others are answered 503 with
+# a Retry-After of ADMISSION_RETRY_AFTER seconds. CONNECT tunnels are limited
+# by MAX_TUNNELS instead.
+MAX_IN_FLIGHT = 2000
+MAX_IN_FLIGHT_PER_CLIENT = 500
+ADMISSION_QUEUE = 2000
+ADMISSION_WAIT = 10
+ADMISSION_RETRY_AFTER = 1
+admission = AdmissionController(max_in_flight=MAX_IN_FLIGHT,
+                                max_per_client=MAX_IN_FLIGHT_PER_CLIENT,
+                                max_queue=ADMISSION_QUEUE, max_wait=ADMISSION_WAIT,
+                                retry_after=ADMISSION_RETRY_AFTER)
+
+# Origins failing BREAKER_THRESHOLD requests in a row (no connection, a
+# timeout or a status in BREAKER_CODES) are answered 502, or 504 after
+# timeouts, without being asked for BREAKER_RESET_TIMEOUT seconds. Then a
+# request probes them, and while probes fail the wait doubles up to
+# BREAKER_MAX_RESET_TIMEOUT seconds.
+BREAKER_THRESHOLD = 5
+BREAKER_CODES = (502, 503, 504)
+BREAKER_RESET_TIMEOUT = 30
+BREAKER_MAX_RESET_TIMEOUT = 5 * 60
+breaker = CircuitBreaker(threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT,
+                         max_reset_timeout=BREAKER_MAX_RESET_TIMEOUT)
+
+# GETs without response headers after their origin's HEDGE_QUANTILE time to
+# headers (kept between HEDGE_MIN_DELAY and HEDGE_MAX_DELAY seconds) are
+# sent again on another connection and the first answer is used. Each
+# request earns its origin HEDGE_RATIO of a hedge, up to HEDGE_BURST.
+HEDGE_REQUESTS = False
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_DELAY = 0.05
+HEDGE_MAX_DELAY = 1.0
+HEDGE_RATIO = 0.05
+HEDGE_BURST = 10
+latencies = LatencyTracker()
+hedging = HedgePolicy(latencies, quantile=HEDGE_QUANTILE, min_delay=HEDGE_MIN_DELAY,
+                      max_delay=HEDGE_MAX_DELAY, ratio=HEDGE_RATIO, burst=HEDGE_BURST)
+
+# The connect, first byte (request sent to response headers) and total
+# timeouts of upstream requests are UPSTREAM_TIMEOUT_FACTOR times the
+# UPSTREAM_TIMEOUT_QUANTILE of their origin's recent answered requests,
+# kept between the (floor, ceiling) seconds below; origins with too few
+# samples get the ceilings. A body announced by the response headers may
+# take as long as it needs at UPSTREAM_MIN_RATE bytes per second, up to the
+# total ceiling.
+UPSTREAM_TIMEOUT_QUANTILE = 0.99
+UPSTREAM_TIMEOUT_FACTOR = 3
+CONNECT_TIMEOUT = (1, 50)
+FIRST_BYTE_TIMEOUT = (5, 5 * 60)
+TOTAL_TIMEOUT = (30, 15 * 60)
+UPSTREAM_MIN_RATE = 16 * 1024
+timeouts = AdaptiveTimeouts(quantile=UPSTREAM_TIMEOUT_QUANTILE, factor=UPSTREAM_TIMEOUT_FACTOR,
+                            connect=CONNECT_TIMEOUT, first_byte=FIRST_BYTE_TIMEOUT,
+                            total=TOTAL_TIMEOUT, min_rate=UPSTREAM_MIN_RATE)
+
+# Prefetch the stylesheets, scripts and images of cacheable HTML pages
+# fetched upstream (see prefetch): the first PREFETCH_PER_PAGE of a page,
+# PREFETCH_PAGE_CONCURRENCY of a page and PREFETCH_IN_FLIGHT in all at
+# once, behind every other upstream request, and no more than PREFETCH_BYTES
+# every PREFETCH_PERIOD seconds. Prefetched responses are kept at most
+# PREFETCH_TTL seconds for the requests that follow, which look them up
+# when they miss the cache.
+PREFETCH = False
+PREFETCH_PER_PAGE = 32
+PREFETCH_PAGE_CONCURRENCY = 6
+PREFETCH_IN_FLIGHT = 64
+PREFETCH_BYTES = 64 * 1024 * 1024
+PREFETCH_PERIOD = 60
+PREFETCH_TTL = 60
+prefetcher = None
+
+# Origin hostnames are looked up by RESOLVER_THREADS threads instead of
+# blocking the IOLoop. Answers are cached DNS_TTL seconds, failures (and
+# lookups taking over DNS_TIMEOUT seconds) DNS_NEGATIVE_TTL seconds, for at
+# most DNS_CACHE_SIZE names.
+RESOLVER_THREADS = 10
+DNS_CACHE_SIZE = 10000
+DNS_TTL = 5 * 60
+DNS_NEGATIVE_TTL = 30
+DNS_TIMEOUT = 10
+resolver = Resolver(threads=RESOLVER_THREADS, max_names=DNS_CACHE_SIZE, ttl=DNS_TTL,
+                    negative_ttl=DNS_NEGATIVE_TTL, timeout=DNS_TIMEOUT)
+
+# CONNECT tunnels: at most MAX_TUNNELS open, closed after TUNNEL_IDLE_TIMEOUT
+# seconds without traffic, and reading from one side pauses while more
+# than TUNNEL_BUFFER bytes wait to be written to the other.
+MAX_TUNNELS = 1000
+TUNNEL_IDLE_TIMEOUT = 5 * 60
+TUNNEL_BUFFER = 256 * 1024
+tunnels = TunnelManager(max_tunnels=MAX_TUNNELS, idle_timeout=TUNNEL_IDLE_TIMEOUT,
+                        max_buffer=TUNNEL_BUFFER, resolver=resolver)
+
+# Intercept CONNECTs to MITM_PORTS instead of tunnelling them: TLS is
+# terminated with certificates issued by the CA kept in MITM_CA_DIR (clients
+# must trust its ca-cert.pem) and the requests are fetched, archived and
+# cached like plain HTTP ones. Needs pyOpenSSL. MITM_CONTEXTS hosts keep
+# their TLS context, and with it their clients' resumable sessions.
+MITM = False
+MITM_PORTS = (443,)
+MITM_CA_DIR = 'ca'
+MITM_CONTEXTS = 1000
+# CA bundle verifying the origins of intercepted requests, tornado's own if None.
+UPSTREAM_CA_CERTS = None
+certificate_authority = None
+
+# Workers of a multi-process run claim a url in memcached before archiving
+# it. Claims last WARC_CLAIM_TTL seconds, the longest relative expiry
+# memcached takes (it reads larger values as timestamps). A url whose claim
+# expired, or was evicted under memory pressure, may be archived by two
+# workers; the merged index of the run still lists it once.
+WARC_CLAIM_TTL = 30 * 24 * 3600
+
+def fingerprint_request(req, arguments=None, headers=None):
     """
     from scrapy
     Return the request fingerprint.
@@ -68,43 +308,142 @@ def fingerprint_request(req, arguments=None):
     and are equivalent (ie. they should return the same response).
 
     """
-    cache = _fingerprint_cache.setdefault(req, {})
-    url = canonicalize_url(req.url)
-    ignore_headers = ['Connection', 'User-Agent', 'Referer', ]
-    if url not in cache:
-        fp = hashlib.sha1()
-        fp.update(str(url))
-        fp.update(str(req.method))
-        fp.update(str(req.body))
-        if arguments:
-            for name, value in arguments.iteritems():
-                fp.update("%s%s" % (name, value))
-
-        for name, value in req.headers.iteritems():
-            if name in ignore_headers:
-                continue
-            fp.update("%s%s" % (name, value))
-        cache[url] = fp.hexdigest()
-    return cache[url]
-
-
-def serialize_response(response):
-    result = {
+    return KEY_POLICY.fingerprint(req.url, req.method, req.body,
+                                  req.headers if headers is None else headers, arguments)
+
+
+def get_certificate_authority():
+    global certificate_authority
+    if certificate_authority is None:
+        certificate_authority = mitm.CertificateAuthority(MITM_CA_DIR, MITM_CONTEXTS)
+    return certificate_authority
+
+
+def get_prefetcher():
+    global prefetcher
+    if prefetcher is None:
+        prefetcher = Prefetcher(prefetch_upstream, load_prefetched,
+                                max_per_page=PREFETCH_PER_PAGE,
+                                page_concurrency=PREFETCH_PAGE_CONCURRENCY,
+                                max_in_flight=PREFETCH_IN_FLIGHT, max_bytes=PREFETCH_BYTES,
+                                period=PREFETCH_PERIOD, recent_ttl=PREFETCH_TTL)
+    return prefetcher
+
+
+def prefetch_upstream(key, url, headers, callback):
+    """Fetches `url` for the prefetcher and keeps the response, if it can
+    be cached and is small enough, under `key` for PREFETCH_TTL seconds."""
+    origin = urlparse.urlsplit(url).netloc.lower()
+    if not breaker.allow(origin):
+        callback(None, 0)
+        return
+    body = {'chunks': [], 'held': 0, 'size': 0}  # chunks is None once dropped
+
+    def on_chunk(chunk):
+        body['size'] += len(chunk)
+        if body['chunks'] is None:
+            return
+        if body['size'] > CACHEABLE_SIZE_LIMIT or not buffers.reserve(len(chunk)):
+            drop_chunks()
+        else:
+            body['held'] += len(chunk)
+            body['chunks'].append(chunk)
+
+    def drop_chunks():
+        buffers.release(body['held'])
+        body['held'] = 0
+        body['chunks'] = None
+
+    def fetched(response):
+        if response.code == 599 or response.code in BREAKER_CODES:
+            breaker.failure(origin, is_timeout(response.error))
+        else:
+            breaker.success(origin)
+        chunks = body['chunks']
+        drop_chunks()
+        entry = None
+        if chunks is not None and response.code in CACHED_CODES and response.code != 304 and \
+                not varies(response.headers.get('Vary')):
+            entry = response_entry(response_with_body(response, ''.join(chunks)))
+            ttl = storage.ttl(req.headers, entry)
+            if ttl is None:
+                entry = None
+            else:
+                ttl = min(ttl, PREFETCH_TTL)
+                l1_store(key, entry, ttl)
+                writes.put(key, serialize_entry(entry), time=ttl, flags=MEMCACHED_FLAG)
+        callback(entry, body['size'])
+
+    req = tornado.httpclient.HTTPRequest(url=url, headers=HTTPHeaders(headers),
+                                         follow_redirects=False,
+                                         connect_timeout=float(CONNECT_TIMEOUT[1]),
+                                         request_timeout=float(TOTAL_TIMEOUT[1]),
+                                         ca_certs=UPSTREAM_CA_CERTS,
+                                         streaming_callback=on_chunk)
+    # Waits behind the requests of clients, see scheduler.
+    req.prefetch = True
+    tornado.httpclient.AsyncHTTPClient(max_clients=5000).fetch(req, fetched)
+
+
+def fetch_whole(key, vary, request, request_headers):
+    """Fetches the whole object a Range `request` asked part of, and caches
+    it under `key` so that the next ranges are sliced from it."""
+    if key in whole_fetches:
+        return
+    whole_fetches.add(key)
+    # Neither the client's range nor its conditions, which were about its
+    # partial copy: a 304 or 412 would leave nothing to cache.
+    headers = freshness.unconditional(request.headers)
+
+    def fetched(response):
+        whole_fetches.discard(key)
+        if response.code == 200 and len(response.body) <= RANGE_CACHE_LIMIT:
+            revalidated(key, vary, request_headers, response, None)
+
+    whole = tornado.httpclient.HTTPRequest(url=request.url, headers=headers,
+                                           follow_redirects=False,
+                                           connect_timeout=float(CONNECT_TIMEOUT[1]),
+                                           request_timeout=float(TOTAL_TIMEOUT[1]),
+                                           ca_certs=UPSTREAM_CA_CERTS)
+    # Waits behind the requests of clients, like a prefetch.
+    whole.prefetch = True
+    tornado.httpclient.AsyncHTTPClient(max_clients=5000).fetch(whole, fetched)
+
+
+def load_prefetched(key, callback):
+    entry = l1_cache.get(key)
+    if entry is not None:
+        callback(entry)
+        return
+
+    def got(dumped):
+        entry = None
+        if dumped:
+            try:
+                entry = decode_entry(dumped, dictionaries)
+            except (UnknownDictionary, ValueError, zlib.error):
+                pass
+        callback(entry)
+
+    ccs.get(key, callback=got)
+
+
+def response_entry(response):
+    return {
         'body': response.body,
         'code': response.code,
         'effective_url': response.effective_url,
-        'headers': response.headers,
+        'headers': list(response.headers.get_all()),
         'time_info': response.time_info,
         'request_time': response.request_time,
+        'stored_at': time.time(),
     }
 
-    serialized = cPickle.dumps(result)
-    return base64.encodestring(zlib.compress(serialized))
 
-
-def unserialize_response(dumped, request):
-    serialized = zlib.decompress(base64.decodestring(dumped))
-    result = cPickle.loads(serialized)
+def entry_response(result, request):
+    headers = HTTPHeaders()
+    for name, value in result['headers']:
+        headers.add(name, value)
     buffer = StringIO()
     buffer.write(result['body'])
     #response.buffer = buffer
@@ -113,7 +452,7 @@ def unserialize_response(dumped, request):
         effective_url=result['effective_url'],
         code=result['code'],
         request_time=result['request_time'],
-        headers=result['headers'],
+        headers=headers,
         time_info=result['time_info'],
         buffer=buffer,
     )
@@ -121,49 +460,204 @@ def unserialize_response(dumped, request):
     return response
 
 
+def entry_size(result):
+    return len(result['body']) + sum(len(k) + len(v) for k, v in result['headers']) + 256
+
+
+def serialize_entry(entry):
+    if not SHARED_DICTIONARIES:
+        return encode_entry(entry)
+    dictionaries.sample(entry)
+    return encode_entry(entry, dictionaries)
+
+
+def l1_store(fingerprint, entry, ttl=None):
+    if ttl is not None and L1_TTL:
+        ttl = min(ttl, L1_TTL)
+    l1_cache.set(fingerprint, entry, entry_size(entry), ttl=ttl)
+
+
+def revalidated(key, vary, request_headers, response, updated):
+    """Stores the outcome of revalidating the entry under `key`: the entry
+    `updated` by a 304, or a new response of the same variants. The entry
+    is dropped if the origin no longer lets it be cached."""
+    if updated is None:
+        if response.code not in CACHED_CODES or response.code == 304 \
+                or KEY_POLICY.vary(response.headers.get('Vary')) != vary:
+            return
+        if response.body is None or len(response.body) > CACHEABLE_SIZE_LIMIT:
+            # Too large to keep, and the old entry is outdated.
+            storage.skip('size')
+            ttl = None
+        else:
+            updated = response_entry(response)
+    if updated is not None:
+        ttl = storage.ttl(request_headers, updated)
+    if ttl is None:
+        l1_cache.delete(key)
+        ccs.delete(key, callback=lambda deleted: None)
+        return
+    l1_store(key, updated, ttl)
+    writes.put(key, serialize_entry(updated), time=ttl, flags=MEMCACHED_FLAG)
+
+
+def client_status(code):
+    """`code`, or 502 for statuses tornado cannot send (e.g. nonstandard 5xx)."""
+    return code if code in httplib.responses else 502
+
+
+def is_timeout(error):
+    """Whether the `error` of a 599 response is a connect or request timeout."""
+    # HTTPError has no message of its own, only "HTTP 599: Timeout".
+    return isinstance(error, tornado.httpclient.HTTPError) and error.code == 599 and \
+        str(error).endswith(': Timeout')
+
+
+def gateway_error(request, timeout, message, retry_after=None, vary=()):
+    """The 504 (after a timeout) or 502 answer to `request` when its origin
+    did not respond. It varies on `vary`, the headers its key was made for."""
+    headers = HTTPHeaders({'Content-Type': 'text/plain'})
+    if retry_after:
+        headers['Retry-After'] = str(retry_after)
+    if vary:
+        headers['Vary'] = ', '.join(vary)
+    return HTTPResponse(request, 504 if timeout else 502, headers=headers,
+                        buffer=StringIO(message + '\n'), effective_url=request.url)
+
+
+def response_with_body(response, body):
+    """Copy of a streamed `response` (whose own body is empty) carrying `body`."""
+    return HTTPResponse(
+        request=response.request,
+        effective_url=response.effective_url,
+        code=response.code,
+        request_time=response.request_time,
+        headers=response.headers,
+        time_info=response.time_info,
+        error=response.error,
+        buffer=StringIO(body),
+    )
+
+
 class ProxyHandler(tornado.web.RequestHandler):
     SUPPORTED_METHODS = ['GET', 'POST', 'CONNECT']
+    # Requests being served, waited for by a graceful shutdown. CONNECT
+    # tunnels are not counted, they are closed when the process exits.
+    in_flight = 0
 
     def initialize(self):
-        tornado.httpclient.AsyncHTTPClient.configure("tornado_proxy.warc_httpclient.WarcSimpleAsyncHTTPClient")
+        tornado.httpclient.AsyncHTTPClient.configure(UPSTREAM_CLIENT, resolver=resolver,
+                                                     max_buffer_size=MAX_BUFFERED_BODY,
+                                                     memory_budget=buffers,
+                                                     timeouts=timeouts)
+        self._leading = False
+        self._lease_held = False
+        self._counted = False
+        self._ticket = None
+        self._stream_chunks = None
+        self._body = None
+
+    def prepare(self):
+        if self.request.method != 'CONNECT':
+            self._counted = True
+            ProxyHandler.in_flight += 1
 
     @tornado.web.asynchronous
     def get(self):
+        ticket = admission.admit(self.request.remote_ip, self._serve, self._shed)
+        if self._finished:
+            # Answered (or rejected) before admit returned.
+            admission.release(ticket)
+        else:
+            self._ticket = ticket
+
+    def _shed(self):
+        self.set_status(503)
+        self.set_header('Retry-After', str(admission.retry_after))
+        try:
+            self.finish()
+        except IOError:
+            pass
+
+    def _serve(self):
         self._memcached = False
+        self._coalesced = False
+        self._streamed = False
+        self._streamed_fetch = False
+        self._rejected = False
+        self._prefetch_checked = False
+        self._range = None
+        self._header_lines = []
+        self._stream_chunks = []
+        self._stream_size = 0
+        self._body = SpillingWriter(self, buffers)
 
         def handle_response(response):
-            if response.error and not isinstance(response.error,
-                                                 tornado.httpclient.HTTPError):
-                self.set_status(500)
-                self.write('Internal server error:\n' + str(response.error))
-                try:
-                    self.finish()
-                except IOError:
-                    pass
+            kept = True
+            if self._streamed_fetch:
+                # Streamed bodies are only kept (for followers and memcached)
+                # if they were small enough.
+                kept = self._stream_chunks is not None
+                if kept:
+                    response = response_with_body(response, ''.join(self._stream_chunks))
+                    self._drop_stream_chunks()
+            if response.code == 599 and not self._streamed:
+                # No response from the origin.
+                response = gateway_error(req, is_timeout(response.error),
+                                         'Could not fetch %s: %s' % (req.url, response.error),
+                                         vary=self._vary)
+                kept = True
+            vary = KEY_POLICY.vary(response.headers.get('Vary'))
+            if self._leading:
+                self._leading = False
+                # Followers share the key, but only the headers in it.
+                shared = kept and vary == self._vary
+                coalescer.release(self.fingerprint, response if shared else None)
+
+            if response.code == 599:
+                # Once streamed headers are out all we can do is cut the body short.
+                self._body.finish()
 
             else:
-                self.set_status(response.code)
-                for header in ('Date', 'Cache-Control', 'Server',
-                               'Content-Type', 'Location'):
-                    v = response.headers.get(header)
-                    if v:
-                        self.set_header(header, v)
-                if response.body:
-                    self.write(response.body)
-                if not self._memcached and response.code in CACHED_CODES:
-                    def mem_set(data):
-                        try:
-                            self.finish()
-                        except IOError:
-                            pass
-
-                    dumped = serialize_response(response)
-                    ccs.set(self.fingerprint, dumped, callback=mem_set)
-                else:
-                    try:
-                        self.finish()
-                    except IOError:
-                        pass
+                if not self._streamed:
+                    code, extra, body = response.code, (), response.body
+                    if self._range is not None and code == 200 and body is not None:
+                        code, extra, body = ranges.serve_range(
+                            self._range, self.request.headers.get('If-Range'),
+                            response.headers, body)
+                    self.set_status(client_status(code))
+                    for header in FORWARDED_HEADERS:
+                        v = response.headers.get(header)
+                        if v:
+                            self.set_header(header, v)
+                    for name, value in extra:
+                        self.set_header(name, value)
+                    if body:
+                        self._body.write(body)
+                if self._range is not None and response.code == 206:
+                    # Not sliced by us, so fetched upstream.
+                    length = ranges.total_length(response.headers.get('Content-Range'))
+                    if length is not None and length <= RANGE_CACHE_LIMIT:
+                        fetch_whole(self.fingerprint, self._vary, req, self.request.headers)
+                ttl = None
+                if not self._memcached and not self._coalesced and not self._rejected:
+                    entry = response_entry(response) if kept else None
+                    ttl = self._cache_ttl(entry, vary)
+                if ttl is not None:
+                    key = self._vary_key(vary)
+                    l1_store(key, entry, ttl)
+                    written = None
+                    if self._lease_held:
+                        # Other nodes wait for the value while the lease
+                        # exists, so it is released once the value is written.
+                        self._lease_held = False
+                        written = functools.partial(lease.release, self.fingerprint)
+                    writes.put(key, serialize_entry(entry), time=ttl, flags=MEMCACHED_FLAG,
+                               callback=written)
+                self._body.finish()
+                if PREFETCH and ttl is not None and entry['code'] == 200 and \
+                        'text/html' in response.headers.get('Content-Type', ''):
+                    get_prefetcher().page(req.url, self.request.headers, entry['body'])
 
 
         #http://www.squid-cache.org/Doc/config/read_timeout/ 15 min
@@ -172,32 +666,270 @@ class ProxyHandler(tornado.web.RequestHandler):
                                              method=self.request.method, body=self.request.body,
                                              headers=self.request.headers, follow_redirects=False,
                                              allow_nonstandard_methods=True,
-                                             connect_timeout=float(1 * 50), request_timeout=float(15 * 60),
+                                             connect_timeout=float(CONNECT_TIMEOUT[1]),
+                                             request_timeout=float(TOTAL_TIMEOUT[1]),
+                                             ca_certs=UPSTREAM_CA_CERTS,
         )
-        self.fingerprint = fingerprint_request(req, self.request.arguments)
+        headers = req.headers
+        if SERVE_RANGES and req.method == 'GET' and 'Range' in req.headers:
+            # Keyed like the whole object, ranges are sliced from it. Built
+            # anew: legacy keys hash the headers in dict order.
+            self._range = req.headers['Range']
+            headers = HTTPHeaders()
+            for name, value in req.headers.get_all():
+                if name not in ('Range', 'If-Range'):
+                    headers.add(name, value)
+        self.fingerprint = self._base_fingerprint = fingerprint_request(req, self.request.arguments,
+                                                                        headers)
+        self._vary = vary_names.get(self.fingerprint) or ()
+        if self._vary:
+            self.fingerprint = KEY_POLICY.variant(self.fingerprint, self._vary,
+                                                  self.request.headers)
+
+        origin = urlparse.urlsplit(req.url).netloc.lower()
+
+        def fetched(response):
+            if response.code == 599 or response.code in BREAKER_CODES:
+                breaker.failure(origin, is_timeout(response.error))
+            else:
+                breaker.success(origin)
+            handle_response(response)
+
+        def fetch():
+            if not breaker.allow(origin):
+                # Answered (and shared with followers) at once, but not cached.
+                self._rejected = True
+                handle_response(gateway_error(
+                    req, breaker.timed_out(origin), 'Not fetching %s, %s is failing'
+                    % (req.url, origin), breaker.retry_after(origin), self._vary))
+                return
+            if STREAM_RESPONSES:
+                self._streamed_fetch = True
+                req.header_callback = self._on_upstream_header
+                req.streaming_callback = self._on_upstream_chunk
+            client = tornado.httpclient.AsyncHTTPClient(max_clients=5000)
+            try:
+                if HEDGE_REQUESTS and req.method == 'GET' and \
+                        hasattr(client, 'fetch_connection'):
+                    HedgedFetch(hedging, client, req, fetched, origin).start()
+                else:
+                    client.fetch(req, fetched)
+            except tornado.httpclient.HTTPError, e:
+                if hasattr(e, 'response') and e.response:
+                    handle_response(e.response)
+                else:
+                    self.set_status(500)
+                    self.write('Internal server error:\n' + str(e))
+                    try:
+                        self.finish()
+                    except IOError:
+                        pass
 
-        def mem_get(dumped):
-            if not dumped:
-                client = tornado.httpclient.AsyncHTTPClient(max_clients=5000)
+        def mem_get(dumped, dictionary_fetched=False):
+            entry = response = None
+            vary = decode_vary(dumped) if dumped else None
+            if vary is not None:
+                if self.fingerprint == self._base_fingerprint:
+                    # Cached per variant by another process.
+                    vary_names.set(self._base_fingerprint, vary, 1)
+                    self._vary = vary
+                    lookup(KEY_POLICY.variant(self._base_fingerprint, vary,
+                                              self.request.headers))
+                    return
+                dumped = None
+            if dumped:
                 try:
-                    client.fetch(req, handle_response)
-                except tornado.httpclient.HTTPError, e:
-                    if hasattr(e, 'response') and e.response:
-                        self.handle_response(e.response)
-                    else:
-                        self.set_status(500)
-                        self.write('Internal server error:\n' + str(e))
-                        try:
-                            self.finish()
-                        except IOError:
-                            pass
+                    entry = decode_entry(dumped, dictionaries)
+                except UnknownDictionary, e:
+                    if not dictionary_fetched:
+                        # Written by another process, get its dictionary first.
+                        dictionaries.fetch(e.dictionary_id,
+                                           lambda dictionary: mem_get(dumped, True))
+                        return
+                    logging.warning('Ignoring unreadable cache entry for %s' % req.url)
+                except (ValueError, zlib.error):
+                    logging.warning('Ignoring unreadable cache entry for %s' % req.url)
+            if entry is not None:
+                response = entry_response(entry, req)
+                if not self._keyed_for(response):
+                    # Stored before its variants were told apart.
+                    response = None
+                elif not self._servable(entry, req):
+                    response = None
+            if response is None:
+                missed()
             else:
-                response = unserialize_response(dumped, req)
                 self._memcached = True
+                l1_store(self.fingerprint, entry)
                 handle_response(response)
                 #pdb.set_trace()
 
-        ccs.get(self.fingerprint, callback=mem_get)
+        def missed():
+            if PREFETCH and req.method == 'GET' and not self._prefetch_checked:
+                self._prefetch_checked = True
+                get_prefetcher().lookup(req.url, self.request.headers, prefetched)
+            elif DISTRIBUTED_LEASE and self._leading:
+                lease.acquire(self.fingerprint, leased)
+            else:
+                fetch()
+
+        def prefetched(entry):
+            if entry is None or freshness.state(entry) not in (freshness.FRESH,
+                                                               freshness.REFRESH):
+                missed()
+            else:
+                # Answered like a fetch, so it is cached under our key too.
+                handle_response(entry_response(entry, req))
+
+        def leased(won):
+            if won:
+                self._lease_held = True
+                fetch()
+            else:
+                lease.wait(self.fingerprint, waited)
+
+        def waited(dumped):
+            if dumped:
+                mem_get(dumped)
+            else:
+                fetch()
+
+        def coalesced(response):
+            if response is None:
+                # The leader could not keep its body for us, go upstream.
+                fetch()
+            else:
+                self._coalesced = True
+                handle_response(response)
+
+        def lookup(key):
+            if self._leading:
+                # Switching to a variant key, let the followers look it up too.
+                self._leading = False
+                coalescer.release(self.fingerprint, None)
+            self.fingerprint = key
+            entry = l1_cache.get(self.fingerprint)
+            if entry is not None:
+                response = entry_response(entry, req)
+                # Expired here may have been revalidated by another process.
+                if self._keyed_for(response) and self._servable(entry, req):
+                    self._memcached = True
+                    handle_response(response)
+                    return
+
+            if self.request.method in COALESCED_METHODS and self._range is None:
+                # A range fetched upstream is no answer for the others.
+                role = coalescer.join(self.fingerprint, coalesced)
+                if role == FOLLOWER:
+                    return
+                self._leading = role == LEADER
+            ccs.get(self.fingerprint, callback=mem_get)
+
+        lookup(self.fingerprint)
+
+    def _keyed_for(self, response):
+        """Whether the key this request looked up tells apart the variants of `response`."""
+        return KEY_POLICY.vary(response.headers.get('Vary')) == self._vary
+
+    def _servable(self, entry, req):
+        """Whether the cached `entry` may answer `req`, see freshness.Revalidator.serve."""
+        return revalidator.serve(self.fingerprint, req, entry,
+                                 functools.partial(revalidated, self.fingerprint, self._vary,
+                                                   self.request.headers))
+
+    def _cache_ttl(self, entry, vary):
+        """Seconds to keep the upstream response `entry` (None if its body
+        was not kept) in memcached, or None if it is not stored."""
+        if entry is None:
+            reason = 'size'
+        elif entry['code'] not in CACHED_CODES and entry['code'] not in NEGATIVE_CODES:
+            reason = 'status'
+        elif vary is None:
+            reason = 'vary'
+        elif entry['code'] == 304 and not (KEY_POLICY.hashes('If-None-Match') and
+                                           KEY_POLICY.hashes('If-Modified-Since')):
+            # A 304 has no body to serve to requests without the conditions.
+            reason = 'not_modified'
+        else:
+            return storage.ttl(self.request.headers, entry)
+        storage.skip(reason)
+        return None
+
+    def _vary_key(self, vary):
+        """The key to store a response varying on `vary` under; records the
+        variants (with a marker in memcached) if they are new."""
+        if vary == self._vary:
+            return self.fingerprint
+        self._vary = vary
+        if vary:
+            vary_names.set(self._base_fingerprint, vary, 1)
+            writes.put(self._base_fingerprint, encode_vary(vary), time=CACHE_MAX_TTL,
+                       flags=MEMCACHED_FLAG)
+            return KEY_POLICY.variant(self._base_fingerprint, vary, self.request.headers)
+        vary_names.delete(self._base_fingerprint)
+        return self._base_fingerprint
+
+    def _release(self):
+        if self._counted:
+            self._counted = False
+            ProxyHandler.in_flight -= 1
+        if self._ticket is not None:
+            admission.release(self._ticket)
+            self._ticket = None
+        if self._body is not None:
+            # Only gives up on a body not sent yet if the client went away:
+            # _body.finish() waits for it before finishing the request.
+            self._body.close()
+        self._drop_stream_chunks()
+
+    def _drop_stream_chunks(self):
+        if self._stream_chunks:
+            buffers.release(sum(len(chunk) for chunk in self._stream_chunks))
+        self._stream_chunks = None
+
+    def on_connection_close(self):
+        # finish() fails on a closed connection and on_finish is not called.
+        self._release()
+
+    def on_finish(self):
+        self._release()
+        if self._leading:
+            # Never leave followers waiting on a request that ended early.
+            self._leading = False
+            coalescer.release(self.fingerprint, None)
+        if self._lease_held:
+            # Nothing was cached, other nodes fetch themselves.
+            self._lease_held = False
+            lease.release(self.fingerprint)
+
+    def _on_upstream_header(self, line):
+        if line != '\r\n':
+            self._header_lines.append(line)
+            return
+        code = int(self._header_lines[0].split()[1])
+        headers = HTTPHeaders.parse(''.join(self._header_lines[1:]))
+        if code in (204, 304) or self.request.method == 'HEAD':
+            # Nothing to stream, handle_response sends it as usual.
+            return
+        self.set_status(client_status(code))
+        for header in FORWARDED_HEADERS:
+            v = headers.get(header)
+            if v:
+                self.set_header(header, v)
+        self._streamed = True
+        try:
+            self.flush()
+        except IOError:
+            pass
+
+    def _on_upstream_chunk(self, chunk):
+        if self._stream_chunks is not None:
+            self._stream_size += len(chunk)
+            if self._stream_size > CACHEABLE_SIZE_LIMIT or not buffers.reserve(len(chunk)):
+                self._drop_stream_chunks()
+            else:
+                self._stream_chunks.append(chunk)
+        self._body.write(chunk)
 
 
     @tornado.web.asynchronous
@@ -207,57 +939,171 @@ class ProxyHandler(tornado.web.RequestHandler):
     @tornado.web.asynchronous
     def connect(self):
         host, port = self.request.uri.split(':')
-        client = self.request.connection.stream
+        if MITM and int(port) in MITM_PORTS:
+            try:
+                context = get_certificate_authority().context(host)
+            except ValueError, e:
+                logging.warning('Tunnelling %s: %s' % (self.request.uri, e))
+            else:
+                # The decrypted requests come back to this application.
+                mitm.intercept(self.request.connection.stream, host, int(port), context,
+                               self.application, self.request.connection.address)
+                return
+        if tunnels.full():
+            self.set_status(503)
+            self.set_header('Retry-After', '1')
+            self.finish()
+            return
 
-        def read_from_client(data):
-            upstream.write(data)
+        def opened(error):
+            # On success the connection belongs to the tunnel, which already
+            # answered the CONNECT.
+            if error is not None:
+                self.set_status(502)
+                self.write('Could not connect to %s: %s' % (self.request.uri, error))
+                try:
+                    self.finish()
+                except IOError:
+                    pass
 
-        def read_from_upstream(data):
-            client.write(data)
+        tunnels.open(self.request.connection.stream, host, int(port), opened)
 
-        def client_close(data=None):
-            if upstream.closed():
-                return
-            if data:
-                upstream.write(data)
-            upstream.close()
 
-        def upstream_close(data=None):
-            if client.closed():
-                return
-            if data:
-                client.write(data)
-            client.close()
+class StatsHandler(tornado.web.RequestHandler):
+    """
+    Counters of this process as JSON, for ``GET /_stats`` sent to the proxy
+    itself. Proxied requests have absolute urls and never match.
+    """
+
+    def get(self):
+        tornado.httpclient.AsyncHTTPClient.configure(UPSTREAM_CLIENT, resolver=resolver,
+                                                     max_buffer_size=MAX_BUFFERED_BODY,
+                                                     memory_budget=buffers,
+                                                     timeouts=timeouts)
+        client = tornado.httpclient.AsyncHTTPClient(max_clients=5000)
+        pool = client.connection_pool
+        stats = {
+            'pid': os.getpid(),
+            'in_flight': ProxyHandler.in_flight,
+            'coalescer': coalescer.stats,
+            'lease': lease.stats,
+            'l1_cache': dict(l1_cache.stats, entries=len(l1_cache), bytes=l1_cache.bytes),
+            'tunnels': dict(tunnels.stats, open=tunnels.report()),
+            'dns': resolver.report(),
+            'freshness': revalidator.report(),
+            'writes': writes.report(),
+            'memcached': ccs.report(),
+            'storage': storage.report(),
+            'breaker': breaker.report(),
+            'admission': admission.report(),
+            'buffers': buffers.report(),
+            'hedging': hedging.report(),
+            'latency': latencies.report(),
+            'timeouts': timeouts.report(),
+        }
+        if prefetcher is not None:
+            stats['prefetch'] = prefetcher.report()
+        if certificate_authority is not None:
+            stats['mitm'] = certificate_authority.report()
+        if pool is not None:
+            stats['upstream_pool'] = dict(pool.stats, idle=len(pool),
+                                          reuse_rate=round(pool.reuse_rate(), 3))
+        stats['upstream_queue'] = client.queue.report()
+        self.write(stats)
 
-        def start_tunnel():
-            client.read_until_close(client_close, read_from_client)
-            upstream.read_until_close(upstream_close, read_from_upstream)
-            client.write('HTTP/1.0 200 Connection established\r\n\r\n')
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        upstream = tornado.iostream.IOStream(s)
-        upstream.connect((host, int(port)), start_tunnel)
+def make_app(debug=True):
+    return tornado.web.Application([
+                                       (r'/_stats', StatsHandler),
+                                       (r'.*', ProxyHandler),
+                                   ], debug=debug)
 
 
-def run_proxy(port, start_ioloop=True):
+def run_proxy(port, start_ioloop=True, processes=1):
     """
 Run proxy on the specified port. If start_ioloop is True (default),
 the tornado IOLoop will be started immediately.
+
+With processes > 1 a supervisor forks that many workers serving the port
+and this only returns once they stopped (see workers.Supervisor); the
+IOLoop is always started then. Every worker archives into its own
+subdirectory of one run directory, whose db_index/index.db merges the
+index of each worker once it exited, and is rebuilt from all of them when
+the supervisor exits.
 """
+    if MITM:
+        # Before forking, so that the workers share one CA.
+        get_certificate_authority()
+    if processes > 1:
+        run_workers(port, processes)
+        return
 
-    app = tornado.web.Application([
-                                      (r'.*', ProxyHandler),
-                                  ], debug=True)
+    app = make_app()
     app.listen(port)
+    if L1_SNAPSHOT:
+        l1_cache.load(L1_SNAPSHOT)
+        atexit.register(l1_cache.save, L1_SNAPSHOT)
+        # Exit through atexit on SIGTERM as well so the snapshot gets written.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     ioloop = tornado.ioloop.IOLoop.instance()
     if start_ioloop:
         ioloop.start()
 
 
+def run_workers(port, processes, outdir='result'):
+    from tornado_proxy import warc_httpclient
+
+    run_name = datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
+
+    def claim(hash_url, callback):
+        # The first worker to add the url's key archives it; if memcached
+        # cannot be asked, archiving twice beats not archiving.
+        key = 'warc:%s:%s' % (run_name, hash_url)
+        ccs.add(key, str(os.getpid()), time=WARC_CLAIM_TTL,
+                callback=lambda stored: callback(stored != 0))
+
+    def run_worker(index, sockets):
+        writer = warc_httpclient.WarcWriter(outdir, run_name=run_name,
+                                            worker=os.getpid(), claim=claim)
+        warc_httpclient.warc_writer = writer
+        snapshot = '%s.%d' % (L1_SNAPSHOT, index) if L1_SNAPSHOT else None
+        if snapshot:
+            l1_cache.load(snapshot)
+        server = tornado.httpserver.HTTPServer(make_app(debug=False))
+        server.add_sockets(sockets)
+        io_loop = tornado.ioloop.IOLoop.instance()
+
+        def drained():
+            if snapshot:
+                l1_cache.save(snapshot)
+            writer.close()
+
+        def stop(signum, frame):
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            io_loop.add_callback(lambda: workers.drain(
+                [server], lambda: ProxyHandler.in_flight, drained))
+
+        signal.signal(signal.SIGTERM, stop)
+        logging.info('Worker %d serving port %d' % (index, port))
+        io_loop.start()
+
+    def exited(pid):
+        # Merged right away, so that the run's index is complete even if
+        # the supervisor does not get to merge them all.
+        warc_httpclient.merge_indexes(os.path.join(outdir, run_name), ['worker-%d' % pid])
+
+    workers.Supervisor(processes, run_worker, port, on_exit=exited).run()
+    merged = warc_httpclient.merge_indexes(os.path.join(outdir, run_name))
+    logging.info('Merged worker indexes: %d urls archived' % merged)
+
+
 if __name__ == '__main__':
     port = 8888
     if len(sys.argv) > 1:
         port = int(sys.argv[1])
+    processes = 1
+    if len(sys.argv) > 2:
+        processes = int(sys.argv[2])
 
     print "Starting HTTP proxy on port %d" % port
-    run_proxy(port)
+    run_proxy(port, processes=processes)
@@ -0,0 +1,143 @@
+"""
+Byte range requests (RFC 7233) answered from whole cached bodies.
+
+    code, headers, body = serve_range(request.headers['Range'],
+                                      request.headers.get('If-Range'),
+                                      cached_headers, cached_body)
+
+gives the 206 answer with the requested slice and its Content-Range, or,
+for several ranges, a multipart/byteranges body with one part per range.
+A Range that is not a valid byte range, asks for more than `max_ranges`
+ranges, or comes with an If-Range that does not match the cached
+response's ETag or Last-Modified is answered with the whole body (200),
+and one that no byte of the body satisfies with 416. Overlapping and
+adjacent ranges are merged.
+
+`total_length` reads the size of the whole object from the Content-Range
+of a 206.
+"""
+import os
+
+MAX_RANGES = 16
+
+
+def parse_range(value, length, max_ranges=MAX_RANGES):
+    """The (first, last) byte positions asked for by the Range header
+    `value` of a body of `length` bytes, sorted and merged; [] if none is
+    satisfiable and None if the header is to be ignored."""
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, dash, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last) or not (first or '0').isdigit() or \
+                not (last or '0').isdigit():
+            return None
+        if not first:
+            # The last `last` bytes.
+            if int(last) and length:
+                ranges.append((max(0, length - int(last)), length - 1))
+            continue
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        if first < length:
+            ranges.append((first, min(int(last), length - 1) if last else length - 1))
+    if len(ranges) > max_ranges:
+        return None
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def if_range_matches(value, headers):
+    """Whether the If-Range `value` names the response with `headers`: its
+    strong ETag, or its Last-Modified date."""
+    value = value.strip()
+    if value.startswith(('"', 'W/')):
+        etag = headers.get('ETag')
+        return not value.startswith('W/') and etag is not None and etag.strip() == value
+    return headers.get('Last-Modified') == value
+
+
+def content_range(first, last, length):
+    return 'bytes %d-%d/%d' % (first, last, length)
+
+
+def total_length(value):
+    """The length of the whole object from a Content-Range `value`, or None."""
+    length = (value or '').rpartition('/')[2].strip()
+    return int(length) if length.isdigit() else None
+
+
+def multipart(ranges, body, content_type=None):
+    """The Content-Type and the multipart/byteranges body of `ranges` of `body`."""
+    boundary = os.urandom(12).encode('hex')
+    parts = []
+    for first, last in ranges:
+        parts.append('\r\n--%s\r\n' % boundary)
+        if content_type:
+            parts.append('Content-Type: %s\r\n' % content_type)
+        parts.append('Content-Range: %s\r\n\r\n' % content_range(first, last, len(body)))
+        parts.append(body[first:last + 1])
+    parts.append('\r\n--%s--\r\n' % boundary)
+    return 'multipart/byteranges; boundary=%s' % boundary, ''.join(parts)
+
+
+def serve_range(value, if_range, headers, body, max_ranges=MAX_RANGES):
+    """The (code, headers, body) answering the Range `value` (and If-Range
+    `if_range`, if any) from the whole response with `headers` and `body`.
+    `headers` are the ones to set on top of those of the whole response."""
+    if if_range and not if_range_matches(if_range, headers):
+        return 200, [], body
+    ranges = parse_range(value, len(body), max_ranges)
+    if ranges is None:
+        return 200, [], body
+    if not ranges:
+        return 416, [('Content-Range', 'bytes */%d' % len(body))], ''
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        return 206, [('Content-Range', content_range(first, last, len(body)))], \
+            body[first:last + 1]
+    content_type, data = multipart(ranges, body, headers.get('Content-Type'))
+    return 206, [('Content-Type', content_type)], data
+
+
+if __name__ == '__main__':
+    assert parse_range('bytes=0-4', 10) == [(0, 4)]
+    assert parse_range('bytes=5-', 10) == [(5, 9)] and parse_range('bytes=-3', 10) == [(7, 9)]
+    assert parse_range('bytes=8-20', 10) == [(8, 9)] and parse_range('bytes=-30', 10) == [(0, 9)]
+    assert parse_range('bytes=4-6, 0-1,2-3', 10) == [(0, 6)]
+    assert parse_range('bytes=10-', 10) == [] and parse_range('bytes=-0', 10) == []
+    assert parse_range('bytes=5-4', 10) is None and parse_range('items=0-1', 10) is None
+    assert parse_range('bytes=a-', 10) is None and parse_range('bytes=' + ','.join(
+        '%d-%d' % (i, i) for i in range(0, 40, 2)), 40) is None
+
+    body = '0123456789'
+    headers = {'ETag': '"v1"', 'Last-Modified': 'Tue, 01 Jan 2030 00:00:00 GMT',
+               'Content-Type': 'text/plain'}
+    assert serve_range('bytes=2-4', None, headers, body) == \
+        (206, [('Content-Range', 'bytes 2-4/10')], '234')
+    assert serve_range('bytes=2-4', '"v2"', headers, body) == (200, [], body)
+    assert serve_range('bytes=2-4', 'W/"v1"', headers, body)[0] == 200
+    assert serve_range('bytes=2-4', '"v1"', headers, body)[0] == 206
+    assert serve_range('bytes=2-4', headers['Last-Modified'], headers, body)[0] == 206
+    assert serve_range('bytes=20-', None, headers, body) == \
+        (416, [('Content-Range', 'bytes */10')], '')
+    code, extra, data = serve_range('bytes=0-0,-2', None, headers, body)
+    boundary = extra[0][1].partition('boundary=')[2]
+    assert code == 206 and extra[0][1].startswith('multipart/byteranges; boundary=')
+    assert data == ('\r\n--%(b)s\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-0/10'
+                    '\r\n\r\n0\r\n--%(b)s\r\nContent-Type: text/plain\r\n'
+                    'Content-Range: bytes 8-9/10\r\n\r\n89\r\n--%(b)s--\r\n' % {'b': boundary})
+    assert total_length('bytes 0-99/1234') == 1234 and total_length('bytes 0-99/*') is None
+    print 'ok'
@@ -0,0 +1,234 @@
+"""
+Hostname resolution off the IOLoop.
+
+``socket.getaddrinfo`` blocks, and while it waits on a slow DNS server no
+other connection of the process is served. A `Resolver` runs the lookups
+in a small pool of threads and hands the answers back to the IOLoop:
+
+    resolver = Resolver(threads=10, ttl=300, negative_ttl=30)
+    resolver.resolve('example.com', callback)   # callback(address, error)
+
+Answers are cached for `ttl` seconds and failures for `negative_ttl`
+seconds, in an LRU of at most `max_names` names. The system resolver does
+not tell the record TTLs, so these are fixed. Concurrent lookups of one
+name share a single query. If a query takes longer than `timeout` seconds
+its callers get an error, which is cached until the thread completes the
+query after all.
+
+`CachedNames` lets a ``SimpleAsyncHTTPClient`` use the cached answers as
+its ``hostname_mapping``, so it only ever calls getaddrinfo with an
+address, which does not block.
+
+`stats` counts hits, misses, negative hits, coalesced lookups, failures
+and timeouts, and the number and total and longest duration of queries.
+"""
+import Queue
+import functools
+import socket
+import threading
+import time
+
+from tornado import ioloop
+from tornado import stack_context
+
+from lrucache import LRUCache
+
+
+def is_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except socket.error:
+            pass
+    return False
+
+
+class Resolver(object):
+    def __init__(self, threads=10, max_names=10000, ttl=300, negative_ttl=30,
+                 timeout=10, family=socket.AF_INET, io_loop=None):
+        self.threads = threads
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.family = family
+        self._io_loop = io_loop
+        self.cache = LRUCache(max_names, max_entry_bytes=1)  # one "byte" per name
+        self.pending = {}  # host -> callbacks waiting for its query
+        self._timeouts = {}
+        self._queries = Queue.Queue()
+        self._workers = []
+        self.stats = {}
+
+    @property
+    def io_loop(self):
+        # Resolved late, see MemcacheLease.io_loop.
+        return self._io_loop or ioloop.IOLoop.instance()
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def cached(self, host):
+        """The cached (address, error) answer for `host`, or None."""
+        if is_address(host):
+            return host, None
+        return self.cache.get(host, touch=False)
+
+    def resolve(self, host, callback):
+        """Calls `callback(address, error)`, right away if the answer is cached.
+
+        `address` is the first address of `host`, or None with a message
+        in `error` if it could not be resolved.
+        """
+        host = host.lower()
+        if is_address(host):
+            callback(host, None)
+            return
+        answer = self.cache.get(host)
+        if answer is not None:
+            self._statlog('negative_hits' if answer[1] else 'hits')
+            callback(*answer)
+            return
+        callback = stack_context.wrap(callback)
+        if host in self.pending:
+            self._statlog('coalesced')
+            self.pending[host].append(callback)
+            return
+        self._statlog('misses')
+        self.pending[host] = [callback]
+        if self.timeout:
+            with stack_context.NullContext():
+                self._timeouts[host] = self.io_loop.add_timeout(
+                    time.time() + self.timeout, functools.partial(self._timed_out, host))
+        self._start_workers()
+        self._queries.put((host, time.time()))
+
+    def _start_workers(self):
+        # Started on first use, so that forked workers start their own.
+        while len(self._workers) < self.threads:
+            worker = threading.Thread(target=self._work, name='resolver')
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            host, queued = self._queries.get()
+            address = error = None
+            try:
+                address = socket.getaddrinfo(host, None, self.family,
+                                             socket.SOCK_STREAM)[0][4][0]
+            except Exception, e:
+                error = str(e) or e.__class__.__name__
+            self.io_loop.add_callback(functools.partial(self._done, host, queued,
+                                                        address, error))
+
+    def _done(self, host, queued, address, error):
+        duration = time.time() - queued
+        self._statlog('queries')
+        self._statlog('query_seconds', duration)
+        self.stats['query_max'] = max(self.stats.get('query_max', 0), duration)
+        if error:
+            self._statlog('failures')
+        self.cache.set(host, (address, error), 1,
+                       ttl=self.negative_ttl if error else self.ttl)
+        timeout = self._timeouts.pop(host, None)
+        if timeout is not None:
+            self.io_loop.remove_timeout(timeout)
+        for callback in self.pending.pop(host, ()):
+            callback(address, error)
+
+    def _timed_out(self, host):
+        self._timeouts.pop(host, None)
+        callbacks = self.pending.pop(host, ())
+        if callbacks:
+            self._statlog('timeouts')
+        # Cached like a failure until the query completes after all.
+        error = 'DNS lookup of %s timed out' % host
+        self.cache.set(host, (None, error), 1, ttl=self.negative_ttl)
+        for callback in callbacks:
+            callback(None, error)
+
+    def report(self):
+        queries = self.stats.get('queries', 0)
+        return dict(self.stats, names=len(self.cache), pending=len(self.pending),
+                    query_avg=self.stats.get('query_seconds', 0) / queries if queries else 0)
+
+
+class CachedNames(object):
+    """A ``hostname_mapping`` for ``SimpleAsyncHTTPClient`` answering from
+    the cache of `resolver`; names that failed to resolve raise the error."""
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    def get(self, host, default=None):
+        answer = self.resolver.cached(host.lower())
+        if answer is None:
+            return default
+        address, error = answer
+        if error:
+            raise socket.gaierror(error)
+        return address
+
+
+if __name__ == '__main__':
+    loop = ioloop.IOLoop.instance()
+    lookups = []
+    answer = threading.Event()
+    real_getaddrinfo = socket.getaddrinfo
+
+    def getaddrinfo(host, *args):
+        lookups.append(host)
+        answer.wait()
+        if host == 'nowhere.test':
+            raise socket.gaierror(-2, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.0.2.1', 0))]
+
+    socket.getaddrinfo = getaddrinfo
+    resolver = Resolver(threads=1, timeout=0.2, io_loop=loop)
+    answers = []
+
+    def resolve(host):
+        resolver.resolve(host, lambda address, error: answers.append((host, address, error)))
+
+    def run(seconds):
+        loop.add_timeout(time.time() + seconds, loop.stop)
+        loop.start()
+
+    resolve('192.0.2.9')
+    assert answers == [('192.0.2.9', '192.0.2.9', None)] and not lookups
+    resolve('example.test')
+    resolve('EXAMPLE.test')                  # shares the query
+    resolve('nowhere.test')
+    answer.set()
+    run(0.1)
+    assert sorted(lookups) == ['example.test', 'nowhere.test'], lookups
+    assert answers[1:3] == [('example.test', '192.0.2.1', None),
+                            ('EXAMPLE.test', '192.0.2.1', None)], answers
+    assert answers[3][:2] == ('nowhere.test', None) and answers[3][2], answers
+    resolve('nowhere.test')                  # failure is cached
+    resolve('example.test')
+    assert answers[4][:2] == ('nowhere.test', None) and answers[5][1] == '192.0.2.1'
+    assert len(lookups) == 2
+    names = CachedNames(resolver)
+    assert names.get('Example.test') == '192.0.2.1' and names.get('other.test') is None
+    try:
+        names.get('nowhere.test')
+        raise AssertionError('nowhere.test resolved')
+    except socket.gaierror:
+        pass
+
+    # A query that does not finish in time fails its callers.
+    answer.clear()
+    resolve('slow.test')
+    run(0.3)
+    assert answers[6][:2] == ('slow.test', None) and 'timed out' in answers[6][2], answers
+    answer.set()
+    run(0.1)
+    assert len(answers) == 7 and resolver.cached('slow.test')[0] == '192.0.2.1'
+    socket.getaddrinfo = real_getaddrinfo
+    report = resolver.report()
+    assert (report['misses'], report['coalesced'], report['hits'], report['negative_hits'],
+            report['failures'], report['timeouts'], report['queries']) == (3, 1, 1, 1, 1, 1, 3), report
+    print 'ok'
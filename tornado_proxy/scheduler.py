@@ -0,0 +1,209 @@
+"""
+Per-origin fair queueing of upstream requests.
+
+A single FIFO in front of the client's connections lets one slow site
+with thousands of queued assets hold up every other site. A `FairQueue`
+keeps a queue per origin and priority class instead and hands out
+requests round-robin between the origins, highest class first, with at
+most `max_per_host` requests to the same origin running at once:
+
+    queue = FairQueue(max_per_host=16)
+    queue.append((request, callback))
+    item = queue.pop()                # None if nothing can be started now
+    queue.started(request)            # once it is sent ...
+    queue.finished(request)           # ... and once it is done
+
+`priority(request)` puts page loads (DOCUMENT, they Accept text/html)
+ahead of other requests (DEFAULT), those ahead of images, audio and video
+(MEDIA), and all of them ahead of speculative requests (PREFETCH, marked
+with a true ``prefetch`` attribute, see prefetch).
+
+`report` has the queued and started counts per class, the current queue
+length and the average and longest queue wait, overall and for the
+`max_hosts` origins that waited longest.
+"""
+import collections
+import time
+import urlparse
+
+DOCUMENT = 0
+DEFAULT = 1
+MEDIA = 2
+PREFETCH = 3
+PRIORITY_NAMES = ('document', 'default', 'media', 'prefetch')
+
+MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.bmp', '.ico',
+                    '.svg', '.mp4', '.webm', '.ogv', '.mov', '.mp3', '.ogg', '.wav', '.m4a')
+MEDIA_TYPES = ('image/', 'video/', 'audio/')
+
+
+def host_of(request):
+    return urlparse.urlsplit(request.url).netloc.lower()
+
+
+def priority(request):
+    if getattr(request, 'prefetch', False):
+        return PREFETCH
+    accept = request.headers.get('Accept', '') if request.headers else ''
+    if 'text/html' in accept:
+        return DOCUMENT
+    if accept.startswith(MEDIA_TYPES) or \
+            urlparse.urlsplit(request.url).path.lower().endswith(MEDIA_EXTENSIONS):
+        return MEDIA
+    return DEFAULT
+
+
+class _HostWaits(object):
+    __slots__ = ('waited', 'seconds', 'longest')
+
+    def __init__(self):
+        self.waited = 0
+        self.seconds = 0.0
+        self.longest = 0.0
+
+
+class FairQueue(object):
+    def __init__(self, max_per_host=16, max_hosts=10000):
+        self.max_per_host = max_per_host
+        self.max_hosts = max_hosts
+        self.queues = {}  # (priority, host) -> deque of (request, callback, queued_at)
+        # Per priority, the hosts to serve in turn. A host is in `ready`
+        # while it has requests of that priority queued; it may have since
+        # reached max_per_host, `pop` drops it then and `finished` puts it
+        # back.
+        self.ready = [collections.deque() for name in PRIORITY_NAMES]
+        self._ready = set()  # (priority, host) in ready
+        self.active = {}  # host -> requests running
+        self.length = 0
+        self.waits = collections.OrderedDict()  # host -> _HostWaits, least recent first
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def __len__(self):
+        return self.length
+
+    def can_start(self, request):
+        """Whether `request` could go ahead of the queue right now."""
+        host = host_of(request)
+        return self.active.get(host, 0) < self.max_per_host and \
+            not any((p, host) in self.queues for p in xrange(len(PRIORITY_NAMES)))
+
+    def append(self, item):
+        request = item[0]
+        p = priority(request)
+        host = host_of(request)
+        self.queues.setdefault((p, host), collections.deque()).append(item + (time.time(),))
+        self.length += 1
+        self._statlog('queued_' + PRIORITY_NAMES[p])
+        self._make_ready(p, host)
+
+    def _make_ready(self, p, host):
+        if (p, host) not in self._ready:
+            self._ready.add((p, host))
+            self.ready[p].append(host)
+
+    def pop(self):
+        """The next (request, callback) to send, or None."""
+        for p, hosts in enumerate(self.ready):
+            while hosts:
+                host = hosts.popleft()
+                queue = self.queues.get((p, host))
+                if queue is None or self.active.get(host, 0) >= self.max_per_host:
+                    self._ready.discard((p, host))
+                    continue
+                request, callback, queued_at = queue.popleft()
+                if queue:
+                    hosts.append(host)
+                else:
+                    del self.queues[(p, host)]
+                    self._ready.discard((p, host))
+                self.length -= 1
+                self._waited(host, time.time() - queued_at)
+                return request, callback
+        return None
+
+    def _waited(self, host, seconds):
+        self._statlog('wait_seconds', seconds)
+        self.stats['wait_max'] = max(self.stats.get('wait_max', 0), seconds)
+        waits = self.waits.pop(host, None)
+        if waits is None:
+            waits = _HostWaits()
+            if len(self.waits) >= self.max_hosts:
+                self.waits.popitem(last=False)
+        waits.waited += 1
+        waits.seconds += seconds
+        waits.longest = max(waits.longest, seconds)
+        self.waits[host] = waits
+
+    def started(self, request):
+        host = host_of(request)
+        self.active[host] = self.active.get(host, 0) + 1
+        self._statlog('started')
+
+    def finished(self, request):
+        host = host_of(request)
+        left = self.active[host] - 1
+        if left:
+            self.active[host] = left
+        else:
+            del self.active[host]
+        for p in xrange(len(PRIORITY_NAMES)):
+            if (p, host) in self.queues:
+                self._make_ready(p, host)
+
+    def report(self, max_hosts=20):
+        started = self.stats.get('started', 0)
+        slowest = sorted(self.waits.iteritems(), key=lambda (host, waits): -waits.seconds)
+        hosts = {}
+        for host, waits in slowest[:max_hosts]:
+            hosts[host] = {'waited': waits.waited, 'longest': round(waits.longest, 3),
+                           'wait_avg': round(waits.seconds / waits.waited, 3),
+                           'queued': sum(len(self.queues.get((p, host), ()))
+                                         for p in xrange(len(PRIORITY_NAMES))),
+                           'active': self.active.get(host, 0)}
+        return dict(self.stats, queue=self.length, hosts_active=len(self.active),
+                    wait_avg=round(self.stats.get('wait_seconds', 0) / started, 3)
+                    if started else 0,
+                    hosts=hosts)
+
+
+if __name__ == '__main__':
+    class Request(object):
+        def __init__(self, url, accept=''):
+            self.url = url
+            self.headers = {'Accept': accept}
+
+    queue = FairQueue(max_per_host=2)
+    slow = [Request('http://slow.example/a%d.js' % i) for i in range(5)]
+    for request in slow:
+        queue.append((request, None))
+    queue.append((Request('http://other.example/b.png'), None))
+    queue.append((Request('http://other.example/page', 'text/html,*/*'), None))
+    guess = Request('http://third.example/app.js', 'text/html,*/*')
+    guess.prefetch = True
+    queue.append((guess, None))
+    assert len(queue) == 8 and not queue.can_start(Request('http://other.example/c'))
+    order = []
+    while True:
+        item = queue.pop()
+        if item is None:
+            break
+        queue.started(item[0])
+        order.append(item[0].url)
+    # The page first, then round-robin, images, then prefetches; slow.example stops at 2.
+    assert order == ['http://other.example/page', 'http://slow.example/a0.js',
+                     'http://slow.example/a1.js', 'http://other.example/b.png',
+                     'http://third.example/app.js'], order
+    queue.finished(slow[0])
+    item = queue.pop()
+    assert item[0] is slow[2]
+    queue.started(item[0])
+    assert queue.pop() is None
+    report = queue.report()
+    assert report['queue'] == 2 and report['hosts']['slow.example']['queued'] == 2
+    assert report['queued_document'] == 1 and report['queued_media'] == 1
+    assert report['queued_prefetch'] == 1
+    assert queue.can_start(Request('http://new.example/'))
+    print 'ok'
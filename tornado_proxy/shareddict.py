@@ -0,0 +1,255 @@
+"""
+Shared-dictionary compression for cached text responses.
+
+Per-object zlib cannot exploit what the pages of one site, or all CSS
+files, have in common. A `Dictionary` is up to 32KB of such common content
+that is run through deflate ahead of every body it compresses, so matches
+against it cost a back-reference instead of literals.
+
+Python 2's zlib has no ``zdict`` argument, so the preset dictionary is
+emulated: one compressor and one decompressor are primed with the
+dictionary, and every body is (de)compressed with a ``copy()`` of them.
+Only the bytes after the primed prefix are stored.
+
+`DictionaryRegistry` samples cacheable bodies per group (content type, or
+content type and host), builds dictionaries from segments that recur
+across samples, publishes them to memcached under ``zdict:<id>`` so other
+processes and nodes can decode the entries, and keeps per-group ratios.
+
+Run this module with WARC files as arguments to report the ratios that
+shared dictionaries would achieve on already archived responses.
+"""
+import collections
+import hashlib
+import logging
+import re
+import struct
+import zlib
+
+# Deflate can only refer back 32KB, older dictionary bytes are useless.
+DICTIONARY_SIZE = 32 * 1024
+
+TEXT_TYPES = ('text/', 'application/javascript', 'application/x-javascript',
+              'application/json', 'application/xml', 'application/xhtml+xml',
+              'image/svg+xml')
+
+SEGMENT = re.compile(r'[^\n>;}]{1,256}[\n>;}]?')
+MIN_SEGMENT = 8
+MIN_DICTIONARY_SIZE = 256
+
+
+class UnknownDictionary(ValueError):
+    def __init__(self, dictionary_id):
+        ValueError.__init__(self, 'Unknown compression dictionary %08x' % dictionary_id)
+        self.dictionary_id = dictionary_id
+
+
+class Dictionary(object):
+    def __init__(self, data, level=6):
+        self.data = data[-DICTIONARY_SIZE:]
+        self.id = struct.unpack('!I', hashlib.sha1(self.data).digest()[:4])[0]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        prefix = compressor.compress(self.data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        decompressor.decompress(prefix)
+        self._compressor = compressor
+        self._decompressor = decompressor
+
+    def compress(self, body):
+        compressor = self._compressor.copy()
+        return compressor.compress(body) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+def build_dictionary(samples, size=DICTIONARY_SIZE):
+    """Picks the segments that recur across `samples`, worth the most bytes first.
+
+    The most valuable segments end up last, closest to the data that will
+    refer to them.
+    """
+    counts = collections.defaultdict(int)
+    for body in samples:
+        for segment in set(SEGMENT.findall(body)):
+            if len(segment) >= MIN_SEGMENT:
+                counts[segment] += 1
+    scored = sorted((n * len(segment), segment)
+                    for segment, n in counts.iteritems() if n > 1)
+    picked = []
+    total = 0
+    for score, segment in reversed(scored):
+        if total + len(segment) > size:
+            continue
+        picked.append(segment)
+        total += len(segment)
+    picked.reverse()
+    return ''.join(picked)
+
+
+def is_text(content_type):
+    return (content_type or '').lower().startswith(TEXT_TYPES)
+
+
+def host_of(url):
+    rest = url.partition('://')[2]
+    return rest.partition('/')[0].lower()
+
+
+class DictionaryRegistry(object):
+    def __init__(self, client=None, by_host=False, min_samples=20,
+                 max_sample_bytes=1024 * 1024, rebuild_after=1000,
+                 max_dictionaries=256, level=6, prefix='zdict:'):
+        self.client = client
+        self.by_host = by_host
+        self.min_samples = min_samples
+        self.max_sample_bytes = max_sample_bytes
+        self.rebuild_after = rebuild_after
+        self.max_dictionaries = max_dictionaries
+        self.level = level
+        self.prefix = prefix
+        self.dictionaries = collections.OrderedDict()
+        self.current = {}
+        self.samples = collections.defaultdict(collections.deque)
+        self.sample_bytes = collections.defaultdict(int)
+        self.since_build = collections.defaultdict(int)
+        self.ratios = collections.defaultdict(lambda: {'entries': 0, 'raw': 0, 'stored': 0})
+
+    def group(self, entry):
+        content_type = None
+        for name, value in entry['headers']:
+            if name.lower() == 'content-type':
+                content_type = value
+        if not is_text(content_type):
+            return None
+        group = content_type.split(';')[0].strip().lower()
+        if self.by_host:
+            group = '%s %s' % (host_of(entry['effective_url'] or ''), group)
+        return group
+
+    def for_entry(self, entry):
+        """Returns the dictionary to compress `entry` with, if its group has one."""
+        group = self.group(entry)
+        if group is None:
+            return None
+        return self.current.get(group)
+
+    def get(self, dictionary_id):
+        return self.dictionaries.get(dictionary_id)
+
+    def record(self, entry, raw_size, stored_size):
+        group = self.group(entry) or 'other'
+        ratio = self.ratios[group]
+        ratio['entries'] += 1
+        ratio['raw'] += raw_size
+        ratio['stored'] += stored_size
+
+    def sample(self, entry):
+        """Keeps the body of a cacheable entry and (re)builds its group's dictionary."""
+        group = self.group(entry)
+        body = entry['body']
+        if group is None or not body:
+            return
+        samples = self.samples[group]
+        samples.append(body[:64 * 1024])
+        self.sample_bytes[group] += len(samples[-1])
+        while self.sample_bytes[group] > self.max_sample_bytes and len(samples) > 1:
+            self.sample_bytes[group] -= len(samples.popleft())
+        self.since_build[group] += 1
+        wait = self.rebuild_after if group in self.current else self.min_samples
+        if len(samples) < self.min_samples or self.since_build[group] < wait:
+            return
+        self.since_build[group] = 0
+        data = build_dictionary(samples)
+        if len(data) < MIN_DICTIONARY_SIZE:
+            return
+        dictionary = Dictionary(data, self.level)
+        self.add(dictionary)
+        self.current[group] = dictionary
+        logging.info('Built %d byte compression dictionary %08x for %s'
+                     % (len(dictionary.data), dictionary.id, group))
+
+    def add(self, dictionary, publish=True):
+        self.dictionaries[dictionary.id] = dictionary
+        while len(self.dictionaries) > self.max_dictionaries:
+            self.dictionaries.popitem(last=False)
+        if publish and self.client is not None:
+            self.client.set(self.prefix + '%08x' % dictionary.id, dictionary.data,
+                            callback=lambda stored: None)
+
+    def fetch(self, dictionary_id, callback):
+        """Loads a dictionary published by another process from memcached.
+
+        Calls `callback(dictionary)`, with None if it is not there.
+        """
+        if self.client is None:
+            callback(None)
+            return
+
+        def got(data):
+            dictionary = Dictionary(data, self.level) if data else None
+            if dictionary is not None and dictionary.id == dictionary_id:
+                self.add(dictionary, publish=False)
+            else:
+                dictionary = None
+            callback(dictionary)
+
+        self.client.get(self.prefix + '%08x' % dictionary_id, callback=got)
+
+    def report(self):
+        """Returns (group, entries, raw bytes, stored bytes, ratio) rows."""
+        rows = []
+        for group, ratio in sorted(self.ratios.iteritems()):
+            rows.append((group, ratio['entries'], ratio['raw'], ratio['stored'],
+                         float(ratio['raw']) / max(ratio['stored'], 1)))
+        return rows
+
+
+if __name__ == '__main__':
+    # Reports what plain zlib and shared dictionaries achieve on the text
+    # responses of the given WARC files: dictionaries are built from every
+    # other response of a group and measured on the remaining ones.
+    import sys
+    import os
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import warc
+
+    if len(sys.argv) < 2:
+        print 'usage: %s [--by-host] file.warc.gz...' % sys.argv[0]
+        sys.exit(1)
+    args = sys.argv[1:]
+    by_host = '--by-host' in args
+    args = [a for a in args if a != '--by-host']
+
+    registry = DictionaryRegistry(by_host=by_host)
+    groups = collections.defaultdict(list)
+    for fname in args:
+        for record in warc.open(fname):
+            if record.type != 'response':
+                continue
+            payload = record.payload.read()
+            head, _, body = payload.partition('\n\r\n')
+            headers = []
+            for line in head.split('\n')[1:]:
+                name, _, value = line.partition(':')
+                headers.append((name.strip(), value.strip()))
+            entry = {'headers': headers, 'body': body, 'effective_url': record.url}
+            group = registry.group(entry)
+            if group and body:
+                groups[group].append(body)
+
+    print '%-40s %7s %12s %12s %12s %8s %8s' % (
+        'group', 'entries', 'raw', 'zlib', 'zdict', 'zlib x', 'zdict x')
+    for group, bodies in sorted(groups.iteritems()):
+        train, test = bodies[::2], bodies[1::2]
+        if not test:
+            continue
+        data = build_dictionary(train)
+        dictionary = Dictionary(data) if data else None
+        raw = sum(len(b) for b in test)
+        plain = sum(len(zlib.compress(b, 6)) for b in test)
+        shared = sum(len(dictionary.compress(b)) for b in test) if dictionary else plain
+        print '%-40s %7d %12d %12d %12d %8.2f %8.2f' % (
+            group[:40], len(test), raw, plain, shared,
+            float(raw) / max(plain, 1), float(raw) / max(shared, 1))
@@ -0,0 +1,94 @@
+"""
+Upstream timeouts that follow each origin's recent latencies.
+
+A fixed connect timeout of 50 seconds and request timeout of 15 minutes
+lets a dead origin hold a connection, and a slot of its per-origin limit,
+for minutes, though it usually answers in milliseconds. `AdaptiveTimeouts`
+keeps the recent connect, first byte (request sent to response headers)
+and total times of every origin and derives its timeouts from them:
+
+    timeouts = AdaptiveTimeouts(quantile=0.99, factor=3)
+    timeouts.record(host, 'connect', seconds)
+    connect, first_byte, total = timeouts.get(host)
+    total = max(total, timeouts.body_time(content_length))   # once the headers are in
+
+Each timeout is `factor` times the `quantile` of the origin's samples,
+kept between the (floor, ceiling) given for it; an origin with fewer than
+`min_samples` gets the ceilings. Since a large body can take longer than
+anything the origin sent before, a response announcing `length` bytes may
+take `body_time(length)` at `min_rate` bytes per second.
+
+Only answered requests are sampled: a timeout says little about how long
+the origin would have taken.
+
+`report` has the timeouts that fired per phase and the current timeouts
+and samples of the `max_hosts` origins seen most recently.
+"""
+from latency import LatencyTracker
+
+PHASES = ('connect', 'first_byte', 'total')
+
+
+class AdaptiveTimeouts(object):
+    def __init__(self, quantile=0.99, factor=3, connect=(1, 50), first_byte=(5, 300),
+                 total=(30, 15 * 60), min_rate=16 * 1024, samples=64, min_samples=20,
+                 max_hosts=10000):
+        self.quantile = quantile
+        self.factor = factor
+        self.bounds = dict(zip(PHASES, (connect, first_byte, total)))
+        self.min_rate = min_rate
+        self.latencies = dict((phase, LatencyTracker(samples, min_samples, max_hosts))
+                              for phase in PHASES)
+        self.stats = {}
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def record(self, host, phase, seconds):
+        self.latencies[phase].record(host, seconds)
+
+    def timed_out(self, phase):
+        self._statlog(phase + '_timeouts')
+
+    def timeout(self, host, phase):
+        floor, ceiling = self.bounds[phase]
+        q = self.latencies[phase].quantile(host, self.quantile)
+        if q is None:
+            return ceiling
+        return min(ceiling, max(floor, q * self.factor))
+
+    def get(self, host):
+        """The (connect, first_byte, total) timeouts for `host`, in seconds."""
+        return tuple(self.timeout(host, phase) for phase in PHASES)
+
+    def body_time(self, length):
+        """Seconds a body of `length` bytes may take to arrive."""
+        return length / float(self.min_rate)
+
+    def report(self, max_hosts=100):
+        recent = self.latencies['total'].report(max_hosts)['hosts']
+        hosts = {}
+        for host in recent:
+            hosts[host] = dict(zip(PHASES, (round(t, 3) for t in self.get(host))),
+                               samples=recent[host]['samples'])
+        return dict(self.stats, quantile=self.quantile, factor=self.factor,
+                    tracked=len(self.latencies['total'].hosts), hosts=hosts)
+
+
+if __name__ == '__main__':
+    timeouts = AdaptiveTimeouts(connect=(1, 50), first_byte=(5, 300), total=(30, 900),
+                                min_rate=1000, min_samples=10)
+    assert timeouts.get('a') == (50, 300, 900)
+    for i in range(20):
+        timeouts.record('a', 'connect', 0.01)
+        timeouts.record('a', 'first_byte', 4)
+        timeouts.record('a', 'total', 20 + i)
+    connect, first_byte, total = timeouts.get('a')
+    assert connect == 1 and first_byte == 12 and round(total, 3) == 117, timeouts.get('a')
+    assert timeouts.get('b') == (50, 300, 900)
+    assert timeouts.body_time(100000) == 100
+    timeouts.timed_out('first_byte')
+    report = timeouts.report()
+    assert report['first_byte_timeouts'] == 1 and report['hosts']['a']['connect'] == 1
+    assert report['hosts']['a']['samples'] == 20
+    print 'ok'
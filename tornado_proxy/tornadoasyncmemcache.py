@@ -33,9 +33,22 @@ Example using ClientPool
       application.listen(8888)
       tornado.ioloop.IOLoop.instance().start()
 
+Timeouts and dead servers
+========
+
+With C{timeout} set, a pool answers operations that take longer with
+C{None} (a miss, or a failed storage command) and drops the connection
+they were sent on. A server is marked dead when connecting to it fails or
+C{dead_after} operations in a row time out. While every server is dead,
+operations are answered with C{None} right away without touching the
+network ("bypassed", counted per command in C{stats}). Every
+C{dead_retry} seconds a health check connects to a dead server and asks
+for its version; the server is used again once it answers.
+
 """
 import weakref
 import sys
+import logging
 import socket
 import time
 import types
@@ -61,13 +74,16 @@ class TooManyClients(Exception):
 
 
 class ClientPool(object):
-    CMDS = ('get', 'replace', 'set', 'decr', 'incr', 'delete')
+    CMDS = ('get', 'add', 'replace', 'set', 'set_multi', 'decr', 'incr', 'delete')
 
     def __init__(self,
                  servers,
                  mincached=0,
                  maxcached=0,
                  maxclients=0,
+                 timeout=None,
+                 dead_after=3,
+                 dead_retry=30,
                  *args, **kwargs):
 
         assert isinstance(mincached, int)
@@ -80,11 +96,18 @@ class ClientPool(object):
             assert maxcached >= mincached
 
         self._servers = servers
+        self.timeout = timeout
+        self.dead_after = dead_after
+        # Shared by the clients, so that all of them skip a dead server.
+        self.health = dict((server, HostHealth(server, retry=dead_retry))
+                           for server in servers)
+        kwargs['health'] = self.health
         self._args, self._kwargs = args, kwargs
         self._used = collections.deque()
         self._maxclients = maxclients
         self._mincached = mincached
         self._maxcached = maxcached
+        self.stats = {}
 
         self._clients = collections.deque(self._create_clients(mincached))
 
@@ -93,15 +116,34 @@ class ClientPool(object):
         return [Client(self._servers, *self._args, **self._kwargs)
                 for x in xrange(n)]
 
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def alive(self):
+        """Whether any server of the pool is usable."""
+        return any(health.alive() for health in self.health.itervalues())
+
     def _do(self, cmd, *args, **kwargs):
+        if not self.alive():
+            self._statlog('bypassed_' + cmd)
+            kwargs['callback'](None)
+            return
         if not self._clients:
             if self._maxclients > 0 and (len(self._clients)
                                              + len(self._used) >= self._maxclients):
-                raise TooManyClients("Max of %d clients is already reached"
-                                     % self._maxclients)
+                # Treated like a dead server rather than raised into the
+                # caller: a cache that is too busy is a miss.
+                self._statlog('overloaded_' + cmd)
+                kwargs['callback'](None)
+                return
             self._clients.append(self._create_clients(1)[0])
         c = self._clients.popleft()
-        kwargs['callback'] = partial(self._gen_cb, c=c, _cb=kwargs['callback'])
+        state = {'timeout': None, 'done': False}
+        if self.timeout:
+            state['timeout'] = c.io_loop.add_timeout(
+                time.time() + self.timeout,
+                partial(self._timed_out, c=c, _cb=kwargs['callback'], state=state))
+        kwargs['callback'] = partial(self._gen_cb, c=c, _cb=kwargs['callback'], state=state)
         self._used.append(c)
         getattr(c, cmd)(*args, **kwargs)
 
@@ -111,7 +153,14 @@ class ClientPool(object):
         raise AttributeError("'%s' object has no attribute '%s'" %
                              (self.__class__.__name__, name))
 
-    def _gen_cb(self, response, c, _cb, *args, **kwargs):
+    def _gen_cb(self, response, c, _cb, state, *args, **kwargs):
+        if state['done']:
+            return
+        state['done'] = True
+        if state['timeout'] is not None:
+            c.io_loop.remove_timeout(state['timeout'])
+        if c.last_server is not None:
+            c.last_server.health.succeeded()
         self._used.remove(c)
         if self._maxcached == 0 or self._maxcached > len(self._clients):
             self._clients.append(c)
@@ -119,6 +168,26 @@ class ClientPool(object):
             c.disconnect_all()
         _cb(response, *args, **kwargs)
 
+    def _timed_out(self, c, _cb, state):
+        if state['done']:
+            return
+        state['done'] = True
+        self._statlog('timeouts')
+        # A late answer would be read as the answer to the next command.
+        self._used.remove(c)
+        c.disconnect_all()
+        if c.last_server is not None:
+            c.last_server.health.timed_out(self.dead_after)
+        _cb(None)
+
+    def report(self):
+        now = time.time()
+        hosts = dict((server, {'alive': health.alive(), 'checks': health.checks,
+                               'dead_for': round(now - health.dead_since, 1)
+                               if not health.alive() else 0})
+                     for server, health in self.health.iteritems())
+        return dict(self.stats, hosts=hosts, idle=len(self._clients), used=len(self._used))
+
 
 class _Error(Exception):
     pass
@@ -138,7 +207,7 @@ class Client(object):
         server, so you could use the user's unique id as the hash value.
 
     @group Setup: __init__, set_servers, forget_dead_hosts, disconnect_all, debuglog
-    @group Insertion: set, add, replace
+    @group Insertion: set, set_multi, add, replace
     @group Retrieval: get, get_multi
     @group Integers: incr, decr
     @group Removal: delete
@@ -148,6 +217,9 @@ class Client(object):
     _FLAG_PICKLE = 1 << 0
     _FLAG_INTEGER = 1 << 1
     _FLAG_LONG = 1 << 2
+    # Bits the client uses to encode value types; the rest are passed
+    # through from the C{flags} argument of the storage commands.
+    _CLIENT_FLAGS = 0xff
 
     _SERVER_RETRIES = 10  # how many times to try finding a free server.
 
@@ -168,9 +240,11 @@ class Client(object):
     #            cls._ASYNC_CLIENTS[io_loop] = instance
     #            return instance
 
-    def __init__(self, servers, debug=0, io_loop=None):
+    def __init__(self, servers, debug=0, io_loop=None, health=None):
         io_loop = io_loop or ioloop.IOLoop.instance()
         self.io_loop = io_loop
+        self._health = health or {}
+        self.last_server = None
         self.set_servers(servers)
         self.debug = debug
         self.stats = {}
@@ -199,7 +273,8 @@ class Client(object):
             2. Tuples of the form C{("host:port", weight)}, where C{weight} is
             an integer weight value.
         """
-        self.servers = [_Host(s, self.debuglog) for s in servers]
+        self.servers = [_Host(s, self.debuglog, self._health.get(s), self.io_loop)
+                        for s in servers]
         self._init_buckets()
 
     def debuglog(self, str):
@@ -217,7 +292,7 @@ class Client(object):
         Reset every host in the pool to an "alive" state.
         """
         for s in self.servers:
-            s.dead_until = 0
+            s.health.mark_alive()
 
     def _init_buckets(self):
         self.buckets = []
@@ -236,6 +311,7 @@ class Client(object):
             server = self.buckets[serverhash % len(self.buckets)]
             if server.connect():
             #                print "(using server %s)" % server
+                self.last_server = server
                 return server, key
             serverhash = hash(str(serverhash) + str(i))
         return None, None
@@ -253,13 +329,15 @@ class Client(object):
         server, key = self._get_server(key)
         if not server:
             self.finish(partial(callback, 0))
+            return
         self._statlog('delete')
         if time != None:
             cmd = "delete %s %d" % (key, time)
         else:
             cmd = "delete %s" % key
 
-        server.send_cmd(cmd, callback=partial(self._delete_send_cb, server, callback))
+        server.send_cmd(cmd, callback=partial(self._delete_send_cb, server, callback),
+                        failed=partial(self.finish, partial(callback, 0)))
 
     def _delete_send_cb(self, server, callback):
         server.expect("DELETED", callback=partial(self._expect_cb, callback=callback))
@@ -314,7 +392,8 @@ class Client(object):
         self._statlog(cmd)
         cmd = "%s %s %d" % (cmd, key, delta)
 
-        server.send_cmd(cmd, callback=partial(self._incrdecr_send_cb, server, callback))
+        server.send_cmd(cmd, callback=partial(self._incrdecr_send_cb, server, callback),
+                        failed=partial(self.finish, partial(callback, None)))
 
     def _send_incrdecr_cb(self, server, callback):
         server.readline(callback=partial(self._send_incrdecr_check_cb, callback=callback))
@@ -326,18 +405,18 @@ class Client(object):
     #            server.mark_dead(msg[1])
     #            return None
 
-    def add(self, key, val, time=0, callback=None):
+    def add(self, key, val, time=0, callback=None, flags=0):
         '''
         Add new key with value.
         
         Like L{set}, but only stores in memcache if the key doesn't already exist.
 
-        @return: Nonzero on success.
+        @return: Nonzero on success, 0 if the key exists, None on error.
         @rtype: int
         '''
-        self._set("add", key, val, time, callback)
+        self._set("add", key, val, time, callback, flags)
 
-    def replace(self, key, val, time=0, callback=None):
+    def replace(self, key, val, time=0, callback=None, flags=0):
         '''Replace existing key with value.
         
         Like L{set}, but only stores in memcache if the key already exists.  
@@ -346,9 +425,9 @@ class Client(object):
         @return: Nonzero on success.
         @rtype: int
         '''
-        self._set("replace", key, val, time, callback)
+        self._set("replace", key, val, time, callback, flags)
 
-    def set(self, key, val, time=0, callback=None):
+    def set(self, key, val, time=0, callback=None, flags=0):
         '''Unconditionally sets a key to a given value in the memcache.
 
         The C{key} can optionally be an tuple, with the first element being the
@@ -357,19 +436,72 @@ class Client(object):
         same memcache server, so you could use the user's unique id as the hash
         value.
 
+        C{flags} are stored with the value for other clients to interpret;
+        the low 8 bits are reserved for the value types of this client.
+
         @return: Nonzero on success.
         @rtype: int
         '''
-        self._set("set", key, val, time, callback)
+        self._set("set", key, val, time, callback, flags)
+
+    def set_multi(self, items, callback=None):
+        '''Sets several C{(key, val, time, flags)} items at once.
 
-    def _set(self, cmd, key, val, time, callback):
+        The commands for one server are pipelined: sent in a single write,
+        after which their answers are read in order.
+
+        @return: The number of items stored.
+        @rtype: int
+        '''
+        self._statlog('set_multi')
+        commands = {}
+        for key, val, time, flags in items:
+            server, key = self._get_server(key)
+            if server:
+                commands.setdefault(server, []).append(
+                    self._storage_cmd("set", key, val, time, flags))
+        if not commands:
+            self.finish(partial(callback, 0))
+            return
+        results = {'pending': len(commands), 'stored': 0}
+
+        def server_done(stored):
+            results['stored'] += stored
+            results['pending'] -= 1
+            if not results['pending']:
+                self.finish(partial(callback, results['stored']))
+
+        for server, cmds in commands.items():
+            server.send_cmd("\r\n".join(cmds), callback=partial(
+                self._multi_send_cb, server=server, count=len(cmds), callback=server_done),
+                failed=partial(server_done, 0))
+
+    def _multi_send_cb(self, server, count, callback):
+        server.readline(partial(self._multi_expect_cb, server=server, remaining=count,
+                                stored=0, callback=callback))
+
+    def _multi_expect_cb(self, line, server, remaining, stored, callback):
+        if line == "STORED":
+            stored += 1
+        if remaining > 1:
+            server.readline(partial(self._multi_expect_cb, server=server,
+                                    remaining=remaining - 1, stored=stored, callback=callback))
+        else:
+            callback(stored)
+
+    def _set(self, cmd, key, val, time, callback, flags=0):
         server, key = self._get_server(key)
         if not server:
-            self.finish(partial(callback, 0))
+            self.finish(partial(callback, None))
+            return
 
         self._statlog(cmd)
+        fullcmd = self._storage_cmd(cmd, key, val, time, flags)
+        server.send_cmd(fullcmd, callback=partial(self._set_send_cb, server=server, callback=callback),
+                        failed=partial(self.finish, partial(callback, None)))
 
-        flags = 0
+    def _storage_cmd(self, cmd, key, val, time, flags):
+        assert not flags & Client._CLIENT_FLAGS, "flags 0-7 are reserved by the client"
         if isinstance(val, types.StringTypes):
             pass
         elif isinstance(val, int):
@@ -382,12 +514,21 @@ class Client(object):
             flags |= Client._FLAG_PICKLE
             val = pickle.dumps(val, 2)
 
-        fullcmd = "%s %s %d %d %d\r\n%s" % (cmd, key, flags, time, len(val), val)
-
-        server.send_cmd(fullcmd, callback=partial(self._set_send_cb, server=server, callback=callback))
+        return "%s %s %d %d %d\r\n%s" % (cmd, key, flags, time, len(val), val)
 
     def _set_send_cb(self, server, callback):
-        server.expect("STORED", callback=partial(self._expect_cb, value=None, callback=callback))
+        server.expect("STORED", callback=partial(self._set_expect_cb, callback=callback))
+
+    def _set_expect_cb(self, line, callback):
+        # add/replace answer NOT_STORED when their condition does not hold;
+        # anything else is an error and reported as None.
+        if line == "STORED":
+            stored = 1
+        elif line == "NOT_STORED":
+            stored = 0
+        else:
+            stored = None
+        self.finish(partial(callback, stored))
 
     #        except socket.error, msg:
     #            server.mark_dead(msg[1])
@@ -401,11 +542,13 @@ class Client(object):
         '''
         server, key = self._get_server(key)
         if not server:
-            return None
+            self.finish(partial(callback, None))
+            return
 
         self._statlog('get')
 
-        server.send_cmd("get %s" % key, partial(self._get_send_cb, server=server, callback=callback))
+        server.send_cmd("get %s" % key, partial(self._get_send_cb, server=server, callback=callback),
+                        failed=partial(self.finish, partial(callback, None)))
 
     def _get_send_cb(self, server, callback):
         self._expectvalue(server, line=None, callback=partial(self._get_expectval_cb, server=server, callback=callback))
@@ -460,7 +603,7 @@ class Client(object):
         if len(buf) == rlen:
             buf = buf[:-2]  # strip \r\n
 
-        if flags == 0:
+        if flags & Client._CLIENT_FLAGS == 0:
             val = buf
         elif flags & Client._FLAG_INTEGER:
             val = int(buf)
@@ -470,6 +613,7 @@ class Client(object):
             val = pickle.loads(buf)
         else:
             self.debuglog("unknown flags on get: %x\n" % flags)
+            val = None
 
         self.finish(partial(callback, val))
 
@@ -479,35 +623,108 @@ class Client(object):
         #        self.disconnect_all()
 
 
-class _Host:
-    _DEAD_RETRY = 30  # number of seconds before retrying a dead server.
+class HostHealth(object):
+    """Liveness of one memcached server, shared by the clients of a pool."""
+
+    def __init__(self, host, retry=30, check_timeout=1, io_loop=None):
+        self.address = _address(host)
+        self.retry = retry
+        self.check_timeout = check_timeout
+        self._io_loop = io_loop
+        self.dead_since = 0
+        self.timeouts = 0
+        self.checks = 0
+        self._dead = False
+
+    @property
+    def io_loop(self):
+        return self._io_loop or ioloop.IOLoop.instance()
+
+    def alive(self):
+        return not self._dead
+
+    def succeeded(self):
+        self.timeouts = 0
+
+    def timed_out(self, dead_after):
+        self.timeouts += 1
+        if self.timeouts >= dead_after:
+            self.mark_dead('%d operations in a row timed out' % self.timeouts)
+
+    def mark_dead(self, reason):
+        if self._dead:
+            return
+        logging.warning('MemCache: %s:%d: %s.  Marking dead.' % (self.address + (reason,)))
+        self._dead = True
+        self.dead_since = time.time()
+        self._schedule_check()
+
+    def mark_alive(self):
+        self._dead = False
+        self.timeouts = 0
+
+    def _schedule_check(self):
+        self.io_loop.add_timeout(time.time() + self.retry, self._check)
+
+    def _check(self):
+        self.checks += 1
+        stream = iostream.IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM),
+                                   io_loop=self.io_loop)
+        state = {'done': False}
+
+        def done(ok):
+            if state['done']:
+                return
+            state['done'] = True
+            self.io_loop.remove_timeout(timeout)
+            stream.close()
+            if ok:
+                logging.warning('MemCache: %s:%d: answering again after %ds.'
+                                % (self.address + (time.time() - self.dead_since,)))
+                self.mark_alive()
+            else:
+                self._schedule_check()
+
+        def connected():
+            stream.write("version\r\n")
+            stream.read_until("\r\n", lambda line: done(line.startswith("VERSION")))
+
+        timeout = self.io_loop.add_timeout(time.time() + self.check_timeout,
+                                           lambda: done(False))
+        stream.set_close_callback(lambda: done(False))
+        stream.connect(self.address, connected)
+
+
+def _address(host):
+    if host.find(":") > 0:
+        ip, port = host.split(":")
+        return ip, int(port)
+    return host, 11211
+
 
-    def __init__(self, host, debugfunc=None):
+class _Host:
+    def __init__(self, host, debugfunc=None, health=None, io_loop=None):
         if isinstance(host, types.TupleType):
             host = host[0]
             self.weight = host[1]
         else:
             self.weight = 1
 
-        if host.find(":") > 0:
-            self.ip, self.port = host.split(":")
-            self.port = int(self.port)
-        else:
-            self.ip, self.port = host, 11211
+        self.ip, self.port = _address(host)
+        self.health = health or HostHealth(host, io_loop=io_loop)
+        self.io_loop = io_loop
 
         if not debugfunc:
             debugfunc = lambda x: x
         self.debuglog = debugfunc
 
-        self.deaduntil = 0
         self.socket = None
         self.stream = None
+        self._connected = False
+        self._unsent = []
 
     def _check_dead(self):
-        if self.deaduntil and self.deaduntil > time.time():
-            return 1
-        self.deaduntil = 0
-        return 0
+        return not self.health.alive()
 
     def connect(self):
         if self._get_socket():
@@ -515,8 +732,7 @@ class _Host:
         return 0
 
     def mark_dead(self, reason):
-        print "MemCache: %s: %s.  Marking dead." % (self, reason)
-        self.deaduntil = time.time() + _Host._DEAD_RETRY
+        self.health.mark_dead(reason)
         self.close_socket()
 
     def _get_socket(self):
@@ -525,31 +741,59 @@ class _Host:
         if self.socket:
             return self.socket
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Python 2.3-ism:  s.settimeout(1)
-        try:
-            s.connect((self.ip, self.port))
-        except socket.error, msg:
-            self.mark_dead("connect: %s" % msg[1])
-            return None
+        # Connects without blocking. Commands sent meanwhile are held back
+        # until the connection is up, and failed if it is refused.
         self.socket = s
-        self.stream = iostream.IOStream(s)
-        self.stream.debug = True
+        self.stream = iostream.IOStream(s, io_loop=self.io_loop)
+        self.stream.set_close_callback(partial(self._closed, self.stream))
+        self._connected = False
+        self._unsent = []
+        self.stream.connect((self.ip, self.port), self._on_connect)
         return s
 
+    def _on_connect(self):
+        self._connected = True
+        unsent, self._unsent = self._unsent, []
+        for cmd, callback, failed in unsent:
+            self.stream.write(cmd, callback)
+
+    def _closed(self, stream):
+        if stream is not self.stream:
+            return  # closed by close_socket
+        self.stream = None
+        self.socket = None
+        if not self._connected:
+            self.health.mark_dead("connect failed")
+            # Answered now rather than when the pool's timeout fires, if
+            # it has one at all.
+            unsent, self._unsent = self._unsent, []
+            for cmd, callback, failed in unsent:
+                if failed is not None:
+                    failed()
+
     def close_socket(self):
         if self.socket:
         #            self.socket.close()
-            self.stream.close()
+            stream = self.stream
             self.stream = None
             self.socket = None
+            stream.close()
 
-    def send_cmd(self, cmd, callback):
+    def send_cmd(self, cmd, callback, failed=None):
+        """Writes `cmd`, then calls `callback()`, or `failed()` if the
+        connection could not be made."""
     #        print "in sendcmd", repr(cmd), callback
-        self.stream.write(cmd + "\r\n", callback)
+        if self._connected:
+            self.stream.write(cmd + "\r\n", callback)
+        else:
+            self._unsent.append((cmd + "\r\n", callback, failed))
         #self.socket.sendall(cmd + "\r\n")
 
     def readline(self, callback):
-        self.stream.read_until("\r\n", callback)
+        self.stream.read_until("\r\n", partial(self._readline_cb, callback=callback))
+
+    def _readline_cb(self, data, callback):
+        callback(data[:-2])
 
     def expect(self, text, callback):
         self.readline(partial(self._expect_cb, text=text, callback=callback))
@@ -564,8 +808,8 @@ class _Host:
 
     def __str__(self):
         d = ''
-        if self.deaduntil:
-            d = " (dead until %d)" % self.deaduntil
+        if self._check_dead():
+            d = " (dead)"
         return "%s:%d%s" % (self.ip, self.port, d)
 
 
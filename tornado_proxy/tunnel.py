@@ -0,0 +1,409 @@
+"""
+CONNECT tunnels with bounded buffers and idle timeouts.
+
+Once the upstream connection is established, both sockets are taken over
+from their IOStreams and driven directly by the IOLoop, because an IOStream
+keeps reading into its buffer whatever the other side does with the data.
+Here each direction buffers at most `max_buffer` bytes: while the receiving
+side cannot keep up, the sending side is not read, so TCP flow control
+slows the sender down instead of the proxy's memory growing.
+
+    tunnels = TunnelManager(max_tunnels=1000, idle_timeout=300)
+    if tunnels.full():
+        ...reject the CONNECT...
+    tunnels.open(client_stream, host, port, callback)   # callback(error)
+
+A tunnel is closed once both sides closed their end, or when no bytes went
+either way for `idle_timeout` seconds. Every tunnel counts the bytes it
+carried and its duration: `report` lists the open tunnels, `stats` holds
+the totals of the closed ones and closed tunnels are logged.
+"""
+import collections
+import errno
+import functools
+import logging
+import socket
+import time
+
+from tornado import ioloop
+from tornado import iostream
+from tornado import stack_context
+
+READ_CHUNK = 64 * 1024
+_WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+
+CONNECTION_ESTABLISHED = 'HTTP/1.0 200 Connection established\r\n\r\n'
+
+
+def take_socket(stream):
+    """Takes the connected socket of `stream` over.
+
+    Returns a duplicate of the socket and the bytes the stream had already
+    read from it, then closes the stream, which leaves the connection open.
+    """
+    sock = stream.socket
+    taken = socket.fromfd(sock.fileno(), sock.family, sock.type)
+    taken.setblocking(0)
+    pending = ''
+    if stream._read_buffer_size:
+        pending = stream._consume(stream._read_buffer_size)
+    stream.close()
+    return taken, pending
+
+
+class _Side(object):
+    """One socket of a tunnel and the bytes waiting to be sent on it."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.out = collections.deque()
+        self.out_bytes = 0
+        self.received = 0
+        self.read_closed = False
+        self.write_closed = False
+        self.events = None
+
+    def queue(self, data):
+        if data:
+            self.out.append(data)
+            self.out_bytes += len(data)
+
+
+class Tunnel(object):
+    def __init__(self, manager, target, client_sock, upstream_sock,
+                 to_client='', to_upstream=''):
+        self.manager = manager
+        self.io_loop = manager.io_loop
+        self.target = target
+        self.client = _Side(client_sock)
+        self.upstream = _Side(upstream_sock)
+        self.client.queue(to_client)
+        self.upstream.queue(to_upstream)
+        self.started = self.last_active = time.time()
+        self.paused = 0
+        self.closed = False
+        self._idle_timeout = None
+
+    def _peer(self, side):
+        return self.upstream if side is self.client else self.client
+
+    def start(self):
+        with stack_context.NullContext():
+            for side in (self.client, self.upstream):
+                side.events = self._wanted(side)
+                self.io_loop.add_handler(side.fd, functools.partial(self._on_events, side),
+                                         side.events)
+            self._schedule_idle_check()
+
+    def _wanted(self, side):
+        events = self.io_loop.ERROR
+        if not side.read_closed and self._peer(side).out_bytes < self.manager.max_buffer:
+            events |= self.io_loop.READ
+        if side.out_bytes:
+            events |= self.io_loop.WRITE
+        return events
+
+    def _update(self):
+        for side in (self.client, self.upstream):
+            if side.events is None:
+                continue
+            if side.read_closed and side.write_closed:
+                # Nothing left to do on this socket; it would keep reporting
+                # the hang-up.
+                self.io_loop.remove_handler(side.fd)
+                side.events = None
+                continue
+            events = self._wanted(side)
+            if events == side.events:
+                continue
+            if side.events & self.io_loop.READ and not events & self.io_loop.READ \
+                    and not side.read_closed:
+                self.paused += 1
+            side.events = events
+            self.io_loop.update_handler(side.fd, events)
+
+    def _on_events(self, side, fd, events):
+        if self.closed:
+            return
+        try:
+            if events & self.io_loop.READ:
+                self._read(side)
+            if events & self.io_loop.WRITE:
+                self._flush(side)
+            if events & self.io_loop.ERROR:
+                error = side.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    self.close(errno.errorcode.get(error, str(error)))
+                    return
+                # Hung up: pass on what it sent, nothing can be sent to it.
+                while not side.read_closed and self._read(side):
+                    pass
+                side.read_closed = side.write_closed = True
+                side.out.clear()
+                side.out_bytes = 0
+        except socket.error, e:
+            self.close(errno.errorcode.get(e.args[0], str(e)))
+            return
+        self._half_close()
+        if not self.closed:
+            self._update()
+
+    def _read(self, side):
+        """Moves one chunk from `side` to its peer, returns its size."""
+        try:
+            data = side.sock.recv(READ_CHUNK)
+        except socket.error, e:
+            if e.args[0] in _WOULD_BLOCK:
+                return 0
+            raise
+        if not data:
+            side.read_closed = True
+            return 0
+        side.received += len(data)
+        self.last_active = time.time()
+        peer = self._peer(side)
+        if peer.write_closed:
+            return len(data)
+        peer.queue(data)
+        self._flush(peer)
+        return len(data)
+
+    def _flush(self, side):
+        while side.out:
+            data = side.out[0]
+            try:
+                sent = side.sock.send(data)
+            except socket.error, e:
+                if e.args[0] in _WOULD_BLOCK:
+                    break
+                raise
+            side.out_bytes -= sent
+            self.last_active = time.time()
+            if sent < len(data):
+                side.out[0] = data[sent:]
+                break
+            side.out.popleft()
+
+    def _half_close(self):
+        """Passes a side's end of stream on once its data was delivered."""
+        for side in (self.client, self.upstream):
+            peer = self._peer(side)
+            if side.read_closed and not peer.out and not peer.write_closed:
+                peer.write_closed = True
+                try:
+                    peer.sock.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+        if self.client.write_closed and self.upstream.write_closed:
+            self.close('finished')
+
+    def _schedule_idle_check(self):
+        if self.manager.idle_timeout:
+            self._idle_timeout = self.io_loop.add_timeout(
+                self.last_active + self.manager.idle_timeout, self._check_idle)
+
+    def _check_idle(self):
+        self._idle_timeout = None
+        if self.closed:
+            return
+        if time.time() - self.last_active >= self.manager.idle_timeout:
+            self.close('idle')
+        else:
+            self._schedule_idle_check()
+
+    def close(self, reason):
+        if self.closed:
+            return
+        self.closed = True
+        if self._idle_timeout is not None:
+            self.io_loop.remove_timeout(self._idle_timeout)
+            self._idle_timeout = None
+        for side in (self.client, self.upstream):
+            if side.events is not None:
+                self.io_loop.remove_handler(side.fd)
+            side.sock.close()
+        self.manager._closed(self, reason)
+
+    def report(self):
+        return {
+            'target': self.target,
+            'duration': round(time.time() - self.started, 3),
+            'bytes_up': self.client.received,
+            'bytes_down': self.upstream.received,
+            'buffered': self.client.out_bytes + self.upstream.out_bytes,
+            'paused': self.paused,
+        }
+
+
+class TunnelManager(object):
+    def __init__(self, max_tunnels=1000, idle_timeout=300, max_buffer=256 * 1024,
+                 connect_timeout=60, resolver=None, io_loop=None):
+        self.max_tunnels = max_tunnels
+        self.resolver = resolver
+        self.idle_timeout = idle_timeout
+        self.max_buffer = max_buffer
+        self.connect_timeout = connect_timeout
+        self._io_loop = io_loop
+        self.tunnels = set()
+        self.connecting = 0
+        self.stats = {}
+
+    @property
+    def io_loop(self):
+        # Resolved late, see MemcacheLease.io_loop.
+        return self._io_loop or ioloop.IOLoop.instance()
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def full(self):
+        if len(self.tunnels) + self.connecting >= self.max_tunnels:
+            self._statlog('rejected')
+            return True
+        return False
+
+    def open(self, client_stream, host, port, callback):
+        """Connects to `host`:`port` and turns `client_stream` into a tunnel
+        to it, answering the CONNECT itself.
+
+        Calls `callback(None)` once the tunnel runs, or `callback(error)` if
+        the upstream connection failed, leaving `client_stream` untouched.
+        With a `resolver.Resolver`, `host` is looked up without blocking;
+        `connect_timeout` includes the lookup.
+        """
+        target = '%s:%d' % (host, port)
+        upstream = iostream.IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0),
+                                     io_loop=self.io_loop)
+        self.connecting += 1
+        state = {'done': False}
+
+        def finish(error):
+            if state['done']:
+                return
+            state['done'] = True
+            self.connecting -= 1
+            if timeout is not None:
+                self.io_loop.remove_timeout(timeout)
+            if error is not None:
+                self._statlog('connect_failed')
+                upstream.close()
+                callback(error)
+                return
+            if client_stream.closed():
+                upstream.close()
+                return
+            upstream.set_close_callback(None)
+            upstream_sock, to_client = take_socket(upstream)
+            client_sock, to_upstream = take_socket(client_stream)
+            tunnel = Tunnel(self, target, client_sock, upstream_sock,
+                            CONNECTION_ESTABLISHED + to_client, to_upstream)
+            self.tunnels.add(tunnel)
+            self._statlog('opened')
+            tunnel.start()
+            callback(None)
+
+        def closed():
+            finish(upstream.error or 'connection closed')
+
+        def resolved(address, error):
+            if state['done']:
+                return
+            if error is not None:
+                finish(error)
+                return
+            upstream.set_close_callback(closed)
+            upstream.connect((address, port), lambda: finish(None))
+
+        timeout = None
+        if self.connect_timeout:
+            timeout = self.io_loop.add_timeout(time.time() + self.connect_timeout,
+                                               lambda: finish('timeout'))
+        if self.resolver is not None:
+            self.resolver.resolve(host, resolved)
+        else:
+            resolved(host, None)
+
+    def _closed(self, tunnel, reason):
+        self.tunnels.discard(tunnel)
+        report = tunnel.report()
+        self._statlog('closed')
+        self._statlog('closed_' + reason)
+        self._statlog('bytes_up', report['bytes_up'])
+        self._statlog('bytes_down', report['bytes_down'])
+        self._statlog('seconds', report['duration'])
+        logging.info('Tunnel to %s closed (%s) after %.1fs, %d bytes up, %d bytes down'
+                     % (tunnel.target, reason, report['duration'],
+                        report['bytes_up'], report['bytes_down']))
+
+    def report(self):
+        """Counters of the open tunnels, longest running first."""
+        return [tunnel.report() for tunnel in
+                sorted(self.tunnels, key=lambda tunnel: tunnel.started)]
+
+
+if __name__ == '__main__':
+    loop = ioloop.IOLoop.instance()
+    manager = TunnelManager(idle_timeout=0.2, max_buffer=64 * 1024, io_loop=loop)
+    total = 4 * 1024 * 1024
+    progress = {'sent': 0, 'received': 0}
+
+    def run(seconds):
+        loop.add_timeout(time.time() + seconds, loop.stop)
+        loop.start()
+
+    def pair():
+        mine, theirs = socket.socketpair()
+        mine.setblocking(0)
+        theirs.setblocking(0)
+        return mine, theirs
+
+    client, client_peer = pair()
+    upstream, upstream_peer = pair()
+    tunnel = Tunnel(manager, 'test:1', client, upstream)
+    manager.tunnels.add(tunnel)
+    tunnel.start()
+
+    def send(fd, events):
+        try:
+            while progress['sent'] < total:
+                progress['sent'] += client_peer.send('x' * min(READ_CHUNK, total - progress['sent']))
+        except socket.error, e:
+            if e.args[0] not in _WOULD_BLOCK:
+                raise
+            return
+        loop.remove_handler(fd)
+        client_peer.shutdown(socket.SHUT_WR)
+
+    def receive(fd, events):
+        data = upstream_peer.recv(READ_CHUNK)
+        progress['received'] += len(data)
+        if not data:
+            loop.remove_handler(fd)
+            upstream_peer.close()
+
+    # The origin does not read: the tunnel buffers at most max_buffer bytes
+    # for it, then stops reading from the client.
+    loop.add_handler(client_peer.fileno(), send, loop.WRITE)
+    run(0.1)
+    assert tunnel.paused == 1 and not tunnel.client.events & loop.READ, tunnel.report()
+    assert manager.max_buffer <= tunnel.upstream.out_bytes < manager.max_buffer + READ_CHUNK
+    assert progress['sent'] < total
+
+    # Once the origin reads, everything goes through and both ends close.
+    loop.add_handler(upstream_peer.fileno(), receive, loop.READ)
+    run(1)
+    assert progress['received'] == total, progress
+    assert tunnel.closed and not manager.tunnels
+
+    client, client_peer = pair()
+    upstream, upstream_peer = pair()
+    idle = Tunnel(manager, 'test:2', client, upstream)
+    manager.tunnels.add(idle)
+    idle.start()
+    run(0.3)
+    assert idle.closed
+    assert manager.stats == {'closed': 2, 'closed_finished': 1, 'closed_idle': 1,
+                             'bytes_up': total, 'bytes_down': 0,
+                             'seconds': manager.stats['seconds']}, manager.stats
+    print 'ok'
@@ -3,14 +3,24 @@ import functools
 import os.path
 import datetime
 import anydbm
-from  cStringIO import StringIO
+import whichdb
 import httplib
 import hashlib
+import copy
+import tempfile
+import time
 
 from tornado import stack_context
+from tornado.escape import native_str, _unicode
+from tornado.httpclient import HTTPError
+from tornado.httputil import HTTPHeaders
 from tornado.simple_httpclient import SimpleAsyncHTTPClient, _HTTPConnection
+from tornado.util import b
 
 import warc
+from tornado_proxy.connpool import ConnectionPool, pool_key
+from tornado_proxy.resolver import CachedNames
+from tornado_proxy.scheduler import FairQueue, host_of
 
 """
 Singleton that handles maintaining a single output file for many connections
@@ -22,27 +32,60 @@ import logging
 
 REGEXP_HOST = re.compile("[^\.]+\.[^\.]+$")
 
+# Streamed record payloads are kept in memory up to this size, or while
+# the client's memory_budget allows, and spill to a temporary file beyond it.
+SPOOL_MAX_SIZE = 1024 * 1024
+
+# Keep connections to origins open between requests (see connpool).
+KEEP_ALIVE = True
+POOL_MAX_IDLE = 256
+POOL_MAX_IDLE_PER_HOST = 8
+POOL_IDLE_TIMEOUT = 30
+# Requests that failed on a reused connection before any response arrived
+# (the origin closed it meanwhile) are sent again on a new one; requests of
+# other methods (POST) always get a new connection.
+RETRIED_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+# At most MAX_PER_HOST requests to the same origin are sent at once; past
+# max_clients, or that, requests wait in per-origin queues served in turn
+# (see scheduler).
+MAX_PER_HOST = 16
+
 
 def get_hostname(url):
     hostname = urlparse.urlparse(url).hostname
-    hostname = re.findall(REGEXP_HOST, hostname)[0]
-    return hostname
+    # Dotless hosts (localhost, intranet names) are their own domain.
+    domains = re.findall(REGEXP_HOST, hostname)
+    return domains[0] if domains else hostname
 
 
 class WarcWriter(object):
-    warc_fp_slots = {}
-    warc_file_n_slots = {}
+    """
+    Writes response records to per-host WARC files under
+    ``<outdir>/<run_name>/warc`` and keeps the md5 of every archived url in
+    ``db_index/index.db`` so each url is archived once per run.
 
-    def __init__(self, outdir='result'):
+    Workers of one run (see `workers`) each get their own
+    ``<run_name>/worker-<n>`` directory, so no two processes ever append to
+    the same gzip file or dbm index. `claim`, if given, makes dedup hold
+    across them: it is called as ``claim(url_hash, callback)`` before a new
+    url is written and must call ``callback(False)`` if another process
+    already archived it. `merge_indexes` combines the worker indexes of a
+    run into its own ``db_index/index.db``.
+    """
+
+    def __init__(self, outdir='result', run_name=None, worker=None, claim=None):
         max_mb_size = 100
         self.max_size = max_mb_size * 1024 * 1024
         self.outdir = outdir
         if not os.path.exists(self.outdir):
             os.mkdir(self.outdir)
-        now = datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
-        self.outdir = os.path.join(self.outdir, now)
+        if run_name is None:
+            run_name = datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
+        self.outdir = os.path.join(self.outdir, run_name)
         if not os.path.exists(self.outdir):
             os.mkdir(self.outdir)
+        if worker is not None:
+            self.outdir = os.path.join(self.outdir, 'worker-%s' % worker)
 
         self.now_iso_format = WarcWriter.now_iso_format()
         if not os.path.exists(self.outdir):
@@ -56,6 +99,9 @@ class WarcWriter(object):
 
         db_fname = os.path.join(self.db_index_dir, 'index.db')
         self.db = anydbm.open(db_fname, 'n')
+        self.claim = claim
+        self.warc_fp_slots = {}
+        self.warc_file_n_slots = {}
         #self.file_n = 0
         #self.warc_fp = None
         self.fname_prefix = ""
@@ -69,32 +115,88 @@ class WarcWriter(object):
         return now.strftime("%Y-%m-%dT%H:%M:%SZ")
 
     def write_record(self, headers, content, response_url, http_code):
+        if not self._mark_url(response_url):
+            return
+        payload = self._http_head(http_code, headers) + content
+        record = warc.WARCRecord(payload=payload,
+                                 headers=self._record_headers(headers, response_url, len(payload)))
+
+        def claimed(owned):
+            if owned:
+                self.hostname = get_hostname(response_url)
+                self._write_record(record)
+
+        self._claim_url(response_url, claimed)
+
+    def open_record(self, headers, response_url, http_code, budget=None):
+        """Starts a response record whose body is fed chunk by chunk.
+
+        Returns a `StreamingWarcRecord`, or None if the url was already
+        archived. Its payload is kept in memory within `budget`, a
+        `membudget.MemoryBudget`, if given.
+        """
+        if not self._mark_url(response_url):
+            return None
+        return StreamingWarcRecord(self, headers, response_url, http_code, budget)
+
+    def _mark_url(self, response_url):
         hash_url = hashlib.md5(str(response_url)).hexdigest()
         if hash_url in self.db:
             logging.debug('Response url in db %s' % response_url)
-            return
+            return False
         self.db[hash_url] = '1'
         logging.debug('Response url not in db %s' % response_url)
-        #Content-Encoding: gzip
-        self.hostname = get_hostname(response_url)
-        payload = StringIO()
+        return True
 
+    def _unmark_url(self, response_url):
+        hash_url = hashlib.md5(str(response_url)).hexdigest()
+        if hash_url in self.db:
+            del self.db[hash_url]
+
+    def _claim_url(self, response_url, callback):
+        """Calls `callback(True)` if no other worker archived `response_url`.
+
+        Urls another worker owns stay marked in the local index, so they are
+        not claimed again, but are dropped from it by `merge_indexes`.
+        """
+        if self.claim is None:
+            callback(True)
+            return
+        hash_url = hashlib.md5(str(response_url)).hexdigest()
+
+        def claimed(owned):
+            if not owned:
+                logging.debug('Response url archived by another worker %s' % response_url)
+                if hash_url in self.db:
+                    self.db[hash_url] = '0'
+            callback(owned)
+
+        self.claim(hash_url, claimed)
+
+    def close(self):
+        """Closes the open WARC files (ending their gzip members) and the index."""
+        for warc_fp in self.warc_fp_slots.values():
+            warc_fp.close()
+        self.warc_fp_slots.clear()
+        self.db.close()
+
+    def _http_head(self, http_code, headers):
+        #Content-Encoding: gzip
         status_reason = httplib.responses.get(http_code, '-')
-        payload.write('HTTP/1.1 %d %s\r\n' % (http_code, status_reason))
+        lines = ['HTTP/1.1 %d %s\r\n' % (http_code, status_reason)]
         for h_name in headers:
-            payload.write('%s: %s\n' % (h_name, headers[h_name]))
-        payload.write('\r\n')
-        payload.write(content)
-        headers = {
+            lines.append('%s: %s\n' % (h_name, headers[h_name]))
+        lines.append('\r\n')
+        return ''.join(lines)
+
+    def _record_headers(self, headers, response_url, content_length):
+        return {
             'WARC-Type': 'response',
             'WARC-Date': self.now_iso_format,
-            'Content-Length': str(payload.tell()),
+            'Content-Length': str(content_length),
             'Content-Type': str(headers.get('Content-Type', '')),
             'WARC-Target-URI': response_url,
         }
-        record = warc.WARCRecord(payload=payload.getvalue(), headers=headers)
-        self._write_record(record)
-
 
     def _write_record(self, record):
         '''Writes a record in the current Warc file.
@@ -134,23 +236,493 @@ class WarcWriter(object):
         return warc_fp
 
 
-warc_writer = WarcWriter()
+class StreamingWarcRecord(object):
+    """
+    Response record assembled from body chunks as they arrive.
+
+    The payload is spooled (in memory, then on disk past `SPOOL_MAX_SIZE`)
+    while its digest is updated incrementally, because the WARC header with
+    Content-Length and digest has to precede the payload in the file.
+    """
+
+    def __init__(self, writer, headers, response_url, http_code, budget=None):
+        self.writer = writer
+        self.headers = headers
+        self.response_url = response_url
+        self.payload = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.digest = hashlib.sha1()
+        self.budget = budget
+        self.held = 0  # bytes of the payload accounted in budget
+        self.on_disk = False
+        self.write(writer._http_head(http_code, headers))
+
+    def write(self, chunk):
+        self.digest.update(chunk)
+        self.payload.write(chunk)
+        if self.budget is None or self.on_disk:
+            return
+        if self.payload.tell() <= SPOOL_MAX_SIZE and self.budget.reserve(len(chunk), self.held):
+            self.held += len(chunk)
+            return
+        # Past SPOOL_MAX_SIZE the payload already rolled over by itself.
+        self.payload.rollover()
+        self.on_disk = True
+        self._release()
+
+    def _release(self):
+        if self.held:
+            self.budget.release(self.held)
+            self.held = 0
+
+    def close(self):
+        self.writer._claim_url(self.response_url, self._claimed)
+
+    def _claimed(self, owned):
+        self._release()
+        if not owned:
+            self.payload.close()
+            return
+        headers = self.writer._record_headers(self.headers, self.response_url, self.payload.tell())
+        headers['WARC-Payload-Digest'] = 'sha1:' + self.digest.hexdigest()
+        self.payload.seek(0)
+        record = warc.WARCRecord(payload=self.payload, headers=headers)
+        self.writer.hostname = get_hostname(self.response_url)
+        self.writer._write_record(record)
+        self.payload.close()
+
+    def discard(self):
+        """Drops an incomplete record so the url can be archived later."""
+        self._release()
+        self.payload.close()
+        self.writer._unmark_url(self.response_url)
+
+
+def merge_indexes(run_dir, names=None):
+    """Merges the ``worker-*/db_index/index.db`` files of a multi-process run
+    into ``<run_dir>/db_index/index.db``.
+
+    Urls a worker skipped because another one archived them are left out,
+    so every key of the merged index has exactly one record in the run.
+    With `names`, only the indexes of those worker directories are added to
+    the merged index, as the supervisor does when a worker exits; otherwise
+    it is rebuilt from all of them. Returns the number of urls in the
+    merged index.
+    """
+    db_index_dir = os.path.join(run_dir, 'db_index')
+    if not os.path.exists(db_index_dir):
+        os.mkdir(db_index_dir)
+    merged = anydbm.open(os.path.join(db_index_dir, 'index.db'), 'c' if names else 'n')
+    try:
+        for name in sorted(names or os.listdir(run_dir)):
+            shard_fname = os.path.join(run_dir, name, 'db_index', 'index.db')
+            # anydbm may add suffixes to the file name, ask whichdb.
+            if not name.startswith('worker-') or not whichdb.whichdb(shard_fname):
+                continue
+            shard = anydbm.open(shard_fname, 'r')
+            try:
+                for hash_url in shard.keys():
+                    if shard[hash_url] == '1':
+                        merged[hash_url] = name
+            finally:
+                shard.close()
+        return len(merged)
+    finally:
+        merged.close()
+
+
+# Created on first use so that importing this module does not create a run
+# directory; multi-process workers install their own before serving.
+warc_writer = None
+
+
+def get_warc_writer():
+    global warc_writer
+    if warc_writer is None:
+        warc_writer = WarcWriter()
+    return warc_writer
+
+
+class _ReturnedStream(object):
+    """Stands in for a stream handed back to the connection pool, which
+    _HTTPConnection would otherwise close after delivering the response."""
+
+    def close(self):
+        pass
+
+    def closed(self):
+        return True
+
+
+class _StreamingReads(object):
+    """
+    Stands in for the stream of a streamed `connection` while
+    _HTTPConnection reads the response headers. The body reads it starts
+    then get the connection's streaming callback, so that the body is
+    passed on in chunks rather than read whole, once the WARC record of
+    the response is open. Any use puts the stream back.
+    """
+
+    def __init__(self, connection, stream):
+        self.connection = connection
+        self.stream = stream
+
+    def restore(self):
+        self.connection.stream = self.stream
+        return self.stream
+
+    def read_bytes(self, num_bytes, callback):
+        self.restore()
+        self.connection._on_response_headers()
+        self.stream.read_bytes(num_bytes, callback,
+                               streaming_callback=self.connection._on_stream_data)
+
+    def read_until_close(self, callback):
+        self.restore()
+        self.connection._on_response_headers()
+        self.stream.read_until_close(callback,
+                                     streaming_callback=self.connection._on_stream_data)
+
+    def read_until(self, delimiter, callback):
+        # The first chunk length of a chunked body.
+        self.restore()
+        self.connection._on_response_headers()
+        self.stream.read_until(delimiter, callback)
+
+    def __getattr__(self, name):
+        return getattr(self.restore(), name)
 
 
 class Warc_HTTPConnection(_HTTPConnection, object):
     """
+    Connection that archives every response it delivers.
+
+    When the request has a ``streaming_callback`` the body is not buffered:
+    each chunk goes to the WARC record and then to the caller, and the
+    ``header_callback`` receives the status line, the header lines and the
+    closing blank line before the first chunk.
+
+    If the client has a ``connection_pool`` the request is sent on an idle
+    connection to the same origin when there is one (unless its method is
+    not in RETRIED_METHODS), and the connection is returned to the pool
+    once the response was read, if it can be reused.
+
+    If the client has a ``resolver``, a new connection is only made once
+    the resolver has the origin's address, which the client's
+    ``hostname_mapping`` then supplies without blocking.
+
+    If the client has ``timeouts`` (a timeouts.AdaptiveTimeouts), the
+    connect and request timeouts of the request are lowered to those of
+    its origin, the response headers must arrive within the origin's first
+    byte timeout, and the connect, first byte and total times of answered
+    requests are recorded there.
+
+    `cancel` gives up on the request, e.g. once another attempt answered
+    (see hedging).
     """
 
-    def _run_callback(self, response):
-        if response.headers.get('Transfer-Encoding'):
-            del response.headers['Transfer-Encoding']
-        if response.headers.get('Content-Encoding'):
-            del response.headers['Content-Encoding']
-        warc_writer.write_record(
-            headers=response.headers, content=response.body,
-            http_code=response.code, response_url=response.effective_url,
+    def __init__(self, io_loop, client, request, release_callback,
+                 final_callback, max_buffer_size, reuse=True):
+        self._warc_record = None
+        self._cancelled = False
+        self._retry = None
+        # Set again by _HTTPConnection, but cancel may come before that.
+        self.release_callback = release_callback
+        self._original_request = request
+        self._max_buffer_size = max_buffer_size
+        self._first_line = None
+        self._header_callback = None
+        self._headers_passed = False
+        self._persistent = False
+        self._timed_out = False
+        self._reused = False
+        self._pool_key = None
+        self._host = host_of(request)
+        self._timeouts = getattr(client, 'timeouts', None)
+        self._first_byte_timeout = self._connected_at = self._first_byte_at = None
+        pool = getattr(client, 'connection_pool', None)
+        parsed = urlparse.urlsplit(_unicode(request.url))
+        if pool is not None:
+            self._pool_key = pool_key(parsed)
+            # Whether the upstream connection persists is our choice, not
+            # the browser's.
+            request = copy.copy(request)
+            request.headers = HTTPHeaders(request.headers)
+            request.headers['Connection'] = 'keep-alive'
+            if 'Proxy-Connection' in request.headers:
+                del request.headers['Proxy-Connection']
+        if self._timeouts is not None:
+            if request is self._original_request:
+                request = copy.copy(request)
+            self._apply_timeouts(request)
+        if request.streaming_callback is not None:
+            if request is self._original_request:
+                request = copy.copy(request)
+            request.streaming_callback = functools.partial(self._on_streaming_chunk,
+                                                           request.streaming_callback)
+            # Given the status line and the blank line too, see _on_response_headers.
+            self._header_callback, request.header_callback = request.header_callback, None
+        if request.method not in RETRIED_METHODS:
+            # Not sent again if the origin closed the idle connection meanwhile.
+            reuse = False
+        stream = pool.checkout(self._pool_key) if pool is not None and reuse else None
+        if stream is None:
+            connect = functools.partial(super(Warc_HTTPConnection, self).__init__, io_loop,
+                                        client, request, release_callback, final_callback,
+                                        max_buffer_size)
+            resolver = getattr(client, 'resolver', None)
+            hostname = parsed.hostname or ''
+            if resolver is not None and resolver.cached(hostname) is None:
+                # Failures are cached too: hostname_mapping raises them.
+                resolver.resolve(hostname,
+                                 lambda address, error: self._cancelled or connect())
+            else:
+                connect()
+        else:
+            self._send_on(stream, parsed, io_loop, client, request,
+                          release_callback, final_callback)
+
+    def _send_on(self, stream, parsed, io_loop, client, request,
+                 release_callback, final_callback):
+        """Sends `request` on an already connected `stream`, the way
+        _HTTPConnection.__init__ does once it connected."""
+        self.start_time = time.time()
+        self.io_loop = io_loop
+        self.client = client
+        self.request = request
+        self.release_callback = release_callback
+        self.final_callback = final_callback
+        self.code = None
+        self.headers = None
+        self.chunks = None
+        self._decompressor = None
+        self._timeout = None
+        self.stream = stream
+        self._reused = True
+        with stack_context.StackContext(self.cleanup):
+            self.stream.set_close_callback(self._on_close)
+            self._on_connect(parsed, parsed.hostname)
+
+    def _apply_timeouts(self, request):
+        connect, first_byte, total = self._timeouts.get(self._host)
+        # Those of the request are the ceilings.
+        self._ceiling = request.request_timeout
+        if request.connect_timeout:
+            request.connect_timeout = min(request.connect_timeout, connect)
+        if request.request_timeout:
+            request.request_timeout = min(request.request_timeout, total)
+        self._first_byte_timeout = first_byte
+
+    def _on_connect(self, parsed, parsed_hostname):
+        self._connected_at = time.time()
+        if self._timeouts is not None and not self._reused:
+            self._timeouts.record(self._host, 'connect', self._connected_at - self.start_time)
+        super(Warc_HTTPConnection, self)._on_connect(parsed, parsed_hostname)
+        if self._first_byte_timeout:
+            self._header_timeout = self.io_loop.add_timeout(
+                self._connected_at + self._first_byte_timeout,
+                stack_context.wrap(self._on_first_byte_timeout))
+
+    def _on_first_byte_timeout(self):
+        self._header_timeout = None
+        if self.final_callback is not None:
+            self._timed_out = True
+            self._timeouts.timed_out('first_byte')
+            raise HTTPError(599, "Timeout")
+
+    def _remove_first_byte_timeout(self):
+        if getattr(self, '_header_timeout', None) is not None:
+            self.io_loop.remove_timeout(self._header_timeout)
+            self._header_timeout = None
+
+    def _on_first_byte(self):
+        """Once the response headers are in: records the first byte time
+        and, if the response announced a long body, lets it take longer."""
+        self._remove_first_byte_timeout()
+        if self._timeouts is None or self._first_byte_at is not None:
+            return
+        now = self._first_byte_at = time.time()
+        self._timeouts.record(self._host, 'first_byte', now - self._connected_at)
+        if self._timeout is None or not self._ceiling:
+            return
+        length = self.headers.get('Content-Length') if self.headers else None
+        if self.request.method == 'HEAD' or self.code in (204, 304):
+            length = 0
+        allowed = self._ceiling
+        if length is not None and length.isdigit():
+            allowed = min(self._ceiling, max(self.request.request_timeout,
+                                             now - self.start_time +
+                                             self._timeouts.body_time(int(length))))
+        if allowed > self.request.request_timeout:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = self.io_loop.add_timeout(self.start_time + allowed,
+                                                     stack_context.wrap(self._on_timeout))
+
+    def _on_timeout(self):
+        self._timed_out = True
+        if self._timeouts is not None and self.final_callback is not None:
+            self._timeouts.timed_out('connect' if self._connected_at is None else 'total')
+        super(Warc_HTTPConnection, self)._on_timeout()
+
+    def cancel(self):
+        """Closes the connection; the callback is not called."""
+        if self._retry is not None:
+            self._retry.cancel()
+            return
+        self._cancelled = True
+        self.final_callback = None
+        record, self._warc_record = self._warc_record, None
+        if record is not None:
+            record.discard()
+        if getattr(self, '_timeout', None) is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self._remove_first_byte_timeout()
+        stream = getattr(self, 'stream', None)
+        if stream is not None:
+            stream.close()
+        self._release()
+
+    def _can_persist(self, first_line, headers):
+        """Whether the connection can carry another request after this
+        response: neither side asked to close it and the end of the body is
+        framed rather than marked by closing the connection."""
+        connection = headers.get('Connection', '').lower()
+        if 'close' in connection:
+            return False
+        if first_line.startswith('HTTP/1.0') and 'keep-alive' not in connection:
+            return False
+        if self.request.method == 'HEAD' or self.code in (204, 304):
+            return True
+        return (headers.get('Transfer-Encoding') == 'chunked' or
+                'Content-Length' in headers)
+
+    def _return_stream(self, response):
+        pool = self.client.connection_pool
+        if (self._persistent and response.code != 599 and not self.stream.closed()
+                and not self.stream.reading() and not self.stream._read_buffer_size):
+            if pool.checkin(self._pool_key, self.stream):
+                self.stream = _ReturnedStream()
+        else:
+            pool._statlog('not_reusable')
+
+    def _retry_stale(self, response):
+        """Sends the request again on a new connection if the reused one
+        turned out to be closed. Returns True if it did."""
+        if not (self._reused and response.code == 599 and self.code is None
+                and not self._timed_out
+                and self._original_request.method in RETRIED_METHODS):
+            return False
+        logging.debug('Reused connection to %s:%d failed, retrying' % self._pool_key[1:])
+        self.client.connection_pool._statlog('retried')
+        release_callback, self.release_callback = self.release_callback, None
+        final_callback, self.final_callback = self.final_callback, None
+        with stack_context.NullContext():
+            self._retry = Warc_HTTPConnection(self.io_loop, self.client,
+                                              self._original_request, release_callback,
+                                              final_callback, self._max_buffer_size,
+                                              reuse=False)
+        return True
+
+    def _strip_encoding_headers(self, headers):
+        if headers.get('Transfer-Encoding'):
+            del headers['Transfer-Encoding']
+        if headers.get('Content-Encoding'):
+            del headers['Content-Encoding']
+
+    def _on_headers(self, data):
+        self._first_line = data[:data.find(b("\n"))]
+        if self.request.streaming_callback is not None:
+            # Lets _HTTPConnection choose how to read the body, in chunks.
+            self.stream = _StreamingReads(self, self.stream)
+        try:
+            super(Warc_HTTPConnection, self)._on_headers(data)
+        finally:
+            if isinstance(self.stream, _StreamingReads):
+                self.stream.restore()
+        if self.code is not None:
+            self._on_first_byte()
+
+    def _on_response_headers(self):
+        """Once the headers of a streamed response are in, before its body:
+        opens its WARC record and passes the headers on."""
+        if self._headers_passed:
+            return
+        self._headers_passed = True
+        self._persistent = self._can_persist(self._first_line, self.headers)
+        self._strip_encoding_headers(self.headers)
+        self._warc_record = get_warc_writer().open_record(
+            headers=self.headers, http_code=self.code, response_url=self.request.url,
+            budget=getattr(self.client, 'memory_budget', None),
         )
+        if self._header_callback is not None:
+            self._header_callback(native_str(self._first_line.decode("latin1")) + "\n")
+            for k, v in self.headers.get_all():
+                self._header_callback("%s: %s\r\n" % (k, v))
+            self._header_callback("\r\n")
+
+    def _on_body(self, data):
+        if isinstance(self.stream, _StreamingReads):
+            # A response without a body.
+            self.stream.restore()
+        if self.request.streaming_callback is not None:
+            self._on_response_headers()
+        super(Warc_HTTPConnection, self)._on_body(data)
+
+    def _on_chunk_length(self, data):
+        if self._pool_key is not None and int(data.strip(), 16) == 0:
+            # _HTTPConnection stops after the last chunk; read the trailer
+            # too, so a reused connection starts at the next response.
+            self.stream.read_until(b("\r\n"), functools.partial(self._on_trailer_line, data))
+            return
+        super(Warc_HTTPConnection, self)._on_chunk_length(data)
+
+    def _on_trailer_line(self, last_chunk, line):
+        if line.strip():
+            self.stream.read_until(b("\r\n"), functools.partial(self._on_trailer_line, last_chunk))
+            return
+        super(Warc_HTTPConnection, self)._on_chunk_length(last_chunk)
+
+    def _on_stream_data(self, data):
+        if self._decompressor:
+            data = self._decompressor.decompress(data)
+        if data:
+            self.request.streaming_callback(data)
+
+    def _on_streaming_chunk(self, streaming_callback, chunk):
+        if not chunk:
+            return
+        if self._warc_record is not None:
+            self._warc_record.write(chunk)
+        streaming_callback(chunk)
+
+    def _run_callback(self, response):
+        self._remove_first_byte_timeout()
+        if self.final_callback is None:
+            return super(Warc_HTTPConnection, self)._run_callback(response)
+        if self._retry_stale(response):
+            return
+        if self._timeouts is not None and response.code != 599:
+            self._timeouts.record(self._host, 'total', response.request_time)
+        if self.request.streaming_callback is not None:
+            record, self._warc_record = self._warc_record, None
+            if record is not None:
+                if response.error and response.code == 599:
+                    record.discard()
+                else:
+                    record.close()
+        else:
+            if self.code is not None:
+                self._persistent = self._can_persist(self._first_line, self.headers)
+            self._strip_encoding_headers(response.headers)
+            if response.code != 599:
+                # Not a response, e.g. a body over max_buffer_size.
+                get_warc_writer().write_record(
+                    headers=response.headers, content=response.body,
+                    http_code=response.code, response_url=response.effective_url,
+                )
         super(Warc_HTTPConnection, self)._run_callback(response)
+        if self._pool_key is not None:
+            self._return_stream(response)
 
 
 class WarcSimpleAsyncHTTPClient(SimpleAsyncHTTPClient):
@@ -158,13 +730,57 @@ class WarcSimpleAsyncHTTPClient(SimpleAsyncHTTPClient):
         #self._warcout = WarcOutputSingleton()
         SimpleAsyncHTTPClient.__init__(self, *args, **kwargs)
 
+    def initialize(self, io_loop=None, resolver=None, memory_budget=None, timeouts=None,
+                   **kwargs):
+        """`resolver` is a `resolver.Resolver` looking origin names up
+        without blocking the IOLoop, `memory_budget` a
+        `membudget.MemoryBudget` limiting the streamed WARC payloads kept in
+        memory, `timeouts` a `timeouts.AdaptiveTimeouts` setting the
+        timeouts of each origin."""
+        if resolver is not None and kwargs.get('hostname_mapping') is None:
+            kwargs['hostname_mapping'] = CachedNames(resolver)
+        SimpleAsyncHTTPClient.initialize(self, io_loop=io_loop, **kwargs)
+        self.queue = FairQueue(max_per_host=MAX_PER_HOST)
+        self.resolver = resolver
+        self.memory_budget = memory_budget
+        self.timeouts = timeouts
+        self.connection_pool = None
+        if KEEP_ALIVE:
+            self.connection_pool = ConnectionPool(max_idle=POOL_MAX_IDLE,
+                                                  max_idle_per_host=POOL_MAX_IDLE_PER_HOST,
+                                                  idle_timeout=POOL_IDLE_TIMEOUT,
+                                                  io_loop=self.io_loop)
+
+    def can_send(self, request):
+        """Whether `request` would be sent at once rather than queued."""
+        return len(self.active) < self.max_clients and self.queue.can_start(request)
+
+    def fetch_connection(self, request, callback):
+        """Like `fetch`, but returns the `Warc_HTTPConnection` sending
+        `request`, or None if it was queued (see `can_send`)."""
+        if not self.can_send(request):
+            self.fetch(request, callback)
+            return None
+        request.headers = HTTPHeaders(request.headers)
+        return self._connect(request, stack_context.wrap(callback))
+
     def _process_queue(self):
+        while len(self.active) < self.max_clients:
+            item = self.queue.pop()
+            if item is None:
+                break
+            self._connect(*item)
+
+    def _connect(self, request, callback):
+        key = object()
+        self.active[key] = (request, callback)
+        self.queue.started(request)
         with stack_context.NullContext():
-            while self.queue and len(self.active) < self.max_clients:
-                request, callback = self.queue.popleft()
-                key = object()
-                self.active[key] = (request, callback)
-                Warc_HTTPConnection(self.io_loop, self, request,
-                                    functools.partial(self._release_fetch, key),
-                                    callback,
-                                    self.max_buffer_size)
\ No newline at end of file
+            return Warc_HTTPConnection(self.io_loop, self, request,
+                                       functools.partial(self._release_fetch, key),
+                                       callback,
+                                       self.max_buffer_size)
+
+    def _release_fetch(self, key):
+        self.queue.finished(self.active[key][0])
+        SimpleAsyncHTTPClient._release_fetch(self, key)
\ No newline at end of file
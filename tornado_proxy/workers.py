@@ -0,0 +1,243 @@
+"""
+Pre-fork supervisor running several proxy processes on one port.
+
+Each worker binds its own listening socket with SO_REUSEPORT, so the
+kernel spreads incoming connections across workers and a new generation
+of workers can listen while the old one drains. Where SO_REUSEPORT is
+missing the sockets are bound once in the supervisor and inherited.
+
+    supervisor = Supervisor(4, run_worker, port=8001, on_exit=exited)
+    supervisor.run()            # returns after SIGTERM/SIGINT
+
+where ``run_worker(index, sockets)`` serves on the listening `sockets`
+until the worker should exit, and ``on_exit(pid)``, if given, is called in
+the supervisor once a worker exited, whatever the reason.
+
+Signals sent to the supervisor:
+
+    SIGHUP           start a new generation of workers, then gracefully
+                     stop the old one
+    SIGTERM, SIGINT  gracefully stop every worker and return
+
+Workers exiting on their own are restarted. Inside a worker, `drain`
+implements the graceful stop: stop accepting, wait for the in-flight
+requests, run the cleanup and stop the IOLoop.
+"""
+import errno
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from tornado import ioloop
+
+# Python 2 has no socket.SO_REUSEPORT; the value is 15 on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
+# Workers still serving requests this long after being asked to stop exit anyway.
+GRACEFUL_TIMEOUT = 30
+# Workers that die within this many seconds of starting are restarted with
+# this delay, so a broken worker does not fork in a tight loop.
+MIN_WORKER_UPTIME = 1
+
+
+def reuseport_supported():
+    if SO_REUSEPORT is None:
+        return False
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def bind_sockets(port, address=None, reuse_port=False, backlog=128):
+    """Like `tornado.netutil.bind_sockets`, optionally setting SO_REUSEPORT."""
+    sockets = []
+    if address == '':
+        address = None
+    for res in set(socket.getaddrinfo(address, port, socket.AF_UNSPEC,
+                                      socket.SOCK_STREAM, 0, socket.AI_PASSIVE)):
+        family, socktype, proto, canonname, sockaddr = res
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if family == socket.AF_INET6 and hasattr(socket, 'IPPROTO_IPV6'):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+
+class Supervisor(object):
+    def __init__(self, processes, run_worker, port, address=None, on_exit=None):
+        self.processes = processes
+        self.run_worker = run_worker
+        self.on_exit = on_exit
+        self.port = port
+        self.address = address
+        self.reuse_port = reuseport_supported()
+        self.shared_sockets = None
+        self.workers = {}  # pid -> (index, started)
+        self.draining = set()  # pids of the previous generations
+        self.stopping = False
+        self.reloading = False
+
+    def worker_sockets(self):
+        """The listening sockets for a new worker, bound in the worker itself
+        unless SO_REUSEPORT is missing."""
+        if self.shared_sockets is not None:
+            return self.shared_sockets
+        return bind_sockets(self.port, self.address, reuse_port=True)
+
+    def run(self):
+        if not self.reuse_port:
+            logging.warning('SO_REUSEPORT is not available, workers share one listening socket')
+            self.shared_sockets = bind_sockets(self.port, self.address)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        for index in xrange(self.processes):
+            self._spawn(index)
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self._reload()
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._reap(pid, status)
+        self._stop_all()
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            # The supervisor forwards SIGINT as SIGTERM, ignore the one the
+            # terminal sends to the whole process group.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                self.run_worker(index, self.worker_sockets())
+            except Exception:
+                logging.error('Worker %d failed' % index, exc_info=True)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        logging.info('Started worker %d (pid %d)' % (index, pid))
+        self.workers[pid] = (index, time.time())
+
+    def _reap(self, pid, status):
+        self._exited(pid)
+        worker = self.workers.pop(pid, None)
+        if worker is None:
+            # A worker of a previous generation finished draining.
+            self.draining.discard(pid)
+            return
+        if self.stopping:
+            return
+        index, started = worker
+        logging.warning('Worker %d (pid %d) exited with status %d, restarting'
+                        % (index, pid, status))
+        if time.time() - started < MIN_WORKER_UPTIME:
+            time.sleep(MIN_WORKER_UPTIME)
+        self._spawn(index)
+
+    def _exited(self, pid):
+        if self.on_exit is None:
+            return
+        try:
+            self.on_exit(pid)
+        except Exception:
+            logging.error('Handling the exit of pid %d failed' % pid, exc_info=True)
+
+    def _reload(self):
+        old = self.workers
+        self.workers = {}
+        logging.info('Reloading %d workers' % len(old))
+        for index in xrange(self.processes):
+            self._spawn(index)
+        for pid in old:
+            self.draining.add(pid)
+            self._signal(pid, signal.SIGTERM)
+
+    def _stop_all(self):
+        logging.info('Stopping %d workers' % len(self.workers))
+        for pid in self.workers:
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.time() + GRACEFUL_TIMEOUT + 5
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid:
+                self._reap(pid, status)
+                continue
+            if time.time() > deadline:
+                for pid in list(self.workers) + list(self.draining):
+                    logging.warning('Killing worker (pid %d)' % pid)
+                    self._signal(pid, signal.SIGKILL)
+                deadline = float('inf')
+            time.sleep(0.1)
+        self.workers = {}
+        self.draining.clear()
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+def drain(servers, in_flight, on_drained=None, timeout=GRACEFUL_TIMEOUT,
+          io_loop=None):
+    """Gracefully stops a worker.
+
+    Stops `servers` accepting connections, waits until `in_flight()` is 0
+    or `timeout` seconds passed, calls `on_drained()` and stops the IOLoop.
+    """
+    io_loop = io_loop or ioloop.IOLoop.instance()
+    for server in servers:
+        server.stop()
+    deadline = time.time() + timeout
+
+    def check():
+        pending = in_flight()
+        if pending and time.time() < deadline:
+            io_loop.add_timeout(time.time() + 0.1, check)
+            return
+        if pending:
+            logging.warning('Exiting with %d requests in flight' % pending)
+        try:
+            if on_drained is not None:
+                on_drained()
+        finally:
+            io_loop.stop()
+
+    check()
@@ -0,0 +1,202 @@
+"""
+Write-behind population of memcached.
+
+Responses are sent to the client without waiting for memcached to store
+them; a `WriteBehindQueue` takes the writes instead and sends them in the
+background:
+
+    writes = WriteBehindQueue(ccs, max_bytes=64 * 1024 * 1024)
+    writes.put(key, value, time=ttl, flags=MEMCACHED_FLAG, callback=done)
+
+Writes queued during one IOLoop iteration, and those piling up while
+`max_inflight` batches are being written, go out together in batches of
+at most `batch_items` items and `batch_bytes` bytes, pipelined by
+``set_multi``. A newer write of a queued key replaces the older one.
+
+The queue holds at most `max_items` writes and `max_bytes` bytes; past
+that writes are dropped, since the data is only a cache. A batch that is
+not answered within `timeout` seconds is given up on so that a stuck
+memcached connection cannot stop all writes.
+
+`callback`, if given, is called once the write completed, failed or was
+dropped. `report` has the counts of queued, written, replaced, dropped
+and failed writes and the drop ratio.
+"""
+import collections
+import logging
+import time
+
+from tornado import ioloop
+from tornado import stack_context
+
+
+class WriteBehindQueue(object):
+    def __init__(self, client, max_items=10000, max_bytes=64 * 1024 * 1024,
+                 batch_items=32, batch_bytes=1024 * 1024, max_inflight=4, timeout=5,
+                 io_loop=None):
+        self.client = client
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.batch_items = batch_items
+        self.batch_bytes = batch_bytes
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self._io_loop = io_loop
+        self.queue = collections.OrderedDict()  # key -> (value, time, flags, callbacks)
+        self.bytes = 0
+        self.inflight = 0
+        self._scheduled = False
+        self.stats = {}
+
+    @property
+    def io_loop(self):
+        # Resolved late, see MemcacheLease.io_loop.
+        return self._io_loop or ioloop.IOLoop.instance()
+
+    def _statlog(self, name, n=1):
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def put(self, key, value, time=0, flags=0, callback=None):
+        """Queues setting `key` to `value`; returns False if it was dropped."""
+        callbacks = [stack_context.wrap(callback)] if callback else []
+        old = self.queue.pop(key, None)
+        if old is not None:
+            self._statlog('replaced')
+            self.bytes -= len(old[0])
+            callbacks = old[3] + callbacks
+        if len(self.queue) >= self.max_items or self.bytes + len(value) > self.max_bytes:
+            self._statlog('dropped')
+            self._statlog('dropped_bytes', len(value))
+            for dropped in callbacks:
+                dropped()
+            return False
+        self._statlog('queued')
+        self.queue[key] = (value, time, flags, callbacks)
+        self.bytes += len(value)
+        if not self._scheduled:
+            self._scheduled = True
+            with stack_context.NullContext():
+                self.io_loop.add_callback(self._flush)
+        return True
+
+    def _flush(self):
+        self._scheduled = False
+        while self.queue and self.inflight < self.max_inflight:
+            batch = []
+            size = 0
+            while self.queue and len(batch) < self.batch_items:
+                key = next(iter(self.queue))
+                if batch and size + len(self.queue[key][0]) > self.batch_bytes:
+                    break
+                value, expire, flags, callbacks = self.queue.pop(key)
+                self.bytes -= len(value)
+                size += len(value)
+                batch.append((key, value, expire, flags, callbacks))
+            self._write(batch, size)
+
+    def _write(self, batch, size):
+        self.inflight += 1
+        self._statlog('batches')
+        state = {'done': False}
+
+        def done(stored):
+            if state['done']:
+                return
+            state['done'] = True
+            self.io_loop.remove_timeout(timeout)
+            self.inflight -= 1
+            self._statlog('written', stored or 0)
+            if stored == len(batch):
+                self._statlog('written_bytes', size)
+            else:
+                self._statlog('failed', len(batch) - (stored or 0))
+            for item in batch:
+                for callback in item[4]:
+                    callback()
+            self._flush()
+
+        def timed_out():
+            if not state['done']:
+                self._statlog('timeouts')
+                logging.warning('memcached did not answer a write of %d items in %ss'
+                                % (len(batch), self.timeout))
+                done(0)
+
+        with stack_context.NullContext():
+            timeout = self.io_loop.add_timeout(time.time() + self.timeout, timed_out)
+            try:
+                self.client.set_multi([(key, value, expire, flags)
+                                       for key, value, expire, flags, callbacks in batch],
+                                      callback=done)
+            except Exception:
+                logging.error('Writing %d items to memcached failed' % len(batch),
+                              exc_info=True)
+                done(0)
+
+    def report(self):
+        puts = self.stats.get('queued', 0) + self.stats.get('dropped', 0)
+        return dict(self.stats, pending=len(self.queue), pending_bytes=self.bytes,
+                    inflight=self.inflight,
+                    drop_ratio=round(self.stats.get('dropped', 0) / float(puts), 3)
+                    if puts else 0)
+
+
+if __name__ == '__main__':
+    class Client(object):
+        """Holds each set_multi until it is answered with `answer`."""
+
+        def __init__(self):
+            self.batches = []
+            self.broken = False
+
+        def set_multi(self, items, callback):
+            if self.broken:
+                raise IOError('connection lost')
+            self.batches.append((items, callback))
+
+        def answer(self, stored=None):
+            items, callback = self.batches.pop(0)
+            callback(len(items) if stored is None else stored)
+
+    loop = ioloop.IOLoop.instance()
+    client = Client()
+    writes = WriteBehindQueue(client, max_items=5, batch_items=2, max_inflight=2,
+                              timeout=0.1, io_loop=loop)
+    done = []
+
+    def run(seconds):
+        loop.add_timeout(time.time() + seconds, loop.stop)
+        loop.start()
+
+    for n in range(5):
+        writes.put('k%d' % n, 'v%d' % n, callback=lambda n=n: done.append(n))
+    assert writes.put('k1', 'v1b', callback=lambda: done.append('1b'))  # replaces k1
+    assert not writes.put('k5', 'v5', callback=lambda: done.append(5))   # queue full
+    assert done == [5]
+    run(0.01)
+    # Batched after the iteration, at most max_inflight at a time.
+    assert [[item[0] for item in items] for items, callback in client.batches] == \
+        [['k0', 'k2'], ['k3', 'k4']]
+    client.answer()
+    assert client.batches[-1][0] == [('k1', 'v1b', 0, 0)] and done == [5, 0, 2]
+    client.answer(stored=1)                  # k4 was not stored
+    client.answer()
+    assert done == [5, 0, 2, 3, 4, 1, '1b'] and not writes.queue
+
+    # A failing or stuck client fails its batch without holding up the next.
+    client.broken = True
+    writes.put('k6', 'v6', callback=lambda: done.append(6))
+    logging.disable(logging.ERROR)
+    run(0.01)
+    logging.disable(logging.NOTSET)
+    client.broken = False
+    writes.put('k7', 'v7', callback=lambda: done.append(7))
+    logging.disable(logging.WARNING)
+    run(0.2)
+    logging.disable(logging.NOTSET)
+    assert done[7:] == [6, 7] and writes.inflight == 0
+    report = writes.report()
+    assert (report['queued'], report['replaced'], report['dropped'], report['written'],
+            report['failed'], report['timeouts'], report['batches']) == \
+        (8, 1, 1, 4, 3, 1, 5), report
+    print 'ok'
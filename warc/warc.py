@@ -157,7 +157,14 @@ class WARCRecord(object):
                 
     def write_to(self, f):
         self.header.write_to(f)
-        f.write(self.payload)
+        if hasattr(self.payload, "read"):
+            # File-like payloads are copied in blocks instead of being
+            # loaded into memory. Content-Length and WARC-Payload-Digest
+            # must already be in the header.
+            for block in iter(lambda: self.payload.read(64*1024), ""):
+                f.write(block)
+        else:
+            f.write(self.payload)
         f.write("\r\n")
         f.write("\r\n")
         f.flush()